@@ -13,6 +13,7 @@ https://docs.djangoproject.com/en/4.2/ref/settings/
 from pathlib import Path
 from base.helpers import get_secret
 import os
+import json
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -132,6 +133,8 @@ EMAIL_HOST_USER = get_secret('APIFORLLMDJANGO_EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = get_secret('APIFORLLMDJANGO_EMAIL_HOST_PASSWORD')
 TURNSTILE_SECRET_KEY = get_secret('APIFORLLMDJANGO_TURNSTILE_SECRET_KEY')
 APIFORLLMDJANGO_OPENAI_KEY = get_secret('APIFORLLMDJANGO_OPENAI_KEY')
+# Run interactive chat turns in the ASGI event loop instead of on Celery workers
+ASYNC_CHAT_CONSUMER = get_secret('APIFORLLMDJANGO_ASYNC_CHAT_CONSUMER') == 'True'
 
 if get_secret('APIFORLLMDJANGO_ENV') == 'prod':
     SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
@@ -148,4 +151,132 @@ CHANNEL_LAYERS = {
     },
 }
 
-CELERY_BROKER_URL = 'redis://redis:6379/0'
\ No newline at end of file
+CELERY_BROKER_URL = 'redis://redis:6379/0'
+# Interactive completions, function dispatch, upkeep and batch work each have their own
+# queue and workers, so a burst of one cannot hold up the others.
+CELERY_TASK_DEFAULT_QUEUE = 'batch'
+CELERY_TASK_ROUTES = {
+    'main.tasks.openai_api_call': {'queue': 'interactive'},
+    'main.tasks.execute_function': {'queue': 'functions'},
+    'main.tasks.summarize_session': {'queue': 'background'},
+    'main.tasks.expire_balance_holds': {'queue': 'background'},
+    'main.tasks.flush_balance_ledger': {'queue': 'background'},
+}
+CELERY_BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(10)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+}
+# Workers reserve one task at a time, so a higher priority turn is not stuck behind prefetched ones.
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+# State that must survive memory pressure (locks, counters, balances)
+REDIS_URL = 'redis://redis:6379/1'
+# Disposable data, served by a separate LRU-evicting instance
+CACHE_REDIS_URL = 'redis://redis-cache:6379/0'
+
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": CACHE_REDIS_URL,
+    }
+}
+
+HISTORY_CACHE_TIMEOUT = 60 * 60
+
+# Balance holds older than this are released by expire_balance_holds
+BALANCE_RESERVATION_TIMEOUT = 120
+BALANCE_LEDGER_FLUSH_BATCH_SIZE = 1000
+
+CELERY_BEAT_SCHEDULE = {
+    'expire-balance-holds': {
+        'task': 'main.tasks.expire_balance_holds',
+        'schedule': 60.0,
+    },
+    'flush-balance-ledger': {
+        'task': 'main.tasks.flush_balance_ledger',
+        'schedule': 30.0,
+    },
+}
+
+MODERATION_CACHE_TIMEOUT = 60 * 60 * 24
+# Replies cached for templates with cache_responses set; the cache instance evicts the least recently used
+RESPONSE_CACHE_TIMEOUT = 60 * 60 * 24 * 7
+# First-turn replies of templates with semantic_cache set are reused for prompts whose embedding
+# is at least this similar. Needs numpy and sentence-transformers, which are not in requirements.txt.
+SEMANTIC_CACHE_MODEL = 'all-MiniLM-L6-v2'
+SEMANTIC_CACHE_THRESHOLD = 0.92
+SEMANTIC_CACHE_MAX_ENTRIES = 10000
+SEMANTIC_CACHE_DIR = os.path.join(BASE_DIR, 'semantic_cache')
+# Turns in flight per interactive Celery worker, the same value as its --concurrency in docker-compose.yml.
+# Every one of them may hold a database connection, so Postgres' max_connections has to exceed the
+# concurrencies of all Celery workers plus the web process's connections; docker-compose.yml sets 400.
+CELERY_INTERACTIVE_CONCURRENCY = int(get_secret('APIFORLLMDJANGO_CELERY_INTERACTIVE_CONCURRENCY') or 200)
+# Threads moderating user input, one for each turn in flight
+MODERATION_MAX_WORKERS = CELERY_INTERACTIVE_CONCURRENCY
+
+# Seconds to wait on OpenAI, function servers and Turnstile; the threads pool does not enforce task time limits
+OPENAI_REQUEST_TIMEOUT = 30
+FUNCTION_REQUEST_TIMEOUT = 30
+TURNSTILE_REQUEST_TIMEOUT = 10
+# Outbound HTTP connections are pooled per host and kept alive; a pool keeps up to
+# HTTP_POOL_MAXSIZE idle connections, enough for every thread of a threads pool worker.
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_CONNECT_RETRIES = 2
+HTTP_POOL_HOSTS = 20
+HTTP_POOL_MAXSIZE = 200
+
+# Adaptive limit on concurrent completions per provider and model, shared by all workers. It grows by one per
+# round of successful calls and is multiplied by decrease_factor on 429s, 5xx errors, timeouts or a
+# time to first response above latency_tolerance times its moving average.
+UPSTREAM_CONCURRENCY = {'initial': 20, 'min': 2, 'max': 200, 'decrease_factor': 0.5, 'latency_tolerance': 2.0, 'decrease_cooldown': 5}
+# Endpoints serving chat completions besides OpenAI, each with its own concurrency limit. Turns
+# go to the healthiest provider serving the template's model and fail over to the others, e.g.
+# [{"name": "vllm", "api_base": "http://vllm:8000/v1", "models": ["llama"]},
+#  {"name": "azure", "api_type": "azure", "api_base": "https://example.openai.azure.com", "api_version": "2023-07-01-preview",
+#   "api_key_secret": "APIFORLLMDJANGO_AZURE_OPENAI_KEY", "deployments": {"gpt-4": "gpt4"}, "concurrency": {"max": 50}}]
+LLM_PROVIDERS = json.loads(get_secret('APIFORLLMDJANGO_LLM_PROVIDERS') or '[]')
+# Providers failing this many calls in a row are tried last for PROVIDER_COOLDOWN seconds
+PROVIDER_FAILURE_THRESHOLD = 3
+PROVIDER_COOLDOWN = 30
+# Opt-in hedging of short completions of the models named by these prefixes: when no response
+# has arrived within the HEDGE_PERCENTILE percentile of the provider's recent times to first
+# response, the request is also sent to another provider (or again) and the first answer wins.
+HEDGE_MODELS = []
+HEDGE_MAX_INPUT_TOKENS = 1000
+HEDGE_PERCENTILE = 95
+HEDGE_MIN_DELAY = 0.5
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MAX_WORKERS = 32
+# Upstream slots not given back within this many seconds are reclaimed
+UPSTREAM_SLOT_TIMEOUT = 60
+# Turns that find no upstream slot are retried after a jittered exponential backoff
+UPSTREAM_RETRY_BASE_DELAY = 1
+UPSTREAM_RETRY_MAX_DELAY = 8
+UPSTREAM_MAX_RETRIES = 5
+
+# Chat turn limits and Celery priority (0 is the highest) per user tier. A user gets the
+# first tier named after one of their groups, or the default tier.
+USER_TIERS = {
+    'default': {'requests_per_minute': 20, 'tokens_per_minute': 40000, 'max_in_flight': 2, 'priority': 6},
+}
+# In-flight turn slots not given back within this many seconds are reclaimed
+RATE_LIMIT_TURN_TIMEOUT = 60
+# Chat session locks of turns that never released them expire after this many seconds
+SESSION_LOCK_TIMEOUT = 60
+# User messages that can wait for the running turn of a session, to be answered together
+SESSION_QUEUE_MAX_MESSAGES = 10
+
+# Prices and limits of models, overriding or extending main.model_registry.MODEL_SPECS, e.g.
+# {"gpt-4-1106-preview": {"input_cost": 0.01, "output_cost": 0.03, "context_window": 128000, "max_output_tokens": 4000}}.
+# Replies are capped at max_output_tokens (1000 unless overridden).
+MODEL_SPECS = json.loads(get_secret('APIFORLLMDJANGO_MODEL_SPECS') or '{}')
+
+# Rolling summaries of long chat sessions, as fractions of the model's prompt budget: a session is
+# summarized once its unsummarized messages pass the trigger, before drop_oldest would discard them,
+# keeping the most recent ones verbatim and folding in at most the max input per summary.
+SUMMARY_TRIGGER_FRACTION = 0.75
+SUMMARY_KEEP_RECENT_FRACTION = 0.3
+SUMMARY_MAX_INPUT_FRACTION = 0.75
+# Seconds before a session whose user could not pay for its summary is summarized again
+SUMMARY_UNFUNDED_RETRY_DELAY = 60 * 10
\ No newline at end of file
@@ -1,5 +1,6 @@
 import requests
 from django.conf import settings
+from main import http_client
 from django.contrib import messages
 import os
 
@@ -11,8 +12,12 @@ def check_turnstile(request):
             'secret': settings.TURNSTILE_SECRET_KEY,
             'response': turnstile_token,
         }
-        response = requests.post(siteverify_url, data=data)
-        result = response.json()
+        try:
+            response = http_client.get_session().post(siteverify_url, data=data, timeout=http_client.timeout(settings.TURNSTILE_REQUEST_TIMEOUT))
+            result = response.json()
+        except (requests.RequestException, ValueError):
+            messages.error(request, 'Captcha could not be verified. Please try again.')
+            return False
 
         if result['success']:
             return True
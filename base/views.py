@@ -10,6 +10,8 @@ from .forms import EmailUpdateForm, EmailRequiredUserCreationForm
 from django.contrib.auth.views import LoginView, PasswordResetView
 from .helpers import check_turnstile
 from main.models import UserBalance
+from main.ledger import get_available_balance
+from redis import RedisError
 from decimal import Decimal
 
 def handler400(request, exception, template_name="base/error.html"):
@@ -70,7 +72,12 @@ class ProfileView(LoginRequiredMixin, View):
     def get(self, request, *args, **kwargs):
         form = EmailUpdateForm(initial={'email': request.user.email})
         user_balance = UserBalance.objects.get(user=request.user)
-        return render(request, 'base/profile.html', {'user': request.user, 'form': form, 'user_balance': user_balance})
+        try:
+            balance = get_available_balance(request.user.id)
+        except RedisError:
+            # The settled balance lags behind unflushed charges, but is better than an error page.
+            balance = user_balance.balance
+        return render(request, 'base/profile.html', {'user': request.user, 'form': form, 'user_balance': user_balance, 'balance': balance})
 
     def post(self, request, *args, **kwargs):
         form = EmailUpdateForm(request.POST)
@@ -1,5 +1,5 @@
 from django.contrib import admin
-from .models import ChatSession, ChatMessage, UserBalance, FunctionSchema, ChatTemplate, SecretKey, FunctionServer
+from .models import ChatSession, ChatMessage, UserBalance, FunctionSchema, ChatTemplate, SecretKey, FunctionServer, BalanceLedgerEntry
 from django.utils.text import Truncator
 from .forms import ChatMessageAdminForm, SecretKeyForm, ChatTemplateAdminForm
 
@@ -29,13 +29,19 @@ class UserBalanceAdmin(admin.ModelAdmin):
     search_fields = ['user__username', 'user__email']
     list_filter = ['last_credit']
 
+class BalanceLedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ('user', 'kind', 'amount', 'chat_message', 'flushed', 'created_at')
+    search_fields = ['user__username']
+    list_filter = ['kind', 'flushed', 'created_at']
+    raw_id_fields = ('chat_message',)
+
 class FunctionSchemaAdmin(admin.ModelAdmin):
     list_display = ('name', 'user', 'is_public', 'network_access')
     search_fields = ('name', 'user')
 
 class ChatTemplateAdmin(admin.ModelAdmin):
     form = ChatTemplateAdminForm
-    list_display = ('name', 'model', 'temperature', 'user', 'is_public')
+    list_display = ('name', 'model', 'temperature', 'context_strategy', 'user', 'is_public', 'cache_responses', 'semantic_cache')
     search_fields = ('name', 'user')
 
 class SecretKeyAdmin(admin.ModelAdmin):
@@ -51,6 +57,7 @@ class FunctionServerAdmin(admin.ModelAdmin):
 admin.site.register(ChatSession, ChatSessionAdmin)
 admin.site.register(ChatMessage, ChatMessageAdmin)
 admin.site.register(UserBalance, UserBalanceAdmin)
+admin.site.register(BalanceLedgerEntry, BalanceLedgerEntryAdmin)
 admin.site.register(FunctionSchema, FunctionSchemaAdmin)
 admin.site.register(ChatTemplate, ChatTemplateAdmin)
 admin.site.register(SecretKey, SecretKeyAdmin)
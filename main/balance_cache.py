@@ -0,0 +1,95 @@
+from decimal import Decimal
+from functools import lru_cache
+from .redis_client import get_redis
+
+# Balances are kept in Redis as integer nano-dollars, the precision of UserBalance.balance.
+UNIT = Decimal('0.000000001')
+HOLD_EXPIRY_KEY = 'balance_hold_expiry'
+MISSING = -1
+
+def to_units(amount):
+    return int((Decimal(amount) / UNIT).to_integral_value())
+
+def from_units(units):
+    return Decimal(units) * UNIT
+
+def balance_key(user_id):
+    return f'balance:{user_id}'
+
+def holds_key(user_id):
+    return f'balance_holds:{user_id}'
+
+RESERVE = """
+local balance = redis.call('GET', KEYS[1])
+if not balance then return -1 end
+if tonumber(balance) < tonumber(ARGV[1]) then return 0 end
+redis.call('DECRBY', KEYS[1], ARGV[1])
+redis.call('HSET', KEYS[2], ARGV[2], ARGV[1])
+redis.call('ZADD', KEYS[3], ARGV[3], ARGV[4])
+return 1
+"""
+
+SETTLE = """
+local held = redis.call('HGET', KEYS[2], ARGV[1])
+if held then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+else
+    held = 0
+end
+redis.call('ZREM', KEYS[3], ARGV[3])
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('INCRBY', KEYS[1], tonumber(held) - tonumber(ARGV[2]))
+end
+return 1
+"""
+
+CHARGE = """
+local balance = redis.call('GET', KEYS[1])
+if not balance then return -1 end
+if tonumber(balance) < tonumber(ARGV[1]) then return 0 end
+redis.call('DECRBY', KEYS[1], ARGV[1])
+return 1
+"""
+
+ADJUST = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('INCRBY', KEYS[1], ARGV[1])
+end
+return 1
+"""
+
+@lru_cache(maxsize=None)
+def get_script(source):
+    return get_redis().register_script(source)
+
+def get(user_id):
+    units = get_redis().get(balance_key(user_id))
+    return None if units is None else int(units)
+
+def initialize(user_id, units):
+    """Seed the cached balance unless another process got there first."""
+    get_redis().set(balance_key(user_id), units, nx=True)
+
+def reserve(user_id, hold_id, units, expires_at):
+    member = f'{user_id}:{hold_id}'
+    return get_script(RESERVE)(keys=[balance_key(user_id), holds_key(user_id), HOLD_EXPIRY_KEY], args=[units, hold_id, expires_at, member])
+
+def settle(user_id, hold_id, units):
+    member = f'{user_id}:{hold_id}'
+    return get_script(SETTLE)(keys=[balance_key(user_id), holds_key(user_id), HOLD_EXPIRY_KEY], args=[hold_id, units, member])
+
+def charge(user_id, units):
+    return get_script(CHARGE)(keys=[balance_key(user_id)], args=[units])
+
+def adjust(user_id, units):
+    """Apply a change already recorded in the database, if the balance is cached."""
+    return get_script(ADJUST)(keys=[balance_key(user_id)], args=[units])
+
+def expired_holds(now):
+    """Return (user_id, hold_id) pairs of holds that expired before now."""
+    members = get_redis().zrangebyscore(HOLD_EXPIRY_KEY, 0, now)
+    return [tuple(member.decode().split(':', 1)) for member in members]
+
+def reset(user_id):
+    """Drop the cached balance and holds so they are rebuilt from the database."""
+    get_redis().delete(balance_key(user_id), holds_key(user_id))
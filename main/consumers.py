@@ -1,68 +1,162 @@
-from channels.generic.websocket import JsonWebsocketConsumer
+from channels.generic.websocket import JsonWebsocketConsumer, AsyncJsonWebsocketConsumer
+from channels.db import database_sync_to_async
 from django.contrib.auth.models import AnonymousUser
-from .models import ChatSession
-from asgiref.sync import async_to_sync
-from .tasks import openai_api_call
+from .models import ChatSession, ContextStrategyChoices, FlaggedSessionCount
+from asgiref.sync import async_to_sync, sync_to_async
+from .tasks import openai_api_call, prepare_turn, moderate_reply, finish_turn, store_cached_reply, release_turn, astream_chat_completion, get_cached_reply, UPSTREAM_BUSY_MESSAGE
+from .context import get_prompt_budget
+from .helpers import estimate_cost
+from .tokens import REPLY_PRIMING_TOKENS, num_tokens_from_message
+from .history_cache import fail_open
+from . import ledger, rate_limit, session_events, session_lock, upstream_limit
+from django.conf import settings
+import asyncio
+import uuid
 from django.core.signing import TimestampSigner, SignatureExpired, BadSignature
 from django.core.exceptions import ObjectDoesNotExist
 
+MAX_FLAGGED_SESSIONS = 3
+
+def get_chat_session_access(user, session_id):
+    """Return (session, close_code) for user on session_id; close_code is None when access is allowed."""
+    if user == AnonymousUser():
+        return None, 4401
+
+    try:
+        session = ChatSession.objects.select_related('template').get(id=session_id)
+    except ChatSession.DoesNotExist:
+        return None, 4404
+
+    if user.id != session.user_id:
+        return session, 4403
+
+    if session.flagged or FlaggedSessionCount.get(user.id) >= MAX_FLAGGED_SESSIONS:
+        return session, 4405
+
+    return session, None
+
+ACCESS_DENIED_MESSAGES = {
+    4401: "You do not have access.",
+    4404: "Invalid chat session.",
+    4403: "You can only access your chat sessions.",
+    4405: "This chat session has been flagged or you have too many flagged chat sessions. Please email dinesh@apiforllm.com if you think there's been an error.",
+}
+
+TURN_REJECTED_MESSAGES = {
+    'duplicate': "Your request is already being processed.",
+    'queued': "Your message will be sent when the current reply finishes.",
+    'busy': "Please wait for the current reply in this chat session to finish.",
+    'requests': "You are sending messages too quickly. Please wait a moment and try again.",
+    'tokens': "You have used too many tokens in the last minute. Please wait a moment and try again.",
+    'in_flight': "Please wait for your current replies to finish before sending another message.",
+    'context': "Token limit exceeded. Please start a new chat session.",
+    'balance': "Insufficient balance in your account. Please topup your account to continue.",
+}
+
+@fail_open()
+def precheck_turn(session, user_id, content):
+    """Return a TURN_REJECTED_MESSAGES key for a turn that prepare_turn would certainly refuse, or None.
+
+    Uses the session's stored token totals and the cached balance instead of loading
+    the history, and only counts the tokens any prompt for the turn must include.
+    prepare_turn still makes the exact checks, so the turn is let through if Redis
+    is unavailable.
+    """
+    if 'invoke_function' in content:
+        return None  # runs a function, not a completion
+    template = session.template
+    budget = get_prompt_budget(template.model) - template.function_token_count
+    new_tokens = num_tokens_from_message({'role' : 'user', 'content' : content['content']}, template.model) if 'content' in content else 0
+
+    if template.context_strategy == ContextStrategyChoices.REJECT:
+        # The connection's copy of the session is not kept up to date.
+        session.refresh_from_db(fields=['token_count', 'summary_token_count', 'summarized_token_count', 'summarized_until'])
+        history_tokens = session.token_count - session.summarized_token_count
+        if session.summarized_until is not None:
+            history_tokens += session.summary_token_count
+        required_tokens = history_tokens + new_tokens
+    elif template.context_strategy == ContextStrategyChoices.DROP_OLDEST:
+        required_tokens = new_tokens
+    else:
+        required_tokens = 0  # the newest message is cut down to fit
+    if required_tokens > budget:
+        return 'context'
+
+    input_tokens = required_tokens + template.function_token_count + REPLY_PRIMING_TOKENS
+    if ledger.get_available_balance(user_id) < estimate_cost(input_tokens, model=template.model):
+        return 'balance'
+    return None
+
+def get_turn_request(content):
+    """Return the turn a client frame asks for, as prepare_turn content, or None for an invalid frame.
+
+    Only the keys clients may send are kept; 'queued' and 'resume' are set by the
+    server for follow-up turns and retries.
+    """
+    if 'content' in content:
+        return {'content' : content['content']} if isinstance(content['content'], str) else None
+    if 'invoke_ai' in content:
+        return {'invoke_ai' : True}
+    if 'invoke_function' in content:
+        return {'invoke_function' : True}
+    return None
+
+def admit_turn(session, user_id, content, limits):
+    """Return (turn_id, reason); turn_id is None and reason a TURN_REJECTED_MESSAGES key when the turn may not run.
+
+    Turns that cannot fit the context or the user's balance are turned away before
+    taking anything. An admitted turn holds the session's lock and one of the user's
+    in-flight slots until the task running it releases them. A queued message counts
+    against the user's request rate, but not against their in-flight turns.
+    """
+    reason = precheck_turn(session, user_id, content)
+    if reason is not None:
+        return None, reason
+
+    turn_id = uuid.uuid4().hex
+    reason = rate_limit.admit(user_id, turn_id, limits)
+    if reason is not None:
+        return None, reason
+
+    reason = session_lock.acquire(session.id, turn_id, content)
+    if reason is not None:
+        rate_limit.release(user_id, turn_id, 0)
+        return None, reason
+    return turn_id, None
+
 class ChatConsumer(JsonWebsocketConsumer):
+    """Chat consumer that hands completion turns to Celery.
+
+    Access is checked once on connect. The session and the verdict are kept for the
+    connection, and flagging a session revokes access through a session_flagged event.
+    """
     def connect(self):
-        user = self.scope["user"]
-        if user == AnonymousUser():
-            self.close(code=4401)
-            return
-        
-        session_id = self.scope["url_route"]["kwargs"]["session_id"]
-        self.session_id = session_id
-        try:
-            session = ChatSession.objects.get(id=session_id)
-        except ChatSession.DoesNotExist:
-            self.close(code=4404)
-            return
-        
-        if user != session.user:
-            self.close(code=4403)
-            return
-        
-        flagged_sessions_count = ChatSession.objects.filter(user=user, flagged=True).count()
-        if session.flagged or flagged_sessions_count >= 3:
-            self.close(code=4405)
+        self.session_id = self.scope["url_route"]["kwargs"]["session_id"]
+        self.session, self.close_code = get_chat_session_access(self.scope["user"], self.session_id)
+        if self.close_code is not None:
+            self.close(code=self.close_code)
             return
         
+        self.tier = rate_limit.get_user_tier(self.scope["user"])
         self.accept()
         async_to_sync(self.channel_layer.group_add)(self.session_id, self.channel_name)
+        async_to_sync(self.channel_layer.group_add)(session_events.user_group(self.scope["user"].id), self.channel_name)
 
     def receive_json(self, content, **kwargs):
         user = self.scope["user"]
-        if user == AnonymousUser():
-            self.send_json({"role" : "system", "content" : "You do not have access."})
-            self.close(code=4401)
-            return
-
-        session_id = self.scope["url_route"]["kwargs"]["session_id"]
-        try:
-            session = ChatSession.objects.get(id=session_id)
-        except ChatSession.DoesNotExist:
-            self.send_json({"role" : "system", "content" : "Invalid chat session."})
-            self.close(code=4404)
+        session, close_code = self.session, self.close_code
+        if close_code is not None:
+            self.send_json({"role" : "system", "content" : ACCESS_DENIED_MESSAGES[close_code]})
+            self.close(code=close_code)
             return
 
-        if user != session.user:
-            self.send_json({"role" : "system", "content" : "You can only access your chat sessions."})
-            return
-
-        flagged_sessions_count = ChatSession.objects.filter(user=user, flagged=True).count()
-        if session.flagged or flagged_sessions_count >= 3:
-            self.send_json({
-                "role": "system",
-                "content": "This chat session has been flagged or you have too many flagged chat sessions. Please email dinesh@apiforllm.com if you think there's been an error."
-            })
-            self.close(code=4405)
-            return
-
-        if 'content' in content or 'invoke_ai' in content or 'invoke_function' in content:
-            openai_api_call.delay(session.id, user.id, content)
+        content = get_turn_request(content)
+        if content is not None:
+            turn_id, reason = admit_turn(session, user.id, content, self.tier)
+            if reason is not None:
+                self.send_json({"role" : "system", "content" : TURN_REJECTED_MESSAGES[reason], "rejected" : reason})
+                return
+            openai_api_call.apply_async((session.id, user.id, content, turn_id), priority=self.tier['priority'])
         else:
             self.send_json({"role" : "system", "content" : "Invalid request."})
     
@@ -78,9 +172,119 @@ class ChatConsumer(JsonWebsocketConsumer):
     def receive_group_message(self, event):
         self.send_json(event['message'])
 
+    def session_flagged(self, event):
+        if event['session_id'] == self.session.id or event['flagged_count'] >= MAX_FLAGGED_SESSIONS:
+            self.close_code = 4405
 
     def disconnect(self, close_code):
         async_to_sync(self.channel_layer.group_discard)(self.session_id, self.channel_name)
+        async_to_sync(self.channel_layer.group_discard)(session_events.user_group(self.scope["user"].id), self.channel_name)
+
+class AsyncChatConsumer(AsyncJsonWebsocketConsumer):
+    """Chat consumer that runs completion turns inside the ASGI event loop instead of on a Celery worker.
+
+    Function execution is still dispatched to Celery by prepare_turn. Access is cached
+    for the connection as in ChatConsumer.
+    """
+    async def connect(self):
+        self.session_id = self.scope["url_route"]["kwargs"]["session_id"]
+        self.turns = set()
+        self.session, self.close_code = await database_sync_to_async(get_chat_session_access)(self.scope["user"], self.session_id)
+        if self.close_code is not None:
+            await self.close(code=self.close_code)
+            return
+
+        self.tier = await database_sync_to_async(rate_limit.get_user_tier)(self.scope["user"])
+        await self.accept()
+        await self.channel_layer.group_add(self.session_id, self.channel_name)
+        await self.channel_layer.group_add(session_events.user_group(self.scope["user"].id), self.channel_name)
+
+    async def receive_json(self, content, **kwargs):
+        user = self.scope["user"]
+        session, close_code = self.session, self.close_code
+        if close_code is not None:
+            await self.send_json({"role" : "system", "content" : ACCESS_DENIED_MESSAGES[close_code]})
+            await self.close(code=close_code)
+            return
+
+        content = get_turn_request(content)
+        if content is not None:
+            turn_id, reason = await database_sync_to_async(admit_turn)(session, user.id, content, self.tier)
+            if reason is not None:
+                await self.send_json({"role" : "system", "content" : TURN_REJECTED_MESSAGES[reason], "rejected" : reason})
+                return
+            self.start_turn(session.id, user.id, content, turn_id)
+        else:
+            await self.send_json({"role" : "system", "content" : "Invalid request."})
+
+    def start_turn(self, session_id, user_id, content, turn_id):
+        # Run the turn as a separate task so group messages (the streamed deltas) keep being delivered.
+        turn = asyncio.ensure_future(self.run_turn(session_id, user_id, content, turn_id))
+        self.turns.add(turn)
+        turn.add_done_callback(self.turns.discard)
+
+    async def run_turn(self, session_id, user_id, content, turn_id):
+        tokens_used = 0
+        try:
+            turn = await database_sync_to_async(prepare_turn)(session_id, user_id, content)
+            if turn is None:
+                return
+
+            # Moderation, embedding and cache lookups block on the network, so they stay off the ORM's single thread.
+            response = await sync_to_async(get_cached_reply, thread_sensitive=False)(turn)
+            if response is None:
+                try:
+                    response = await self.stream_with_retries(session_id, turn)
+                except upstream_limit.Overloaded:
+                    await database_sync_to_async(turn['reservation'].release)()
+                    await self.send_group_message(UPSTREAM_BUSY_MESSAGE)
+                    return
+                except Exception as e:
+                    await database_sync_to_async(turn['reservation'].release)()
+                    await self.send_group_message({"role": "system", "content": "A network error occurred."})
+                    return
+
+                tokens_used = turn['input_tokens'] + response['output_tokens']
+            flagged = await sync_to_async(moderate_reply, thread_sensitive=False)(turn, response)
+            if await database_sync_to_async(finish_turn)(turn, response, flagged):
+                await sync_to_async(store_cached_reply, thread_sensitive=False)(turn, response)
+
+        except Exception as e:
+            await self.send_group_message({"role": "system", "content": "An error occurred."})
+        finally:
+            follow_up = await database_sync_to_async(release_turn)(session_id, user_id, turn_id, tokens_used)
+            if follow_up is not None:
+                follow_up_turn_id, follow_up_content = follow_up
+                self.start_turn(session_id, user_id, follow_up_content, follow_up_turn_id)
+
+    async def stream_with_retries(self, session_id, turn):
+        """Stream the turn's completion, waiting out upstream overloads with jittered backoff."""
+        for retries in range(settings.UPSTREAM_MAX_RETRIES):
+            try:
+                return await astream_chat_completion(session_id, turn['messages'], turn['user'].username, turn['session'], turn['input_tokens'], turn['user_moderation'])
+            except upstream_limit.Overloaded:
+                await asyncio.sleep(upstream_limit.retry_delay(retries))
+        return await astream_chat_completion(session_id, turn['messages'], turn['user'].username, turn['session'], turn['input_tokens'], turn['user_moderation'])
+
+    async def send_group_message(self, message):
+        await self.channel_layer.group_send(
+            self.session_id,
+            {
+                'type': 'receive_group_message',
+                'message': message,
+            }
+        )
+
+    async def receive_group_message(self, event):
+        await self.send_json(event['message'])
+
+    async def session_flagged(self, event):
+        if event['session_id'] == self.session.id or event['flagged_count'] >= MAX_FLAGGED_SESSIONS:
+            self.close_code = 4405
+
+    async def disconnect(self, close_code):
+        await self.channel_layer.group_discard(self.session_id, self.channel_name)
+        await self.channel_layer.group_discard(session_events.user_group(self.scope["user"].id), self.channel_name)
 
 class FunctionResultConsumer(JsonWebsocketConsumer):
     def connect(self):
@@ -120,7 +324,20 @@ class FunctionResultConsumer(JsonWebsocketConsumer):
         
         if output is not None and session_exists:
             session = ChatSession.objects.get(id=self.session_id)
-            openai_api_call.delay(session.id, session.user.id, {"content" : output})
+            content = {"content" : output}
+            turn_id = uuid.uuid4().hex
+            reason = session_lock.acquire(session.id, turn_id, content)
+            if reason is not None:
+                async_to_sync(self.channel_layer.group_send)(
+                    self.session_id,
+                    {
+                        'type': 'receive_group_message',
+                        'message': {"role" : "system", "content" : TURN_REJECTED_MESSAGES[reason], "rejected" : reason},
+                    }
+                )
+                return
+            priority = rate_limit.get_user_tier(session.user)['priority']
+            openai_api_call.apply_async((session.id, session.user.id, content, turn_id), priority=priority)
         elif error is not None:
             async_to_sync(self.channel_layer.group_send)(
                 self.session_id,
@@ -0,0 +1,74 @@
+from .tokens import DEFAULT_MODEL, TOKENS_PER_MESSAGE, REPLY_PRIMING_TOKENS, get_encoding
+from .model_registry import get_model_spec
+
+def get_context_window(model):
+    return get_model_spec(model).context_window
+
+def get_prompt_budget(model):
+    """Tokens left for the prompt once the model's maximum reply is reserved."""
+    spec = get_model_spec(model)
+    return spec.context_window - spec.max_output_tokens - REPLY_PRIMING_TOKENS
+
+def reject(system_messages, history, budget, model=DEFAULT_MODEL):
+    """Send everything or nothing."""
+    if sum(token_count for message, token_count in system_messages + history) > budget:
+        return None
+    return system_messages + history
+
+def drop_oldest(system_messages, history, budget, model=DEFAULT_MODEL):
+    """Keep the system prompt and as many of the latest messages as fit, dropping the oldest ones."""
+    remaining = budget - sum(token_count for message, token_count in system_messages)
+    kept = []
+    for message, token_count in reversed(history):
+        if token_count > remaining:
+            break
+        kept.append((message, token_count))
+        remaining -= token_count
+
+    if history and not kept:
+        return None
+    return system_messages + kept[::-1]
+
+def truncate_oldest(system_messages, history, budget, model=DEFAULT_MODEL):
+    """Like drop_oldest, but the newest message that no longer fits is cut down to the remaining budget instead of dropped."""
+    remaining = budget - sum(token_count for message, token_count in system_messages)
+    kept = []
+    for message, token_count in reversed(history):
+        if token_count > remaining:
+            content_budget = remaining - TOKENS_PER_MESSAGE
+            if content_budget > 0:
+                kept.append(truncate_message(message, content_budget, model))
+            break
+        kept.append((message, token_count))
+        remaining -= token_count
+
+    if history and not kept:
+        return None
+    return system_messages + kept[::-1]
+
+def truncate_message(message, content_budget, model=DEFAULT_MODEL):
+    """Keep the last content_budget tokens of the message content, counted with model's tokenizer."""
+    encoding = get_encoding(model)
+    tokens = encoding.encode(message['content'])[-content_budget:]
+    return {**message, 'content': encoding.decode(tokens)}, len(tokens) + TOKENS_PER_MESSAGE
+
+CONTEXT_STRATEGIES = {
+    'drop_oldest': drop_oldest,
+    'truncate_oldest': truncate_oldest,
+    'reject': reject,
+}
+
+def select_context_messages(template, history):
+    """Choose which (message, token_count) pairs of history to send for template's model.
+
+    The leading system messages (the system prompt and any conversation summary)
+    are always kept. The budget leaves room for the template's function schemas.
+    Returns the selected pairs, or None when the template's strategy cannot fit
+    the conversation in the budget.
+    """
+    pinned = 0
+    while pinned < len(history) and history[pinned][0]['role'] == 'system':
+        pinned += 1
+    system_messages = history[:pinned]
+    strategy = CONTEXT_STRATEGIES[template.context_strategy]
+    return strategy(system_messages, history[pinned:], get_prompt_budget(template.model) - template.function_token_count, template.model)
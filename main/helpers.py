@@ -1,62 +1,111 @@
 import openai
-from .models import ChatSession, ChatMessage, UserBalance, FunctionSchema
+from .models import ChatSession, ChatMessage
 from django.conf import settings
+from django.core.cache import cache
 import hashlib
-import tiktoken
+from . import history_cache
+from .turn_context import get_template_functions
+from .tokens import DEFAULT_MODEL, REPLY_PRIMING_TOKENS, num_tokens_from_message, num_tokens_from_string
+from .model_registry import get_model_spec
+from . import http_client, providers
 from decimal import Decimal
+from asgiref.sync import sync_to_async
+
+# openai keeps one session per thread; hand every thread the process's pooled one.
+openai.requestssession = http_client.get_session
 
 def get_model(session):
     return session.template.model
 
-def get_chat_completion(messages, username, session):
-    openai.api_key = settings.APIFORLLMDJANGO_OPENAI_KEY
-    model = get_model(session)
-    
+def get_completion_kwargs(messages, username, session):
+    kwargs = {
+        'model': get_model(session),
+        'messages': messages,
+        'user': hash_username(username),
+        'temperature': session.template.temperature,
+        'max_tokens': get_model_spec(get_model(session)).max_output_tokens,
+        # Task time limits are not enforced by the threads pool, so bound the request itself.
+        'request_timeout': settings.OPENAI_REQUEST_TIMEOUT,
+    }
+
     functions = get_functions_as_json(session)
     if functions:
-        chat_completion = openai.ChatCompletion.create(
-            model=model, 
-            messages=messages, 
-            user=hash_username(username),
-            temperature=session.template.temperature,
-            functions=functions
-        )
-    else:
-        chat_completion = openai.ChatCompletion.create(
-            model=model, 
-            messages=messages, 
-            user=hash_username(username),
-            temperature=session.template.temperature
-        )
+        kwargs['functions'] = functions
+    return kwargs
+
+def get_chat_completion(messages, username, session, provider=None):
+    provider = provider or providers.route(get_model(session))[0]
+    chat_completion = openai.ChatCompletion.create(**get_sync_completion_kwargs(messages, username, session, provider))
 
     costs = calculate_cost(chat_completion)
     return { 'chat_completion' : chat_completion, 'costs' : costs}
 
+def get_chat_completion_stream(messages, username, session, provider):
+    return openai.ChatCompletion.create(stream=True, **get_sync_completion_kwargs(messages, username, session, provider))
+
+def get_sync_completion_kwargs(messages, username, session, provider):
+    # requests takes separate connect and read timeouts; the aiohttp client only a total one.
+    return {
+        **get_completion_kwargs(messages, username, session),
+        **providers.get_request_kwargs(provider, get_model(session)),
+        'request_timeout': http_client.timeout(settings.OPENAI_REQUEST_TIMEOUT),
+    }
+
+async def aget_chat_completion_stream(messages, username, session, provider):
+    completion_kwargs = await sync_to_async(get_completion_kwargs)(messages, username, session)
+    return await openai.ChatCompletion.acreate(
+        stream=True,
+        **completion_kwargs,
+        **providers.get_request_kwargs(provider, completion_kwargs['model'])
+    )
+
 def calculate_cost(chat_completion):
     usage = chat_completion["usage"]
-    input_prompt_token_cost = 0.0015 / 1000  # cost per input token
-    output_completion_token_cost = 0.002 / 1000  # cost per output token
+    return calculate_cost_from_tokens(usage["prompt_tokens"], usage["completion_tokens"], chat_completion["model"])
 
-    input_tokens = usage["prompt_tokens"]
-    output_tokens = usage["completion_tokens"]
-    
-    input_cost = input_tokens * input_prompt_token_cost
-    output_cost = output_tokens * output_completion_token_cost
-
-    return {'input_cost' : input_cost, 'output_cost' : output_cost}
-
-def has_sufficient_balance(user, input_tokens, output_tokens=50):
-    input_prompt_token_cost = 0.0015 / 1000  # cost per input token
-    output_completion_token_cost = 0.002 / 1000  # cost per output token
+def calculate_cost_from_tokens(input_tokens, output_tokens, model=DEFAULT_MODEL):
+    spec = get_model_spec(model)
+    input_prompt_token_cost = spec.input_cost / 1000  # cost per input token
+    output_completion_token_cost = spec.output_cost / 1000  # cost per output token
 
     input_cost = input_tokens * input_prompt_token_cost
     output_cost = output_tokens * output_completion_token_cost
 
-    total_cost = input_cost + output_cost
-
-    user_balance, created = UserBalance.objects.get_or_create(user=user, defaults={'balance': Decimal('0.0')})
+    return {'input_cost' : input_cost, 'output_cost' : output_cost}
 
-    return user_balance.balance >= total_cost
+def estimate_cost(input_tokens, output_tokens=None, model=DEFAULT_MODEL):
+    """Estimate the cost of a completion, used to size the balance reservation before the call.
+
+    Without output_tokens the longest reply the model may give is assumed, so a hold
+    covers whatever the call costs; settling it gives back the unused part.
+    """
+    if output_tokens is None:
+        output_tokens = get_model_spec(model).max_output_tokens
+    costs = calculate_cost_from_tokens(input_tokens, output_tokens, model)
+    return Decimal(str(costs['input_cost'])) + Decimal(str(costs['output_cost']))
+
+def get_chat_history(session):
+    """Return the messages to build a prompt from, oldest first, as (message, token_count) pairs.
+
+    Reads go to the history cache first and fall back to the database. Once a
+    session has been summarized, the summary replaces the messages it covers.
+    """
+    history, version = history_cache.get_history(session)
+    if history is None:
+        history = load_chat_history(session)
+        if version is not None:
+            history_cache.store_history(session, version, history)
+
+    if session.summarized_until is not None:
+        history.insert(1, (session.summary_message(), session.summary_token_count))
+    return history
+
+def load_chat_history(session):
+    messages = ChatMessage.objects.filter(session=session).order_by('created_at').only('role', 'content', 'token_count', 'created_at')
+    if session.summarized_until is not None:
+        system_prompt = messages.first()
+        messages = [system_prompt] + list(messages.filter(created_at__gt=session.summarized_until))
+    return [(message.as_message(), message.token_count) for message in messages]
 
 def get_chat_messages(session_id):
     try:
@@ -64,74 +113,86 @@ def get_chat_messages(session_id):
     except ChatSession.DoesNotExist:
         return "ChatSession does not exist"
 
-    messages = ChatMessage.objects.filter(session=chat_session).order_by('created_at')
-
-    result = [
-        {
-            "role": message.role,
-            "content": message.content
-        }
-        for message in messages
-    ]
+    return [message for message, token_count in get_chat_history(chat_session)]
+
+def get_summary_completion(messages, username, model):
+    chat_completion = openai.ChatCompletion.create(
+        model=model,
+        messages=messages,
+        user=hash_username(username),
+        temperature=0,
+        # Bounds the summary to what summarize_session reserved for it.
+        max_tokens=get_model_spec(model).max_output_tokens,
+        request_timeout=http_client.timeout(settings.OPENAI_REQUEST_TIMEOUT),
+        **providers.get_request_kwargs(providers.route(model)[0], model)
+    )
 
-    return result
+    costs = calculate_cost(chat_completion)
+    return { 'chat_completion' : chat_completion, 'costs' : costs}
 
 def moderation_endpoint(input_text):
-    if not input_text:
-        return False
-    openai.api_key = settings.APIFORLLMDJANGO_OPENAI_KEY
-    response = openai.Moderation.create(
-        input=input_text
-    )
+    return moderate_texts([input_text])[0]
+
+def moderate_texts(input_texts):
+    """Return a flagged verdict for each text.
+
+    Verdicts are cached by content hash, and all uncached texts are sent to the
+    moderation endpoint together as one batched request.
+    """
+    keys = {text: moderation_cache_key(text) for text in input_texts if text}
+    verdicts = get_cached_verdicts(keys.values()) or {}
+
+    pending = [text for text, key in keys.items() if key not in verdicts]
+    if pending:
+        response = openai.Moderation.create(
+            input=pending,
+            api_key=settings.APIFORLLMDJANGO_OPENAI_KEY,
+            request_timeout=http_client.timeout(settings.OPENAI_REQUEST_TIMEOUT)
+        )
+        results = {keys[text]: result['flagged'] for text, result in zip(pending, response["results"])}
+        store_verdicts(results)
+        verdicts.update(results)
+
+    return [bool(text) and verdicts[keys[text]] for text in input_texts]
+
+@history_cache.fail_open()
+def get_cached_verdicts(keys):
+    return cache.get_many(keys)
+
+@history_cache.fail_open()
+def store_verdicts(verdicts):
+    cache.set_many(verdicts, timeout=settings.MODERATION_CACHE_TIMEOUT)
 
-    return response["results"][0]['flagged']
+def moderation_cache_key(input_text):
+    return 'moderation:' + hashlib.sha256(input_text.encode()).hexdigest()
 
 def hash_username(username):
     return hashlib.sha256(username.encode()).hexdigest()
 
-def num_tokens_from_messages(messages, model="gpt-3.5-turbo-16k-0613"):
+def num_tokens_from_messages(messages, model=DEFAULT_MODEL):
     """Return the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    
-    tokens_per_message = 3
-    tokens_per_name = 1
-    
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+    num_tokens = sum(num_tokens_from_message(message, model) for message in messages)
+    return num_tokens + REPLY_PRIMING_TOKENS
 
 def get_functions_as_json(session):
-    function_schemas = session.template.functions.all()
-    if function_schemas.exists():
-        return [function.schema for function in function_schemas]
-    else:
-        return []
+    return [function.schema for function in get_template_functions(session.template)]
     
-def can_execute_function(function_name, session):
-    if session is None:
+def can_execute_function(function_name, context):
+    if context is None:
         return False
     
-    function = session.template.functions.filter(name=function_name).first()
+    function = context.get_function(function_name)
     
     if function is None:
         return False
 
-    if session.function_server is None:
+    if context.function_server is None:
         return False
     
-    if not session.function_server.is_public and session.function_server.user != session.user:
+    if not context.function_server.is_public and context.function_server.user_id != context.user.id:
         return False
     
-    if not function.is_public and function.user != session.user:
+    if not function.is_public and function.user_id != context.user.id:
         return False
     
-    return True
\ No newline at end of file
+    return True
@@ -0,0 +1,74 @@
+import json
+import redis
+from django.conf import settings
+from functools import wraps
+from .redis_client import get_cache_redis
+
+def fail_open(default=None):
+    """Treat an unavailable cache as a miss instead of failing the caller."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                return func(*args, **kwargs)
+            except redis.RedisError:
+                return default
+        return wrapper
+    return decorator
+
+def session_key(session):
+    # The creation time guards against reading another session's entries when ids are reused, e.g. after a database reset.
+    return f'{session.id}:{session.created_at.timestamp()}'
+
+def history_key(session, version):
+    return f'chat_history:{session_key(session)}:{version}'
+
+def version_key(session):
+    return f'chat_history_version:{session_key(session)}'
+
+def get_version(session):
+    return int(get_cache_redis().get(version_key(session)) or 0)
+
+@fail_open(default=(None, None))
+def get_history(session):
+    """Return (history, version) for the session. history is None on a cache miss."""
+    client = get_cache_redis()
+    version = get_version(session)
+    key = history_key(session, version)
+    with client.pipeline() as pipe:
+        pipe.lrange(key, 0, -1)
+        pipe.expire(key, settings.HISTORY_CACHE_TIMEOUT)
+        entries, exists = pipe.execute()
+    if not exists:
+        return None, version
+    return [tuple(json.loads(entry)) for entry in entries], version
+
+@fail_open()
+def store_history(session, version, history):
+    """Cache history as loaded from the database at version.
+
+    If the version moved on while the rows were being loaded, the entries land
+    under a key nobody reads and simply expire.
+    """
+    key = history_key(session, version)
+    with get_cache_redis().pipeline() as pipe:
+        pipe.delete(key)
+        if history:
+            pipe.rpush(key, *[json.dumps(entry) for entry in history])
+            pipe.expire(key, settings.HISTORY_CACHE_TIMEOUT)
+        pipe.execute()
+
+@fail_open()
+def append_message(session, message, token_count):
+    """Append a newly written message to the cached history, if there is one."""
+    key = history_key(session, get_version(session))
+    if not get_cache_redis().rpushx(key, json.dumps((message, token_count))):
+        # A reader may be loading from the database right now without this message.
+        invalidate(session)
+
+@fail_open()
+def invalidate(session):
+    with get_cache_redis().pipeline() as pipe:
+        pipe.incr(version_key(session))
+        pipe.expire(version_key(session), settings.HISTORY_CACHE_TIMEOUT * 2)
+        pipe.execute()
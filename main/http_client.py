@@ -0,0 +1,80 @@
+import os
+import time
+from functools import lru_cache
+from urllib.parse import urlsplit
+import redis
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from .redis_client import get_cache_redis
+
+METRICS_TIMEOUT = 60 * 60 * 24 * 7
+
+class PooledSession(requests.Session):
+    """Session keeping connections to each host alive across calls, and recording per-host metrics."""
+
+    def __init__(self):
+        super().__init__()
+        adapter = HTTPAdapter(
+            pool_connections=settings.HTTP_POOL_HOSTS,
+            pool_maxsize=settings.HTTP_POOL_MAXSIZE,
+            max_retries=settings.HTTP_CONNECT_RETRIES,
+        )
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+    def send(self, request, **kwargs):
+        started = time.monotonic()
+        try:
+            response = super().send(request, **kwargs)
+        except requests.RequestException:
+            record(request.url, time.monotonic() - started, error=True)
+            raise
+        record(request.url, time.monotonic() - started, error=response.status_code == 429 or response.status_code >= 500)
+        return response
+
+    def close(self):
+        # The pools are shared by every thread of the process. openai closes its per-thread
+        # session every few minutes, which must not drop the other threads' connections.
+        pass
+
+@lru_cache(maxsize=None)
+def get_process_session(pid):
+    return PooledSession()
+
+def get_session():
+    """The process's pooled session; a forked worker gets its own instead of sharing the parent's sockets."""
+    return get_process_session(os.getpid())
+
+def timeout(read_timeout):
+    """(connect, read) timeout for a request whose response may take read_timeout seconds."""
+    return (settings.HTTP_CONNECT_TIMEOUT, read_timeout)
+
+def metrics_key(host):
+    return f'http_metrics:{host}'
+
+def record(url, seconds, error=False):
+    """Count a request to url's host, the seconds until its response headers arrived, and whether it failed."""
+    key = metrics_key(urlsplit(url).netloc)
+    try:
+        with get_cache_redis().pipeline(transaction=False) as pipe:
+            pipe.hincrby(key, 'requests', 1)
+            pipe.hincrby(key, 'errors', int(error))
+            pipe.hincrbyfloat(key, 'seconds', seconds)
+            pipe.expire(key, METRICS_TIMEOUT)
+            pipe.execute()
+    except redis.RedisError:
+        pass
+
+def get_metrics():
+    """Return {host: {'requests', 'errors', 'seconds'}} for the hosts called recently."""
+    client = get_cache_redis()
+    metrics = {}
+    for key in client.scan_iter(match=metrics_key('*')):
+        values = client.hgetall(key)
+        metrics[key.decode().split(':', 1)[1]] = {
+            'requests': int(values.get(b'requests', 0)),
+            'errors': int(values.get(b'errors', 0)),
+            'seconds': float(values.get(b'seconds', 0)),
+        }
+    return metrics
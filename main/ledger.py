@@ -0,0 +1,98 @@
+import time
+import uuid
+from decimal import Decimal
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from . import balance_cache
+from .models import UserBalance, BalanceLedgerEntry, LedgerEntryKind
+
+def pending_total(user_ref):
+    return Coalesce(
+        Subquery(
+            BalanceLedgerEntry.objects.filter(user=user_ref, flushed=False).values('user').annotate(total=Sum('amount')).values('total')
+        ),
+        Decimal('0.0'),
+    )
+
+def load_balance(user_id):
+    """Seed the cached balance from the settled balance plus the unflushed ledger entries."""
+    # Users who never had a balance get an empty one, whose later changes reach the cache.
+    UserBalance.objects.get_or_create(user_id=user_id, defaults={'balance': Decimal('0.0')})
+    # One statement, so a concurrent flush cannot be counted twice or missed.
+    balance, pending = UserBalance.objects.filter(user_id=user_id).annotate(pending=pending_total(OuterRef('user'))).values_list('balance', 'pending').get()
+    balance_cache.initialize(user_id, balance_cache.to_units(balance + pending))
+
+def with_cached_balance(operation, user_id, *args):
+    result = operation(user_id, *args)
+    if result == balance_cache.MISSING:
+        load_balance(user_id)
+        result = operation(user_id, *args)
+    return result
+
+def get_available_balance(user_id):
+    """Balance available for new turns: settled balance, minus unflushed charges and open holds."""
+    units = balance_cache.get(user_id)
+    if units is None:
+        load_balance(user_id)
+        units = balance_cache.get(user_id)
+    return balance_cache.from_units(units)
+
+class Reservation:
+    """An amount held from a user's cached balance while a turn is in flight."""
+
+    def __init__(self, user_id, hold_id, amount):
+        self.user_id = user_id
+        self.hold_id = hold_id
+        self.amount = amount
+
+    @classmethod
+    def reserve(cls, user, amount):
+        """Hold amount from the user's balance. Returns the reservation, or None if the balance is too low."""
+        hold_id = uuid.uuid4().hex
+        expires_at = time.time() + settings.BALANCE_RESERVATION_TIMEOUT
+        held = with_cached_balance(balance_cache.reserve, user.id, hold_id, balance_cache.to_units(amount), expires_at)
+        if held != 1:
+            return None
+        return cls(user.id, hold_id, amount)
+
+    def settle(self, actual_amount, chat_message=None):
+        """Charge actual_amount and give back whatever is left of the hold.
+
+        If the hold has already expired, the full actual_amount is charged.
+        """
+        BalanceLedgerEntry.objects.create(user_id=self.user_id, kind=LedgerEntryKind.CHARGE, amount=-actual_amount, chat_message=chat_message)
+        balance_cache.settle(self.user_id, self.hold_id, balance_cache.to_units(actual_amount))
+
+    def release(self):
+        balance_cache.settle(self.user_id, self.hold_id, 0)
+
+def charge(user, amount, chat_message=None):
+    """Charge amount if the balance covers it. Returns whether it was charged."""
+    charged = with_cached_balance(balance_cache.charge, user.id, balance_cache.to_units(amount))
+    if charged != 1:
+        return False
+    BalanceLedgerEntry.objects.create(user_id=user.id, kind=LedgerEntryKind.CHARGE, amount=-amount, chat_message=chat_message)
+    return True
+
+def expire_holds():
+    """Give back holds left behind by turns that died before settling them."""
+    for user_id, hold_id in balance_cache.expired_holds(time.time()):
+        balance_cache.settle(user_id, hold_id, 0)
+
+def flush(batch_size=1000):
+    """Apply a batch of unflushed ledger entries to UserBalance, one UPDATE per user. Returns the number of entries flushed."""
+    with transaction.atomic():
+        entries = list(
+            BalanceLedgerEntry.objects.select_for_update(skip_locked=True).filter(flushed=False).order_by('id').values_list('id', 'user_id', 'amount')[:batch_size]
+        )
+        totals = {}
+        for entry_id, user_id, amount in entries:
+            totals[user_id] = totals.get(user_id, Decimal('0.0')) + amount
+
+        for user_id, total in totals.items():
+            UserBalance.objects.filter(user_id=user_id).update(balance=F('balance') + total)
+        BalanceLedgerEntry.objects.filter(id__in=[entry_id for entry_id, user_id, amount in entries]).update(flushed=True)
+
+    return len(entries)
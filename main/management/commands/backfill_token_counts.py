@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from django.db.models import OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+from main.models import ChatMessage, ChatSession
+from main.tokens import num_tokens_from_message
+
+class Command(BaseCommand):
+    help = 'Compute token counts for chat messages and recompute the running token total of every chat session.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--all', action='store_true', help='Recount every message, not only those without a count.')
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        messages = ChatMessage.objects.only('id', 'role', 'content', 'token_count').order_by('id')
+        if not options['all']:
+            messages = messages.filter(token_count=0)
+
+        batch = []
+        updated = 0
+        for message in messages.iterator(chunk_size=batch_size):
+            message.token_count = num_tokens_from_message(message.as_message())
+            batch.append(message)
+            if len(batch) >= batch_size:
+                ChatMessage.objects.bulk_update(batch, ['token_count'])
+                updated += len(batch)
+                batch = []
+        if batch:
+            ChatMessage.objects.bulk_update(batch, ['token_count'])
+            updated += len(batch)
+
+        session_totals = ChatMessage.objects.filter(session=OuterRef('pk')).values('session').annotate(total=Sum('token_count')).values('total')
+        sessions = ChatSession.objects.update(token_count=Coalesce(Subquery(session_totals), 0))
+
+        self.stdout.write(self.style.SUCCESS(f'Updated token counts for {updated} messages and {sessions} sessions.'))
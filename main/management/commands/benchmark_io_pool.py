@@ -0,0 +1,99 @@
+import json
+import resource
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import requests
+from django.core.management.base import BaseCommand
+from django.db import connection
+from main.models import ChatSession
+from main.tasks import close_db_connections, release_db_connections
+
+GB = 1024 ** 3
+
+def current_rss():
+    """Resident memory of this process in bytes."""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def slow_handler(latency):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            time.sleep(latency)
+            body = json.dumps({'choices': [{'message': {'role': 'assistant', 'content': 'ok'}}]}).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+    return Handler
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+class Command(BaseCommand):
+    help = 'Estimate how many concurrent network-bound calls a threads pool worker holds per GB of memory, compared to prefork.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--calls', type=int, default=200, help='Concurrent calls to run.')
+        parser.add_argument('--latency', type=float, default=2.0, help='Seconds the fake LLM endpoint takes to answer.')
+
+    def handle(self, *args, **options):
+        calls = options['calls']
+        server = FakeLLMServer(('127.0.0.1', 0), slow_handler(options['latency']))
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        url = f'http://127.0.0.1:{server.server_address[1]}/v1/chat/completions'
+
+        # One process with Django loaded and nothing in flight: what every prefork child costs.
+        ChatSession.objects.exists()
+        requests.post(url, json={}, timeout=options['latency'] + 30)
+        connection.close()
+        process_rss = current_rss()
+
+        lock = threading.Lock()
+        state = {'in_flight': 0, 'peak_in_flight': 0, 'connections': 0, 'peak_connections': 0, 'peak_rss': process_rss}
+
+        def track(key, delta):
+            with lock:
+                state[key] += delta
+                state[f'peak_{key}'] = max(state[f'peak_{key}'], state[key])
+                state['peak_rss'] = max(state['peak_rss'], current_rss())
+
+        def call(index):
+            # The shape of openai_api_call: a few queries, a long HTTP wait, then more queries.
+            ChatSession.objects.exists()
+            track('connections', 1)
+            release_db_connections()
+            track('connections', -1)
+
+            track('in_flight', 1)
+            requests.post(url, json={'call': index}, timeout=options['latency'] + 30)
+            track('in_flight', -1)
+
+            ChatSession.objects.exists()
+            close_db_connections()
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=calls) as executor:
+            list(executor.map(call, range(calls)))
+        elapsed = time.monotonic() - started
+        server.shutdown()
+
+        threads_rss = state['peak_rss']
+        self.stdout.write(f"Calls: {calls} at {options['latency']}s latency, finished in {elapsed:.1f}s")
+        self.stdout.write(f"Peak calls in flight: {state['peak_in_flight']}")
+        self.stdout.write(f"Peak database connections open at once: {state['peak_connections']}")
+        self.stdout.write(f"Memory of one idle worker process: {process_rss / 1024 ** 2:.0f} MB")
+        self.stdout.write(f"Peak memory with {calls} calls on threads: {threads_rss / 1024 ** 2:.0f} MB")
+        self.stdout.write(self.style.SUCCESS(
+            f"Calls in flight per GB: threads {calls * GB / threads_rss:.0f}, prefork {GB / process_rss:.0f}"
+        ))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+from main import semantic_cache
+
+class Command(BaseCommand):
+    help = 'Delete the semantic cache indexes of a chat template, or of all templates.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--template', type=int, help='Id of the chat template whose indexes to delete.')
+
+    def handle(self, *args, **options):
+        cleared = semantic_cache.clear(options['template'])
+        self.stdout.write(self.style.SUCCESS(f'Deleted {cleared} indexes.'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from main.http_client import get_metrics, metrics_key
+from main.redis_client import get_cache_redis
+
+class Command(BaseCommand):
+    help = 'Show request counts, error rates and average response times of outbound HTTP calls per host.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Clear the metrics after showing them.')
+
+    def handle(self, *args, **options):
+        metrics = get_metrics()
+        for host, host_metrics in sorted(metrics.items()):
+            requests = host_metrics['requests']
+            self.stdout.write(
+                f"{host}: {requests} requests, {host_metrics['errors'] / requests:.1%} errors, "
+                f"{host_metrics['seconds'] / requests * 1000:.0f} ms average"
+            )
+
+        if options['reset'] and metrics:
+            get_cache_redis().delete(*[metrics_key(host) for host in metrics])
+        self.stdout.write(self.style.SUCCESS(f'{len(metrics)} hosts.'))
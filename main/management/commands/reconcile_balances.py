@@ -0,0 +1,35 @@
+from decimal import Decimal
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+from main.models import UserBalance, BalanceLedgerEntry
+from main import balance_cache
+
+class Command(BaseCommand):
+    help = 'Recompute every UserBalance from its flushed ledger entries and drop the cached balances.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true', help='Report mismatched balances without fixing them.')
+
+    def handle(self, *args, **options):
+        totals = dict(
+            BalanceLedgerEntry.objects.filter(flushed=True).values('user').annotate(total=Sum('amount')).values_list('user', 'total')
+        )
+
+        mismatched = 0
+        for user_balance in UserBalance.objects.select_related('user').order_by('id').iterator():
+            expected = totals.get(user_balance.user_id, Decimal('0.0'))
+            if user_balance.balance != expected:
+                mismatched += 1
+                self.stdout.write(f'{user_balance.user}: balance {user_balance.balance}, ledger {expected}')
+                if not options['dry_run']:
+                    with transaction.atomic():
+                        # Lock the row before summing, so a flush cannot land in between.
+                        UserBalance.objects.select_for_update().only('pk').get(pk=user_balance.pk)
+                        expected = BalanceLedgerEntry.objects.filter(user_id=user_balance.user_id, flushed=True).aggregate(total=Sum('amount'))['total'] or Decimal('0.0')
+                        UserBalance.objects.filter(pk=user_balance.pk).update(balance=expected)
+            if not options['dry_run']:
+                balance_cache.reset(user_balance.user_id)
+
+        action = 'Found' if options['dry_run'] else 'Fixed'
+        self.stdout.write(self.style.SUCCESS(f'{action} {mismatched} mismatched balances.'))
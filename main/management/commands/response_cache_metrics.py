@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from main.models import ChatTemplate
+from main.response_cache import get_metrics
+
+class Command(BaseCommand):
+    help = 'Show exact and semantic response cache hits and misses per chat template.'
+
+    def handle(self, *args, **options):
+        metrics = get_metrics()
+        names = dict(ChatTemplate.objects.filter(id__in=metrics).values_list('id', 'name'))
+        for template_id, template_metrics in sorted(metrics.items()):
+            parts = []
+            for prefix, label in (('', 'exact'), ('semantic_', 'semantic')):
+                hits = template_metrics.get(f'{prefix}hits', 0)
+                lookups = hits + template_metrics.get(f'{prefix}misses', 0)
+                if lookups:
+                    parts.append(f'{label} {hits}/{lookups} hits ({hits / lookups:.1%})')
+            self.stdout.write(f"{names.get(template_id, template_id)}: {', '.join(parts)}")
+        self.stdout.write(self.style.SUCCESS(f'{len(metrics)} templates.'))
@@ -0,0 +1,23 @@
+# Generated by Django 4.2.2 on 2026-10-18 11:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0022_remove_functionserver_api_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chatmessage',
+            name='token_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='chatsession',
+            name='token_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+    ]
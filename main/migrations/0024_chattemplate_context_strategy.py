@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-18 11:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0023_chatmessage_token_count_chatsession_token_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chattemplate',
+            name='context_strategy',
+            field=models.CharField(choices=[('drop_oldest', 'Drop oldest messages'), ('truncate_oldest', 'Truncate oldest messages'), ('reject', 'Reject when over the limit')], default='drop_oldest', max_length=32),
+        ),
+    ]
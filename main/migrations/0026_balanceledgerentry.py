@@ -0,0 +1,39 @@
+# Generated by Django 4.2.2 on 2026-10-18 11:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def open_ledgers(apps, schema_editor):
+    UserBalance = apps.get_model('main', 'UserBalance')
+    BalanceLedgerEntry = apps.get_model('main', 'BalanceLedgerEntry')
+
+    BalanceLedgerEntry.objects.bulk_create(
+        BalanceLedgerEntry(user_id=user_balance.user_id, kind='opening', amount=user_balance.balance, flushed=True)
+        for user_balance in UserBalance.objects.all()
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('main', '0025_chatsession_summary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BalanceLedgerEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(choices=[('opening', 'Opening balance'), ('charge', 'Charge'), ('credit', 'Credit'), ('adjustment', 'Adjustment')], max_length=16)),
+                ('amount', models.DecimalField(decimal_places=9, max_digits=16)),
+                ('flushed', models.BooleanField(db_index=True, default=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('chat_message', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='main.chatmessage')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(open_ledgers, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0026_balanceledgerentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chattemplate',
+            name='cache_responses',
+            field=models.BooleanField(default=False),
+        ),
+    ]
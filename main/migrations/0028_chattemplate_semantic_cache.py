@@ -0,0 +1,18 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0027_chattemplate_cache_responses'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chattemplate',
+            name='semantic_cache',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:45
+
+from django.db import migrations, models
+from main.tokens import num_tokens_from_functions
+
+
+def count_function_tokens(apps, schema_editor):
+    ChatTemplate = apps.get_model('main', 'ChatTemplate')
+    for template in ChatTemplate.objects.all():
+        schemas = list(template.functions.order_by('id').values_list('schema', flat=True))
+        template.function_token_count = num_tokens_from_functions(schemas, template.model)
+        template.save(update_fields=['function_token_count'])
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('main', '0028_chattemplate_semantic_cache'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='chattemplate',
+            name='function_token_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(count_function_tokens, migrations.RunPython.noop),
+    ]
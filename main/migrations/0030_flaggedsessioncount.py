@@ -0,0 +1,33 @@
+# Generated by Django 4.2.2 on 2026-10-18 12:50
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models import Count
+
+
+def count_flagged_sessions(apps, schema_editor):
+    ChatSession = apps.get_model('main', 'ChatSession')
+    FlaggedSessionCount = apps.get_model('main', 'FlaggedSessionCount')
+    FlaggedSessionCount.objects.bulk_create(
+        FlaggedSessionCount(user_id=user_id, count=count)
+        for user_id, count in ChatSession.objects.filter(flagged=True).values('user').annotate(count=Count('id')).values_list('user', 'count')
+    )
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('main', '0029_chattemplate_function_token_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FlaggedSessionCount',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.RunPython(count_flagged_sessions, migrations.RunPython.noop),
+    ]
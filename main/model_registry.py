@@ -0,0 +1,43 @@
+from collections import namedtuple
+from functools import lru_cache
+from django.conf import settings
+
+ModelSpec = namedtuple('ModelSpec', ['input_cost', 'output_cost', 'context_window', 'max_output_tokens', 'tokenizer'])
+ModelSpec.__doc__ = """Pricing and limits of a chat model. Costs are in dollars per 1000 tokens.
+
+max_output_tokens caps every reply of the model. It is also kept free of prompt in
+the context window, and it sizes the balance hold taken before each call.
+"""
+
+DEFAULT_MODEL_SPEC = ModelSpec(
+    input_cost=0.0015,
+    output_cost=0.002,
+    context_window=16000,
+    max_output_tokens=1000,
+    tokenizer='cl100k_base',
+)
+
+# Keyed by model name prefix; dated snapshots such as gpt-4-0613 match their family.
+MODEL_SPECS = {
+    'gpt-3.5-turbo-16k': ModelSpec(0.003, 0.004, 16385, 1000, 'cl100k_base'),
+    'gpt-3.5-turbo': ModelSpec(0.0015, 0.002, 4097, 1000, 'cl100k_base'),
+    'gpt-4-32k': ModelSpec(0.06, 0.12, 32768, 1000, 'cl100k_base'),
+    'gpt-4': ModelSpec(0.03, 0.06, 8192, 1000, 'cl100k_base'),
+}
+
+@lru_cache(maxsize=None)
+def get_registry():
+    """Return the model specs, with settings.MODEL_SPECS overriding or extending the built-in ones."""
+    registry = dict(MODEL_SPECS)
+    for name, spec in settings.MODEL_SPECS.items():
+        registry[name] = registry.get(name, DEFAULT_MODEL_SPEC)._replace(**spec)
+    return registry
+
+@lru_cache(maxsize=None)
+def get_model_spec(model):
+    """Return the spec of model, matching the longest known model name prefix."""
+    registry = get_registry()
+    for name in sorted(registry, key=len, reverse=True):
+        if model.startswith(name):
+            return registry[name]
+    return DEFAULT_MODEL_SPEC
@@ -1,12 +1,15 @@
-from django.db import models
+from django.db import models, transaction
 from django.contrib.auth.models import User
 from decimal import Decimal
 from django.utils import timezone
 from cryptography.fernet import Fernet
 import base64
 from django.conf import settings
-from django.db.models.signals import post_save
+from django.db.models import F
+from django.db.models.signals import post_save, post_delete, pre_delete, m2m_changed
 from django.dispatch import receiver
+from .tokens import num_tokens_from_message, num_tokens_from_functions
+from . import history_cache, balance_cache, session_events
 
 class SecretKey(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
@@ -40,20 +43,45 @@ class FunctionSchema(models.Model):
     def __str__(self):
         return self.name
 
+class ContextStrategyChoices(models.TextChoices):
+    DROP_OLDEST = 'drop_oldest', 'Drop oldest messages'
+    TRUNCATE_OLDEST = 'truncate_oldest', 'Truncate oldest messages'
+    REJECT = 'reject', 'Reject when over the limit'
+
 class ChatTemplate(models.Model):
     name = models.CharField(max_length=64)
     model = models.CharField(max_length=64)
     temperature = models.FloatField()
     functions = models.ManyToManyField(FunctionSchema, blank=True)
     system_prompt = models.CharField(max_length=10000)
+    context_strategy = models.CharField(max_length=32, choices=ContextStrategyChoices.choices, default=ContextStrategyChoices.DROP_OLDEST)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     is_public = models.BooleanField(default=False)
+    # Reuse replies to identical requests; only applies at temperature 0.
+    cache_responses = models.BooleanField(default=False)
+    # Reuse first-turn replies to prompts that mean the same; needs the optional embedding packages.
+    semantic_cache = models.BooleanField(default=False)
+    # Tokens the function schemas add to every prompt, kept up to date by the signals below.
+    function_token_count = models.PositiveIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.name
 
+    def count_function_tokens(self, removed=None):
+        """Count the tokens of the template's function schemas, leaving out the schema removed."""
+        functions = self.functions.order_by('id')
+        if removed is not None:
+            functions = functions.exclude(pk=removed.pk)
+        return num_tokens_from_functions(list(functions.values_list('schema', flat=True)), self.model)
+
+    def save(self, *args, **kwargs):
+        # The count depends on the model's tokenizer; a new template has no functions yet.
+        if not self._state.adding:
+            self.function_token_count = self.count_function_tokens()
+        super().save(*args, **kwargs)
+
 class FunctionServer(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE, null=True, blank=True)
     name = models.CharField(max_length=200)
@@ -73,12 +101,60 @@ class ChatSession(models.Model):
     flagged = models.BooleanField(default=False)
     function_approval_required = models.BooleanField(default=True)
     function_server = models.ForeignKey(FunctionServer, on_delete=models.SET_NULL, null=True, blank=True)
+    token_count = models.PositiveIntegerField(default=0, editable=False)
+    summary = models.TextField(blank=True, default='')
+    summary_token_count = models.PositiveIntegerField(default=0, editable=False)
+    summarized_token_count = models.PositiveIntegerField(default=0, editable=False)
+    summarized_until = models.DateTimeField(null=True, blank=True, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.title
 
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            update_fields = kwargs.get('update_fields')
+            if self._state.adding:
+                changed = self.flagged
+            elif update_fields is not None and 'flagged' not in update_fields:
+                # A partial save of other fields must not write a stale flag back.
+                changed = False
+            else:
+                # Claim the change of flag with a conditional UPDATE, so concurrent saves count it once.
+                changed = ChatSession.objects.filter(pk=self.pk, flagged=not self.flagged).update(flagged=self.flagged) == 1
+            super().save(*args, **kwargs)
+            if changed:
+                flagged_count = FlaggedSessionCount.adjust(self.user_id, 1 if self.flagged else -1)
+                if self.flagged:
+                    transaction.on_commit(lambda: session_events.send_flagged(self.user_id, self.id, flagged_count))
+
+    def summary_message(self):
+        return {'role': 'system', 'content': f'Summary of the earlier conversation: {self.summary}'}
+
+class FlaggedSessionCount(models.Model):
+    """Number of a user's flagged chat sessions, kept up to date by ChatSession.save and deletes."""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True)
+    count = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def get(cls, user_id):
+        return cls.objects.filter(user_id=user_id).values_list('count', flat=True).first() or 0
+
+    @classmethod
+    def adjust(cls, user_id, delta):
+        """Add delta to the user's count and return the new count."""
+        if delta > 0:
+            cls.objects.get_or_create(user_id=user_id)
+        cls.objects.filter(user_id=user_id, count__gte=-delta).update(count=F('count') + delta)
+        return cls.get(user_id)
+
+@receiver(post_delete, sender=ChatSession)
+def remove_flagged_session(sender, instance, origin=None, **kwargs):
+    origin_model = origin.model if isinstance(origin, models.QuerySet) else type(origin)
+    if instance.flagged and origin_model is not User:
+        FlaggedSessionCount.adjust(instance.user_id, -1)
+
 class RoleChoices(models.TextChoices):
     SYSTEM = 'system',
     USER = 'user',
@@ -91,12 +167,38 @@ class ChatMessage(models.Model):
     content = models.CharField(max_length=40000)
     input_cost = models.DecimalField(max_digits=10, decimal_places=9, default=Decimal('0.0'))
     output_cost = models.DecimalField(max_digits=10, decimal_places=9, default=Decimal('0.0'))
+    token_count = models.PositiveIntegerField(default=0, editable=False)
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return self.content
 
+    def as_message(self):
+        return {'role': self.role, 'content': self.content}
+
+    def save(self, *args, **kwargs):
+        previous_token_count = 0 if self._state.adding else self.token_count
+        self.token_count = num_tokens_from_message(self.as_message(), self.session.template.model)
+        super().save(*args, **kwargs)
+        if self.token_count != previous_token_count:
+            ChatSession.objects.filter(pk=self.session_id).update(token_count=F('token_count') + self.token_count - previous_token_count)
+
+    @receiver(post_delete, sender='main.ChatMessage')
+    def remove_session_tokens(sender, instance, origin=None, **kwargs):
+        origin_model = origin.model if isinstance(origin, models.QuerySet) else type(origin)
+        if origin_model is not ChatMessage:
+            return  # a cascade from the session, its user or its template: the whole session is going away
+        ChatSession.objects.filter(pk=instance.session_id).update(token_count=F('token_count') - instance.token_count)
+        transaction.on_commit(lambda: history_cache.invalidate(instance.session))
+
+    @receiver(post_save, sender='main.ChatMessage')
+    def update_history_cache(sender, instance, created, **kwargs):
+        if created:
+            transaction.on_commit(lambda: history_cache.append_message(instance.session, instance.as_message(), instance.token_count))
+        else:
+            transaction.on_commit(lambda: history_cache.invalidate(instance.session))
+
     @receiver(post_save, sender=ChatSession)
     def create_initial_message(sender, instance, created, **kwargs):
         if created:  # if a new instance of ChatSession is created
@@ -109,24 +211,128 @@ class ChatMessage(models.Model):
             )
 
 class UserBalance(models.Model):
+    """Settled balance of a user.
+
+    Turn charges are recorded as unflushed BalanceLedgerEntry rows and only
+    reach this row when flush_balance_ledger runs; the live balance is kept in
+    Redis by main.ledger. The balance always equals the sum of the user's
+    flushed ledger entries.
+    """
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     balance = models.DecimalField(max_digits=16, decimal_places=9, default=Decimal('0.0')) 
     last_credit = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
 
+    def save(self, *args, **kwargs):
+        with transaction.atomic():
+            if self._state.adding:
+                super().save(*args, **kwargs)
+                BalanceLedgerEntry.objects.create(user_id=self.user_id, kind=LedgerEntryKind.OPENING, amount=self.balance, flushed=True)
+                return
+
+            previous_balance = UserBalance.objects.select_for_update().values_list('balance', flat=True).get(pk=self.pk)
+            super().save(*args, **kwargs)
+            if self.balance != previous_balance:
+                self.record(LedgerEntryKind.ADJUSTMENT, self.balance - previous_balance)
+
+    def record(self, kind, amount):
+        """Record a change already applied to this row and mirror it to the cached balance."""
+        BalanceLedgerEntry.objects.create(user_id=self.user_id, kind=kind, amount=amount, flushed=True)
+        transaction.on_commit(lambda: balance_cache.adjust(self.user_id, balance_cache.to_units(amount)))
+
     def debit(self, amount):
-        if self.balance > 0 and self.balance - amount >= Decimal('0.0'):
-            self.balance -= amount
-            self.save()
-        else:
-            raise ValueError("Insufficient balance")
+        with transaction.atomic():
+            # Conditional UPDATE so concurrent debits cannot overdraw the balance.
+            debited = UserBalance.objects.filter(pk=self.pk, balance__gt=0, balance__gte=amount).update(balance=F('balance') - amount, updated_at=timezone.now())
+            if not debited:
+                raise ValueError("Insufficient balance")
+            self.record(LedgerEntryKind.CHARGE, -amount)
+        self.refresh_from_db(fields=['balance', 'updated_at'])
 
     def credit(self, amount):
-        self.balance += amount
-        self.last_credit = timezone.now()
-        self.save()
+        now = timezone.now()
+        with transaction.atomic():
+            UserBalance.objects.filter(pk=self.pk).update(balance=F('balance') + amount, last_credit=now, updated_at=now)
+            self.record(LedgerEntryKind.CREDIT, amount)
+        self.refresh_from_db(fields=['balance', 'last_credit', 'updated_at'])
 
     def reset_balance(self, amount=Decimal('0.0')):
         self.balance = amount
         self.last_credit = timezone.now()
-        self.save()
\ No newline at end of file
+        self.save()
+
+class LedgerEntryKind(models.TextChoices):
+    OPENING = 'opening', 'Opening balance'
+    CHARGE = 'charge', 'Charge'
+    CREDIT = 'credit', 'Credit'
+    ADJUSTMENT = 'adjustment', 'Adjustment'
+
+class BalanceLedgerEntry(models.Model):
+    """One change to a user's balance: negative for charges, positive for credits."""
+    user = models.ForeignKey(User, on_delete=models.CASCADE)
+    kind = models.CharField(max_length=16, choices=LedgerEntryKind.choices)
+    amount = models.DecimalField(max_digits=16, decimal_places=9)
+    chat_message = models.ForeignKey(ChatMessage, on_delete=models.SET_NULL, null=True, blank=True)
+    flushed = models.BooleanField(default=False, db_index=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f'{self.get_kind_display()} of {self.amount} for {self.user}'
+
+# Anything that changes what a template's functions look like bumps the
+# template's updated_at, which invalidates the per-process function cache in
+# main.turn_context in every worker. Changes to the schemas themselves also
+# recount the tokens they add to the template's prompts.
+
+def touch_templates(templates):
+    templates.update(updated_at=timezone.now())
+
+def recount_function_tokens(templates, removed=None):
+    """Store the function token counts of templates, leaving out the schema removed."""
+    for template in list(templates):
+        ChatTemplate.objects.filter(pk=template.pk).update(function_token_count=template.count_function_tokens(removed))
+
+@receiver(m2m_changed, sender=ChatTemplate.functions.through)
+def template_functions_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if not reverse:
+        templates = ChatTemplate.objects.filter(pk=instance.pk)
+        if action == 'pre_clear':
+            templates.update(function_token_count=0)
+        else:
+            recount_function_tokens(templates)
+    elif action == 'pre_clear':
+        # The schema is still attached before a clear, so count as if it were gone.
+        templates = ChatTemplate.objects.filter(functions=instance)
+        recount_function_tokens(templates, removed=instance)
+    else:
+        templates = ChatTemplate.objects.filter(pk__in=pk_set)
+        recount_function_tokens(templates)
+    touch_templates(templates)
+
+@receiver(m2m_changed, sender=FunctionSchema.secrets.through)
+def function_secrets_changed(sender, instance, action, reverse, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+    if reverse:
+        touch_templates(ChatTemplate.objects.filter(functions__secrets=instance))
+    else:
+        touch_templates(ChatTemplate.objects.filter(functions=instance))
+
+@receiver(post_save, sender=FunctionSchema)
+def function_schema_changed(sender, instance, **kwargs):
+    templates = ChatTemplate.objects.filter(functions=instance)
+    recount_function_tokens(templates)
+    touch_templates(templates)
+
+@receiver(pre_delete, sender=FunctionSchema)
+def function_schema_deleted(sender, instance, **kwargs):
+    templates = ChatTemplate.objects.filter(functions=instance)
+    recount_function_tokens(templates, removed=instance)
+    touch_templates(templates)
+
+@receiver(post_save, sender=SecretKey)
+@receiver(pre_delete, sender=SecretKey)
+def secret_key_changed(sender, instance, **kwargs):
+    touch_templates(ChatTemplate.objects.filter(functions__secrets=instance))
@@ -0,0 +1,148 @@
+import random
+import time
+from collections import namedtuple
+from functools import lru_cache
+import openai
+import redis
+from django.conf import settings
+from base.helpers import get_secret
+from .redis_client import get_redis
+from . import upstream_limit
+
+Provider = namedtuple('Provider', ['name', 'api_type', 'api_base', 'api_key', 'api_version', 'models', 'deployments', 'concurrency'])
+Provider.__doc__ = """An endpoint serving chat completions through the OpenAI API.
+
+api_type is 'open_ai' for OpenAI and OpenAI-compatible servers, or 'azure'. models
+lists the model name prefixes it serves, all models when empty. Azure deployments
+are looked up by model name in deployments.
+"""
+
+# A success resets the failure count; a failure sets nothing else, so a provider that
+# keeps failing is benched for ARGV[4] seconds every ARGV[3] failures in a row. The
+# last ARGV[6] times to first response are kept for percentiles.
+RECORD = """
+if ARGV[2] == '' then
+    if redis.call('HINCRBY', KEYS[1], 'failures', 1) >= tonumber(ARGV[3]) then
+        redis.call('HSET', KEYS[1], 'failures', 0, 'down_until', tonumber(ARGV[1]) + tonumber(ARGV[4]))
+    end
+else
+    local latency = tonumber(ARGV[2])
+    local average = tonumber(redis.call('HGET', KEYS[1], 'latency'))
+    average = average and average + 0.2 * (latency - average) or latency
+    redis.call('HSET', KEYS[1], 'failures', 0, 'latency', average)
+    redis.call('LPUSH', KEYS[2], latency)
+    redis.call('LTRIM', KEYS[2], 0, tonumber(ARGV[6]) - 1)
+    redis.call('EXPIRE', KEYS[2], ARGV[5])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return 1
+"""
+
+# Health of providers that have not been called for this long is forgotten.
+HEALTH_TIMEOUT = 60 * 60
+LATENCY_SAMPLES = 200
+
+def health_key(provider, model):
+    return f'provider_health:{provider.name}:{model}'
+
+def latencies_key(provider, model):
+    return f'provider_latencies:{provider.name}:{model}'
+
+@lru_cache(maxsize=None)
+def get_script(source):
+    return get_redis().register_script(source)
+
+@lru_cache(maxsize=None)
+def get_providers():
+    """Return the providers by name: OpenAI, overridden or joined by those in settings.LLM_PROVIDERS."""
+    providers = {
+        'openai': Provider('openai', 'open_ai', None, settings.APIFORLLMDJANGO_OPENAI_KEY, None, [], {}, {}),
+    }
+    for config in settings.LLM_PROVIDERS:
+        providers[config['name']] = Provider(
+            name=config['name'],
+            api_type=config.get('api_type', 'open_ai'),
+            api_base=config.get('api_base'),
+            api_key=get_secret(config['api_key_secret']) if config.get('api_key_secret') else 'none',
+            api_version=config.get('api_version'),
+            models=config.get('models', []),
+            deployments=config.get('deployments', {}),
+            concurrency=config.get('concurrency', {}),
+        )
+    return providers
+
+def get_candidates(model):
+    return [provider for provider in get_providers().values() if not provider.models or any(model.startswith(prefix) for prefix in provider.models)]
+
+def route(model):
+    """Return the providers serving model, in the order to try them.
+
+    Providers benched after repeated failures go last. The others are shuffled with
+    weights inversely proportional to their average time to first response, so faster
+    providers take most of the load without starving the rest of fresh measurements.
+    """
+    candidates = get_candidates(model)
+    try:
+        with get_redis().pipeline(transaction=False) as pipe:
+            for provider in candidates:
+                pipe.hmget(health_key(provider, model), 'latency', 'down_until')
+            health = pipe.execute()
+    except redis.RedisError:
+        return candidates
+
+    now = time.time()
+    up, down = [], []
+    for provider, (latency, down_until) in zip(candidates, health):
+        if down_until is not None and float(down_until) > now:
+            down.append(provider)
+        else:
+            up.append((provider, float(latency) if latency is not None else None))
+
+    # Providers without measurements are weighted like the fastest one, so they get tried.
+    known = [latency for provider, latency in up if latency is not None]
+    default_latency = min(known) if known else 1.0
+    ordered = []
+    while up:
+        weights = [1 / max(latency if latency is not None else default_latency, 0.001) for provider, latency in up]
+        index = random.choices(range(len(up)), weights=weights)[0]
+        ordered.append(up.pop(index)[0])
+    return ordered + down
+
+def record(provider, model, latency=None):
+    """Record a call of model on provider: its time to first response, or None when it failed."""
+    try:
+        get_script(RECORD)(
+            keys=[health_key(provider, model), latencies_key(provider, model)],
+            args=[time.time(), '' if latency is None else latency, settings.PROVIDER_FAILURE_THRESHOLD, settings.PROVIDER_COOLDOWN, HEALTH_TIMEOUT, LATENCY_SAMPLES],
+        )
+    except redis.RedisError:
+        pass
+
+def get_latency_percentile(provider, model, percentile, min_samples):
+    """Return the percentile of provider's recent times to first response for model, or None with fewer than min_samples."""
+    try:
+        latencies = sorted(float(latency) for latency in get_redis().lrange(latencies_key(provider, model), 0, -1))
+    except redis.RedisError:
+        return None
+    if len(latencies) < min_samples:
+        return None
+    return latencies[min(len(latencies) - 1, int(len(latencies) * percentile / 100))]
+
+def acquire(provider, model):
+    """Take a slot under provider's own adaptive concurrency limit for model."""
+    return upstream_limit.acquire(f'{provider.name}:{model}', {**settings.UPSTREAM_CONCURRENCY, **provider.concurrency})
+
+def is_failure(error):
+    """Whether error is the provider's fault, so the call should go to another provider."""
+    return upstream_limit.is_overload(error) or isinstance(error, (openai.error.APIConnectionError, openai.error.AuthenticationError))
+
+def get_request_kwargs(provider, model):
+    """openai.ChatCompletion.create arguments sending a request for model to provider."""
+    kwargs = {'api_key': provider.api_key, 'api_type': provider.api_type}
+    if provider.api_base:
+        kwargs['api_base'] = provider.api_base
+    if provider.api_version:
+        kwargs['api_version'] = provider.api_version
+    if provider.api_type == 'azure':
+        kwargs['deployment_id'] = provider.deployments.get(model, model)
+    return kwargs
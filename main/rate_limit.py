@@ -0,0 +1,91 @@
+import time
+from functools import lru_cache
+import redis
+from django.conf import settings
+from .redis_client import get_redis
+
+# Requests and tokens refill continuously over a minute, up to a full minute's allowance.
+# Tokens are charged after the turn, so a large reply can take the bucket below zero,
+# which blocks the user until it has refilled.
+ADMIT = """
+local now = tonumber(ARGV[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', now)
+if redis.call('ZCARD', KEYS[2]) >= tonumber(ARGV[4]) then return 'in_flight' end
+
+local rpm = tonumber(ARGV[2])
+local tpm = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'requests', 'tokens', 'updated_at')
+local requests = rpm
+local tokens = tpm
+if bucket[3] then
+    local refill = (now - tonumber(bucket[3])) / 60
+    requests = math.min(rpm, tonumber(bucket[1]) + refill * rpm)
+    tokens = math.min(tpm, tonumber(bucket[2]) + refill * tpm)
+end
+
+if requests < 1 then return 'requests' end
+if tokens <= 0 then return 'tokens' end
+
+redis.call('HSET', KEYS[1], 'requests', requests - 1, 'tokens', tokens, 'updated_at', now)
+redis.call('EXPIRE', KEYS[1], ARGV[7])
+redis.call('ZADD', KEYS[2], ARGV[6], ARGV[5])
+redis.call('EXPIRE', KEYS[2], ARGV[7])
+return 'ok'
+"""
+
+RELEASE = """
+if ARGV[1] ~= '' then
+    redis.call('ZREM', KEYS[2], ARGV[1])
+end
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('HINCRBYFLOAT', KEYS[1], 'tokens', -tonumber(ARGV[2]))
+end
+return 1
+"""
+
+# Buckets idle this long have refilled and are dropped.
+BUCKET_TIMEOUT = 60 * 60
+
+def bucket_key(user_id):
+    return f'rate_limit:{user_id}'
+
+def in_flight_key(user_id):
+    return f'turns_in_flight:{user_id}'
+
+@lru_cache(maxsize=None)
+def get_script(source):
+    return get_redis().register_script(source)
+
+def get_user_tier(user):
+    """Return the first tier in settings.USER_TIERS that user is a member of, or the default tier."""
+    groups = set(user.groups.values_list('name', flat=True))
+    for name, tier in settings.USER_TIERS.items():
+        if name in groups:
+            return tier
+    return settings.USER_TIERS['default']
+
+def admit(user_id, turn_id, limits):
+    """Take a request from the user's bucket and an in-flight slot for turn_id.
+
+    Returns None when the turn may run, or the reason it may not: 'requests', 'tokens'
+    or 'in_flight'. The slot must be given back with release(). If Redis is unavailable
+    the turn is let through.
+    """
+    now = time.time()
+    try:
+        result = get_script(ADMIT)(
+            keys=[bucket_key(user_id), in_flight_key(user_id)],
+            args=[now, limits['requests_per_minute'], limits['tokens_per_minute'], limits['max_in_flight'], turn_id, now + settings.RATE_LIMIT_TURN_TIMEOUT, BUCKET_TIMEOUT],
+        )
+    except redis.RedisError:
+        return None
+
+    result = result.decode()
+    return None if result == 'ok' else result
+
+def release(user_id, turn_id, tokens):
+    """Give back the in-flight slot of turn_id (if any) and charge the tokens the turn used."""
+    try:
+        get_script(RELEASE)(keys=[bucket_key(user_id), in_flight_key(user_id)], args=[turn_id or '', tokens])
+    except redis.RedisError:
+        pass
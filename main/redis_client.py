@@ -0,0 +1,15 @@
+import redis
+from django.conf import settings
+from functools import lru_cache
+
+@lru_cache(maxsize=None)
+def get_client(url):
+    return redis.Redis.from_url(url)
+
+def get_redis():
+    """Client for state that must not be evicted (locks, counters, balances)."""
+    return get_client(settings.REDIS_URL)
+
+def get_cache_redis():
+    """Client for the LRU-evicted cache instance."""
+    return get_client(settings.CACHE_REDIS_URL)
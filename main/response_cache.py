@@ -0,0 +1,43 @@
+import hashlib
+import json
+from django.conf import settings
+from .history_cache import fail_open
+from .redis_client import get_cache_redis
+
+# Entries live on the LRU-evicted cache instance, so its maxmemory bounds their total size.
+METRICS_KEY = 'response_cache_metrics'
+
+def is_cacheable(template):
+    """Replies are only reused for templates that opted in and are deterministic."""
+    return template.cache_responses and template.temperature == 0
+
+def get_key(template, messages, functions):
+    """Hash of everything the reply depends on, independent of dict key order."""
+    request = {'model': template.model, 'temperature': float(template.temperature), 'functions': functions, 'messages': messages}
+    digest = hashlib.sha256(json.dumps(request, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+    return f'response_cache:{digest}'
+
+@fail_open()
+def get(template, key):
+    """Return the cached reply stored under key, counting a hit or miss for template."""
+    entry = get_cache_redis().get(key)
+    count(template, 'hits' if entry is not None else 'misses')
+    if entry is None:
+        return None
+    return json.loads(entry)
+
+def count(template, kind):
+    get_cache_redis().hincrby(METRICS_KEY, f'{template.id}:{kind}', 1)
+
+@fail_open()
+def store(key, reply):
+    entry = {field: reply[field] for field in ('role', 'content', 'function_call', 'output_tokens')}
+    get_cache_redis().set(key, json.dumps(entry), ex=settings.RESPONSE_CACHE_TIMEOUT)
+
+def get_metrics():
+    """Return {template_id: {'hits', 'misses'}}, with 'semantic_hits' and 'semantic_misses' for semantically cached templates."""
+    metrics = {}
+    for field, count in get_cache_redis().hgetall(METRICS_KEY).items():
+        template_id, kind = field.decode().split(':')
+        metrics.setdefault(int(template_id), {'hits': 0, 'misses': 0})[kind] = int(count)
+    return metrics
@@ -1,8 +1,11 @@
 from django.urls import re_path
+from django.conf import settings
 
 from . import consumers
 
+chat_consumer = consumers.AsyncChatConsumer if settings.ASYNC_CHAT_CONSUMER else consumers.ChatConsumer
+
 websocket_urlpatterns = [
-    re_path(r"ws/chat/(?P<session_id>\d+)/$", consumers.ChatConsumer.as_asgi()),
+    re_path(r"ws/chat/(?P<session_id>\d+)/$", chat_consumer.as_asgi()),
     re_path(r'wsapi/sendresult/(?P<session_id>\d+)$', consumers.FunctionResultConsumer.as_asgi()),
 ]
\ No newline at end of file
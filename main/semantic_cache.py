@@ -0,0 +1,114 @@
+import json
+import os
+from functools import lru_cache
+from django.conf import settings
+from .history_cache import fail_open
+from .redis_client import get_redis, get_cache_redis
+from . import response_cache
+
+# numpy and sentence-transformers are optional; without them the semantic cache is off.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    from sentence_transformers import SentenceTransformer
+except ImportError:
+    SentenceTransformer = None
+
+# Each template's prompt embeddings are rows of a fixed-size float32 file, memory-mapped by
+# every worker so they all share one copy in the page cache. Rows are handed out by a
+# counter on the non-evicted Redis instance and written once; the replies they map to
+# live on the cache instance, where an evicted reply is just a miss. A full index stops
+# taking new entries until it is cleared with clear_semantic_cache, which moves the
+# template to a new generation of files instead of reusing names other workers have mapped.
+
+def is_available():
+    return numpy is not None and SentenceTransformer is not None
+
+def is_cacheable(template):
+    return template.semantic_cache and is_available()
+
+@lru_cache(maxsize=None)
+def get_model():
+    return SentenceTransformer(settings.SEMANTIC_CACHE_MODEL, device='cpu')
+
+def embed(text):
+    """Unit-length embedding of text, so a dot product is the cosine similarity."""
+    return get_model().encode(text, normalize_embeddings=True).astype(numpy.float32)
+
+def generation_key(template_id):
+    return f'semantic_cache_generation:{template_id}'
+
+def index_name(template):
+    # A changed template starts a new index, since its old answers may no longer fit.
+    generation = int(get_redis().get(generation_key(template.id)) or 0)
+    return f'{template.id}-{int(template.updated_at.timestamp())}-{generation}'
+
+def index_path(name):
+    return os.path.join(settings.SEMANTIC_CACHE_DIR, f'{name}.vectors')
+
+def rows_key(name):
+    return f'semantic_cache_rows:{name}'
+
+def replies_key(name):
+    return f'semantic_cache_replies:{name}'
+
+@lru_cache(maxsize=None)
+def get_index(path, dimensions):
+    """Memory-map the index file at path, creating it on first use."""
+    size = settings.SEMANTIC_CACHE_MAX_ENTRIES * dimensions * 4
+    os.makedirs(settings.SEMANTIC_CACHE_DIR, exist_ok=True)
+    descriptor = os.open(path, os.O_RDWR | os.O_CREAT)
+    try:
+        if os.fstat(descriptor).st_size < size:
+            os.ftruncate(descriptor, size)
+    finally:
+        os.close(descriptor)
+    return numpy.memmap(path, dtype=numpy.float32, mode='r+', shape=(settings.SEMANTIC_CACHE_MAX_ENTRIES, dimensions))
+
+@fail_open(default=(None, None))
+def search(template, prompt):
+    """Return (reply, embedding): the cached reply to the nearest earlier prompt, if it is
+    similar enough, and prompt's embedding for add()."""
+    vector = embed(prompt)
+    name = index_name(template)
+    rows = min(int(get_redis().get(rows_key(name)) or 0), settings.SEMANTIC_CACHE_MAX_ENTRIES)
+
+    reply = None
+    if rows:
+        similarities = get_index(index_path(name), len(vector))[:rows] @ vector
+        row = int(similarities.argmax())
+        if similarities[row] >= settings.SEMANTIC_CACHE_THRESHOLD:
+            entry = get_cache_redis().hget(replies_key(name), row)
+            reply = json.loads(entry) if entry is not None else None
+
+    response_cache.count(template, 'semantic_hits' if reply is not None else 'semantic_misses')
+    return reply, vector
+
+@fail_open()
+def add(template, vector, reply):
+    """Index a first-turn reply under its prompt's embedding."""
+    name = index_name(template)
+    row = get_redis().incr(rows_key(name)) - 1
+    if row >= settings.SEMANTIC_CACHE_MAX_ENTRIES:
+        return
+
+    index = get_index(index_path(name), len(vector))
+    index[row] = vector
+    index.flush()
+    entry = {field: reply[field] for field in ('role', 'content', 'function_call', 'output_tokens')}
+    get_cache_redis().hset(replies_key(name), row, json.dumps(entry))
+
+def clear(template_id=None):
+    """Delete the indexes of template_id, or of every template. Returns how many were deleted."""
+    if not os.path.isdir(settings.SEMANTIC_CACHE_DIR):
+        return 0
+    prefix = f'{template_id}-' if template_id is not None else ''
+    names = [filename[:-len('.vectors')] for filename in os.listdir(settings.SEMANTIC_CACHE_DIR) if filename.startswith(prefix) and filename.endswith('.vectors')]
+    for name in names:
+        get_redis().incr(generation_key(name.split('-')[0]))
+        get_redis().delete(rows_key(name))
+        get_cache_redis().delete(replies_key(name))
+        os.remove(index_path(name))
+    return len(names)
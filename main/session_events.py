@@ -0,0 +1,19 @@
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+
+# Chat connections cache their session and the user's flag state, so changes to
+# either are pushed to them on a per-user group instead of being re-read per frame.
+
+def user_group(user_id):
+    return f'user_{user_id}'
+
+def send_flagged(user_id, session_id, flagged_count):
+    """Tell the user's open connections that session_id was flagged, leaving them flagged_count flagged sessions."""
+    async_to_sync(get_channel_layer().group_send)(
+        user_group(user_id),
+        {
+            'type': 'session_flagged',
+            'session_id': session_id,
+            'flagged_count': flagged_count,
+        }
+    )
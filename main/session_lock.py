@@ -0,0 +1,86 @@
+import hashlib
+import json
+import uuid
+from functools import lru_cache
+import redis
+from django.conf import settings
+from .redis_client import get_redis
+
+# The lock value is "<payload hash>:<turn id>", so a second request can tell a
+# duplicate of the running turn from a different one. User messages that arrive
+# while a turn runs are queued, up to ARGV[6] of them, instead of being rejected.
+ACQUIRE = """
+if redis.call('SET', KEYS[1], ARGV[1] .. ':' .. ARGV[2], 'NX', 'EX', ARGV[3]) then return 'ok' end
+local held = redis.call('GET', KEYS[1])
+if held and string.sub(held, 1, string.len(ARGV[1]) + 1) == ARGV[1] .. ':' then return 'duplicate' end
+if ARGV[4] ~= '' and redis.call('LLEN', KEYS[2]) < tonumber(ARGV[6]) then
+    redis.call('RPUSH', KEYS[2], ARGV[5])
+    redis.call('EXPIRE', KEYS[2], ARGV[3])
+    return 'queued'
+end
+return 'busy'
+"""
+
+# Releasing hands the lock straight to a follow-up turn when messages are queued,
+# so a message queued just before the release cannot be left behind.
+RELEASE = """
+local held = redis.call('GET', KEYS[1])
+if not held or string.sub(held, -string.len(ARGV[1]) - 1) ~= ':' .. ARGV[1] then return {} end
+local queued = redis.call('LRANGE', KEYS[2], 0, -1)
+if #queued == 0 then
+    redis.call('DEL', KEYS[1])
+    return {}
+end
+redis.call('DEL', KEYS[2])
+redis.call('SET', KEYS[1], 'queued:' .. ARGV[2], 'EX', ARGV[3])
+return queued
+"""
+
+def lock_key(session_id):
+    return f'session_turn:{session_id}'
+
+def queue_key(session_id):
+    return f'session_queue:{session_id}'
+
+def payload_hash(content):
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+@lru_cache(maxsize=None)
+def get_script(source):
+    return get_redis().register_script(source)
+
+def acquire(session_id, turn_id, content):
+    """Make turn_id the only turn running in the session.
+
+    Returns None when the lock was taken, 'duplicate' when the running turn was started
+    with the same content, 'queued' when the user message in content will be sent in a
+    follow-up turn, or 'busy' when another turn is running. If Redis is unavailable the
+    turn is let through.
+    """
+    try:
+        result = get_script(ACQUIRE)(
+            keys=[lock_key(session_id), queue_key(session_id)],
+            args=[payload_hash(content), turn_id, settings.SESSION_LOCK_TIMEOUT, '1' if 'content' in content else '', content.get('content', ''), settings.SESSION_QUEUE_MAX_MESSAGES],
+        )
+    except redis.RedisError:
+        return None
+
+    result = result.decode()
+    return None if result == 'ok' else result
+
+def release(session_id, turn_id):
+    """Release the session's lock if turn_id still holds it.
+
+    Returns (follow_up_turn_id, queued_texts) when messages were queued during the turn;
+    the lock then already belongs to the follow-up turn, which must be run. Otherwise
+    returns None.
+    """
+    follow_up_turn_id = uuid.uuid4().hex
+    try:
+        queued = get_script(RELEASE)(keys=[lock_key(session_id), queue_key(session_id)], args=[turn_id, follow_up_turn_id, settings.SESSION_LOCK_TIMEOUT])
+    except redis.RedisError:
+        return None
+
+    if not queued:
+        return None
+    return follow_up_turn_id, [text.decode() for text in queued]
@@ -2,6 +2,7 @@ let chatSocket = null;
 let reconnectAttempts = 0;
 let reconnectTimeout = 1000;
 let allowReconnect = true;
+let streamingContentElement = null;
 
 window.onload = function () {
     let textarea = document.getElementById('chat_input_box');
@@ -81,6 +82,7 @@ function fetchChatMessages(sessionId) {
         .then(messages => {
             let chatMessagesContainer = document.getElementById('chat_messages_container');
             chatMessagesContainer.innerHTML = '';
+            streamingContentElement = null;
 
             for (let message of messages) {
                 let listItem = document.createElement('li');
@@ -162,6 +164,22 @@ function connectToChat(sessionId) {
     };
 
     chatSocket.onmessage = function (e) {
+        const data = JSON.parse(e.data);
+        const container = document.querySelector('#chat_messages_container');
+        if (data.rejected !== undefined) {
+            // The request was turned away or queued; leave the reply being streamed and the function button alone.
+            const rejectedLi = document.createElement('li');
+            rejectedLi.classList.add('list-group-item');
+            let roleElement = document.createElement('b');
+            roleElement.textContent = data.role;
+            let contentElement = document.createElement('span');
+            contentElement.textContent = " : " + data.content;
+            rejectedLi.appendChild(roleElement);
+            rejectedLi.appendChild(contentElement);
+            container.appendChild(rejectedLi);
+            scrollChatToBottom();
+            return;
+        }
         let invokeFunctionContainer = document.querySelector('#invoke_function_container');
         if (invokeFunctionContainer) {
             let button = invokeFunctionContainer.querySelector('button');
@@ -170,10 +188,29 @@ function connectToChat(sessionId) {
             }
             invokeFunctionContainer.parentNode.removeChild(invokeFunctionContainer);
         }
-        const data = JSON.parse(e.data);
+        if (data.delta !== undefined) {
+            if (streamingContentElement === null) {
+                const streamingLi = document.createElement('li');
+                streamingLi.classList.add('list-group-item');
+                let roleElement = document.createElement('b');
+                roleElement.textContent = data.role;
+                streamingContentElement = document.createElement('span');
+                streamingContentElement.textContent = " : ";
+                streamingLi.appendChild(roleElement);
+                streamingLi.appendChild(streamingContentElement);
+                streamingLi.style.whiteSpace = 'pre-line';
+                container.appendChild(streamingLi);
+            }
+            streamingContentElement.textContent += data.delta;
+            scrollChatToBottom();
+            return;
+        }
+        streamingContentElement = null;
+        if (data.done) {
+            return;
+        }
         const li = document.createElement('li');
         li.classList.add('list-group-item');
-        const container = document.querySelector('#chat_messages_container');
         if (data.is_function_call) {
             if (!data.function_approval_required) {
                 document.getElementById("invoke_function").click();
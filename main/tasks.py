@@ -1,98 +1,508 @@
 from apiforllmdjango.celery import app
 from channels.layers import get_channel_layer
-from asgiref.sync import async_to_sync
-from .helpers import has_sufficient_balance, num_tokens_from_messages, get_chat_messages, moderation_endpoint, get_chat_completion, can_execute_function
+from asgiref.sync import async_to_sync, sync_to_async
+from .helpers import estimate_cost, get_summary_completion, num_tokens_from_string, get_chat_history, moderate_texts, get_chat_completion_stream, aget_chat_completion_stream, calculate_cost_from_tokens, can_execute_function, get_functions_as_json
 from decimal import Decimal
-from .models import ChatMessage, UserBalance, ChatSession
-from django.contrib.auth.models import User
-import requests
+from .models import ChatMessage, ChatSession
+from .tokens import REPLY_PRIMING_TOKENS, num_tokens_from_message
+from .context import get_prompt_budget, select_context_messages
+from .turn_context import TurnContext
+from . import history_cache, http_client, ledger, providers, rate_limit, response_cache, semantic_cache, session_lock, upstream_limit
 import json
 from django.core import signing
+from django.core.cache import cache
+from django.conf import settings
+from django.db import close_old_connections, connections
+from celery.exceptions import Retry
+from celery.signals import task_prerun, task_postrun
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, TimeoutError as FuturesTimeoutError, wait
+import time
+from functools import partial
 
-@app.task(soft_time_limit=30, time_limit=35)
-def openai_api_call(session_id, user_id, content):
+# Runs moderation of the user's input while the completion is being generated.
+moderation_executor = ThreadPoolExecutor(max_workers=settings.MODERATION_MAX_WORKERS)
+# Starts hedged completion requests, so a turn can wait on whichever answers first.
+hedge_executor = ThreadPoolExecutor(max_workers=settings.HEDGE_MAX_WORKERS)
+
+@task_prerun.connect
+@task_postrun.connect
+def close_db_connections(**kwargs):
+    """Drop the worker thread's stale database connections around every task.
+
+    Threads of the threads pool live as long as the worker, so without this a
+    connection would outlive the task that opened it.
+    """
+    close_old_connections()
+
+def release_db_connections():
+    """Close this thread's database connections before a long network wait.
+
+    The next query reopens them, so threads waiting on HTTP do not hold Postgres connections.
+    """
+    connections.close_all()
+
+UPSTREAM_BUSY_MESSAGE = {"role": "system", "content": "The AI service is busy. Please try again in a minute."}
+
+@app.task(bind=True, soft_time_limit=30, time_limit=35)
+def openai_api_call(self, session_id, user_id, content, turn_id=None):
+    tokens_used = 0
+    retrying = False
     try:
-        session = ChatSession.objects.get(id=session_id)
-        user = User.objects.get(id=user_id)
-        messages = get_chat_messages(session.id)
+        turn = prepare_turn(session_id, user_id, content)
+        if turn is None:
+            return
+
+        release_db_connections()
+        response = get_cached_reply(turn)
+        if response is None:
+            try:
+                response = stream_chat_completion(session_id, turn['messages'], turn['user'].username, turn['session'], turn['input_tokens'], turn['user_moderation'])
+            except upstream_limit.Overloaded:
+                turn['reservation'].release()
+                if self.request.retries >= settings.UPSTREAM_MAX_RETRIES:
+                    send_message(session_id, UPSTREAM_BUSY_MESSAGE)
+                    return
+                # The user's messages are already recorded, so the retry only requests the completion.
+                raise self.retry(
+                    args=(session_id, user_id, {'resume' : turn['user_message']['content']}, turn_id),
+                    countdown=upstream_limit.retry_delay(self.request.retries),
+                )
+            except Exception as e:
+                turn['reservation'].release()
+                error_message = {"role": "system", "content": "A network error occurred."}
+                send_message(session_id, error_message)
+                return
+
+            tokens_used = turn['input_tokens'] + response['output_tokens']
+        if finish_turn(turn, response, moderate_reply(turn, response)):
+            store_cached_reply(turn, response)
+    
+    except Retry:
+        # The retried task still runs this turn, so it keeps the session lock and in-flight slot.
+        retrying = True
+        raise
+    except Exception as e:
+        error_message = {"role": "system", "content": "An error occurred."}
+        send_message(session_id, error_message)
+    finally:
+        follow_up = None if retrying else release_turn(session_id, user_id, turn_id, tokens_used)
+        if follow_up is not None:
+            follow_up_turn_id, follow_up_content = follow_up
+            # Keep the priority the user's tier gave the turn that queued the messages.
+            priority = (self.request.delivery_info or {}).get('priority')
+            openai_api_call.apply_async((session_id, user_id, follow_up_content, follow_up_turn_id), priority=priority)
+
+def release_turn(session_id, user_id, turn_id, tokens_used):
+    """Give back what admit_turn took for turn_id and charge the tokens the turn used.
+
+    Returns (turn_id, content) of the follow-up turn that must be run for messages
+    queued during this one, or None.
+    """
+    rate_limit.release(user_id, turn_id, tokens_used)
+    if turn_id is None:
+        return None
+
+    follow_up = session_lock.release(session_id, turn_id)
+    if follow_up is None:
+        return None
+    follow_up_turn_id, queued = follow_up
+    return follow_up_turn_id, {'queued' : queued}
 
-        if 'content' in content:
-            user_message = {'role' : 'user', 'content' : content['content']}
+def prepare_turn(session_id, user_id, content):
+    """Record the user's input and run the pre-completion checks. Returns None when no completion should be requested."""
+    context = TurnContext.load(session_id)
+    session = context.session
+    user = context.user
+    if user.id != user_id:
+        raise ValueError("The turn's user does not own the chat session.")
+    history = get_chat_history(session)
+
+    if 'content' in content or 'queued' in content:
+        # Messages queued while the previous turn ran are recorded one by one and answered together.
+        texts = content['queued'] if 'queued' in content else [content['content']]
+        for text in texts:
+            user_message = {'role' : 'user', 'content' : text}
             chat_record = ChatMessage(
                 session=session,
                 role=user_message['role'],
                 content=user_message['content'],
             )
             chat_record.save() 
+            session.token_count += chat_record.token_count
             send_message(session_id, user_message)
-            messages.append(user_message)
-        
-        elif 'invoke_ai' in content:
-            send_message(session_id, {'role' : 'system', 'content' : "Invoking AI."})
-            user_message = {'role' : 'user', 'content' : ''}
-        
-        elif 'invoke_function' in content:
-            send_message(session_id, {'role' : 'system', 'content' : "Invoking function."})
-            last_message_content = messages[-1]['content']
-            execute_function.delay(session_id, last_message_content)
-            return
+            history.append((user_message, chat_record.token_count))
+        user_message = {'role' : 'user', 'content' : '\n\n'.join(texts)}
+    
+    elif 'resume' in content:
+        # A retry of a turn whose messages were recorded by the first attempt.
+        user_message = {'role' : 'user', 'content' : content['resume']}
 
-        input_tokens = num_tokens_from_messages(messages)
-        if(input_tokens >= 16000):
-            error_message = {"role": "system", "content": "Token limit exceeded. Please start a new chat session."}
-            send_message(session_id, error_message)
-            return
+    elif 'invoke_ai' in content:
+        send_message(session_id, {'role' : 'system', 'content' : "Invoking AI."})
+        user_message = {'role' : 'user', 'content' : ''}
+    
+    elif 'invoke_function' in content:
+        send_message(session_id, {'role' : 'system', 'content' : "Invoking function."})
+        last_message_content = history[-1][0]['content']
+        execute_function.delay(session_id, last_message_content)
+        return None
+
+    selected = select_context_messages(session.template, history)
+    if selected is None:
+        error_message = {"role": "system", "content": "Token limit exceeded. Please start a new chat session."}
+        send_message(session_id, error_message)
+        return None
+    messages = [message for message, token_count in selected]
+    input_tokens = sum(token_count for message, token_count in selected) + session.template.function_token_count + REPLY_PRIMING_TOKENS
+    
+    cache_key = None
+    if response_cache.is_cacheable(session.template):
+        cache_key = response_cache.get_key(session.template, messages, get_functions_as_json(session))
+    # Only a first turn, the system prompt and one user message, can be answered by meaning alone.
+    semantic_prompt = None
+    if len(history) == 2 and user_message['content'] and semantic_cache.is_cacheable(session.template):
+        semantic_prompt = user_message['content']
+
+    reservation = ledger.Reservation.reserve(user, estimate_cost(input_tokens, model=session.template.model))
+    if reservation is None:
+        error_message = {"role": "system", "content": "Insufficient balance in your account. Please topup your account to continue."}
+        send_message(session_id, error_message)
+        return None
+
+    return {
+        'context' : context,
+        'session' : session,
+        'user' : user,
+        'messages' : messages,
+        'user_message' : user_message,
+        'input_tokens' : input_tokens,
+        'reservation' : reservation,
+        'cache_key' : cache_key,
+        'semantic_prompt' : semantic_prompt,
+        'semantic_vector' : None,
+        'user_moderation' : moderation_executor.submit(moderate_texts, [user_message['content']]),
+    }
+
+def moderate_reply(turn, response):
+    """Return whether the turn's input or its reply was flagged, or None when the check failed."""
+    try:
+        return turn['user_moderation'].result()[0] or moderate_texts([response['content']])[0]
+    except Exception:
+        return None
+
+def finish_turn(turn, response, flagged):
+    """Bill and persist a completed reply given its moderation verdict, then notify the session group.
+    Returns whether the reply was recorded."""
+    session = turn['session']
+    session_id = session.id
+
+    input_cost = Decimal(str(response['costs']['input_cost']))
+    output_cost = Decimal(str(response['costs']['output_cost']))
+    total_cost = input_cost + output_cost
+    api_response = response['content']
+
+    if flagged is None:
+        turn['reservation'].settle(total_cost)
+        error_message = {"role": "system", "content": "A network error occurred."}
+        send_message(session_id, error_message)
+        return False
+
+    if flagged:
+        turn['reservation'].settle(total_cost)
+        session.flagged = True
+        session.save(update_fields=['flagged', 'updated_at'])
         
-        if(not has_sufficient_balance(user, input_tokens)):
-            error_message = {"role": "system", "content": "Insufficient balance in your account. Please topup your account to continue."}
-            send_message(session_id, error_message)
-            return
+        send_message(session_id, {"role": "system", "content": "This chat session has been flagged by the moderation endpoint."})
+        return False
+
+    role = response['role']
+    is_function_call = False
+
+    if response['function_call'] is not None:
+        function_name = response['function_call']['name']
+        function_args = response['function_call']['arguments']
+        api_response = f"Function: {function_name}, Arguments: {function_args}"
+        is_function_call = True
+    
+    message = ChatMessage(
+        session=session,
+        role=role,
+        content=api_response,
+        input_cost=input_cost,
+        output_cost=output_cost,
+    )
+
+    message.save()
+    turn['reservation'].settle(total_cost, chat_message=message)
+    session.token_count += message.token_count
+
+    if is_function_call:
+        send_message(session_id, {'role' : role, 'content' : api_response})
+    send_message(session_id, {'role' : role, 'done' : True, 'input_cost' : str(input_cost), 'output_cost' : str(output_cost)})
+    if is_function_call:
+        send_message(session_id, {'is_function_call' : True, 'function_approval_required' : session.function_approval_required})
+
+    trigger_tokens, keep_recent_tokens, max_input_tokens = get_summary_limits(session.template.model)
+    if session.token_count - session.summarized_token_count > trigger_tokens and not cache.get(summary_unfunded_key(session_id)):
+        summarize_session.delay(session_id)
+    return True
+
+def store_cached_reply(turn, response):
+    """Cache a recorded reply for later turns asking the same."""
+    if response.get('cached'):
+        return
+    if turn['cache_key'] is not None:
+        response_cache.store(turn['cache_key'], response)
+    if turn['semantic_vector'] is not None and response['function_call'] is None:
+        semantic_cache.add(turn['session'].template, turn['semantic_vector'], response)
+
+def get_cached_reply(turn):
+    """Return the cached reply to the turn's request, already sent to the session group, or None.
+
+    Exact matches are looked up first, then first-turn prompts that mean the same. A
+    cached reply costs nothing upstream, so it is billed at zero.
+    """
+    template = turn['session'].template
+    reply = None
+    if turn['cache_key'] is not None:
+        reply = response_cache.get(template, turn['cache_key'])
+    if reply is None and turn['semantic_prompt'] is not None:
+        reply, turn['semantic_vector'] = semantic_cache.search(template, turn['semantic_prompt'])
+    if reply is None:
+        return None
+
+    # Like a streamed reply, a cached one is only shown for input that passed moderation.
+    if reply['content'] and input_cleared(turn['user_moderation']):
+        send_message(turn['session'].id, {'role' : reply['role'], 'delta' : reply['content']})
+    return {**reply, 'cached' : True, 'costs' : {'input_cost' : 0, 'output_cost' : 0}}
+
+def input_cleared(moderation):
+    """Wait for the moderation verdict on a turn's input. Whether it passed; a failed check
+    did not, and finish_turn reports it."""
+    try:
+        return not moderation.result()[0]
+    except Exception:
+        return False
+
+def stream_chat_completion(session_id, messages, username, session, input_tokens, moderation=None):
+    """Stream a completion to the session group as delta frames and return the assembled reply with its costs.
+
+    The completion runs on a provider with room for it under its concurrency limit. Raises
+    upstream_limit.Overloaded, before anything was streamed, when no provider could take it.
+    With moderation, the future of the input's verdict, the first delta waits for it, and
+    a flagged input ends the stream before anything is shown; finish_turn then flags the
+    session. The reply itself is moderated only once complete, so a flagged reply to a
+    clean input has already been shown when the session is flagged.
+    """
+    model = session.template.model
+    provider, slot, stream, latency = open_chat_completion_stream(messages, username, session, hedge=should_hedge(model, input_tokens))
+    try:
+        reply = new_completion_reply()
+        for chunk in stream:
+            delta = add_completion_chunk(reply, chunk)
+            if delta:
+                if moderation is not None:
+                    if not input_cleared(moderation):
+                        stream.close()
+                        break
+                    moderation = None
+                send_message(session_id, {'role' : reply['role'], 'delta' : delta})
+    except Exception as e:
+        finish_upstream_call(provider, model, slot, error=e)
+        raise
+
+    finish_upstream_call(provider, model, slot, latency=latency)
+    return completion_reply_result(reply, input_tokens, model)
+
+def open_chat_completion_stream(messages, username, session, hedge=False):
+    """Start the completion on the first provider in routing order that takes it.
+
+    Returns (provider, slot, stream, time to first response). A provider at its limit is
+    skipped, and one that fails is recorded as such and the next one tried. With hedge,
+    a slow first response is raced against a second request; see start_hedged_call.
+    """
+    model = session.template.model
+    candidates = providers.route(model)
+    error = None
+    for index, provider in enumerate(candidates):
+        slot = providers.acquire(provider, model)
+        if slot is None:
+            continue
 
         try:
-            response = get_chat_completion(messages, user.username, session)
-            input_cost = Decimal(str(response['costs']['input_cost']))
-            output_cost = Decimal(str(response['costs']['output_cost']))
-            total_cost = input_cost + output_cost
-            user_balance = UserBalance.objects.get(user=user)  
-            user_balance.debit(total_cost)
-            api_response = response['chat_completion']['choices'][0]['message']['content']
-            if moderation_endpoint(user_message['content']) or moderation_endpoint(api_response):
-                session.flagged = True
-                session.save()
-                
-                send_message(session_id, {"role": "system", "content": "This chat session has been flagged by the moderation endpoint."})
-                return
+            if hedge:
+                return start_hedged_call(provider, slot, candidates[index + 1:] + [provider], messages, username, session)
+            return start_upstream_call(provider, slot, messages, username, session)
         except Exception as e:
-            error_message = {"role": "system", "content": "A network error occurred."}
-            send_message(session_id, error_message)
-            return
+            if not providers.is_failure(e):
+                raise
+            error = e
 
-        role = response['chat_completion']['choices'][0]['message']['role']
-        is_function_call = False
+    raise upstream_limit.Overloaded() from error
 
-        if api_response is None:  
-            function_name = response['chat_completion']['choices'][0]['message']['function_call']['name']
-            function_args = response['chat_completion']['choices'][0]['message']['function_call']['arguments']
-            api_response = f"Function: {function_name}, Arguments: {function_args}"
-            is_function_call = True
-        
-        message = ChatMessage(
-            session=session,
-            role=role,
-            content=api_response,
-            input_cost=input_cost,
-            output_cost=output_cost,
-        )
+def start_upstream_call(provider, slot, messages, username, session):
+    """Send the completion request to provider under slot. Returns (provider, slot, stream, time to first response)."""
+    started = time.monotonic()
+    try:
+        stream = get_chat_completion_stream(messages, username, session, provider)
+    except Exception as e:
+        finish_upstream_call(provider, session.template.model, slot, error=e)
+        raise
+    return provider, slot, stream, time.monotonic() - started
 
-        message.save()
+def should_hedge(model, input_tokens):
+    """Whether the completion is short and cheap enough to be worth a second request when it is slow."""
+    return input_tokens <= settings.HEDGE_MAX_INPUT_TOKENS and any(model.startswith(prefix) for prefix in settings.HEDGE_MODELS)
 
-        send_message(session_id, {'role' : role, 'content' : api_response})
-        if is_function_call:
-            send_message(session_id, {'is_function_call' : True, 'function_approval_required' : session.function_approval_required})
-    
+def start_hedged_call(provider, slot, hedge_providers, messages, username, session):
+    """Like start_upstream_call, but if no response arrives within the provider's usual time
+    to first response, send the same request to the first of hedge_providers with a free
+    slot as well. The first response wins; the other call's stream is closed unread and
+    its usage is never billed.
+    """
+    model = session.template.model
+    delay = providers.get_latency_percentile(provider, model, settings.HEDGE_PERCENTILE, settings.HEDGE_MIN_SAMPLES)
+    if delay is None:
+        return start_upstream_call(provider, slot, messages, username, session)
+
+    calls = [hedge_executor.submit(run_upstream_call, provider, slot, messages, username, session)]
+    try:
+        return calls[0].result(timeout=max(delay, settings.HEDGE_MIN_DELAY))
+    except FuturesTimeoutError:
+        pass
+
+    for hedge_provider in hedge_providers:
+        hedge_slot = providers.acquire(hedge_provider, model)
+        if hedge_slot is not None:
+            calls.append(hedge_executor.submit(run_upstream_call, hedge_provider, hedge_slot, messages, username, session))
+            break
+
+    error = None
+    while calls:
+        done, pending = wait(calls, return_when=FIRST_COMPLETED)
+        for call in done:
+            calls.remove(call)
+            if call.exception() is None:
+                for loser in calls:
+                    loser.add_done_callback(partial(cancel_upstream_call, model))
+                return call.result()
+            error = call.exception()
+    raise error
+
+def run_upstream_call(provider, slot, messages, username, session):
+    # Runs on a hedge_executor thread, which must not keep database connections open.
+    try:
+        return start_upstream_call(provider, slot, messages, username, session)
+    finally:
+        release_db_connections()
+
+def cancel_upstream_call(model, call):
+    """Drop the losing call of a hedged request once it has a response.
+
+    Closing its unread stream drops the response, whose connection is closed instead
+    of going back to the pool, so the provider stops generating.
+    """
+    if call.exception() is not None:
+        return
+    provider, slot, stream, latency = call.result()
+    stream.close()
+    finish_upstream_call(provider, model, slot, latency=latency)
+
+def finish_upstream_call(provider, model, slot, latency=None, error=None):
+    """Give back slot, adapting the provider's concurrency limit and health to how the call went."""
+    if error is None:
+        upstream_limit.release(slot, 'success', latency)
+        providers.record(provider, model, latency)
+        return
+
+    upstream_limit.release(slot, 'overload' if upstream_limit.is_overload(error) else None)
+    if providers.is_failure(error):
+        providers.record(provider, model)
+
+async def astream_chat_completion(session_id, messages, username, session, input_tokens, moderation=None):
+    """Async counterpart of stream_chat_completion for turns run inside the ASGI event loop."""
+    model = session.template.model
+    provider, slot, stream, latency = await aopen_chat_completion_stream(messages, username, session)
+    channel_layer = get_channel_layer()
+    reply = new_completion_reply()
+    try:
+        async for chunk in stream:
+            delta = add_completion_chunk(reply, chunk)
+            if delta:
+                if moderation is not None:
+                    if not await sync_to_async(input_cleared, thread_sensitive=False)(moderation):
+                        await stream.aclose()
+                        break
+                    moderation = None
+                await channel_layer.group_send(
+                    str(session_id),
+                    {
+                        'type': 'receive_group_message',
+                        'message': {'role' : reply['role'], 'delta' : delta},
+                    }
+                )
     except Exception as e:
-        error_message = {"role": "system", "content": "An error occurred."}
-        send_message(session_id, error_message)
+        await sync_to_async(finish_upstream_call)(provider, model, slot, error=e)
+        raise
+
+    await sync_to_async(finish_upstream_call)(provider, model, slot, latency=latency)
+    return completion_reply_result(reply, input_tokens, model)
+
+async def aopen_chat_completion_stream(messages, username, session):
+    """Async counterpart of open_chat_completion_stream."""
+    model = session.template.model
+    error = None
+    for provider in await sync_to_async(providers.route)(model):
+        slot = await sync_to_async(providers.acquire)(provider, model)
+        if slot is None:
+            continue
+
+        started = time.monotonic()
+        try:
+            stream = await aget_chat_completion_stream(messages, username, session, provider)
+        except Exception as e:
+            await sync_to_async(finish_upstream_call)(provider, model, slot, error=e)
+            if not providers.is_failure(e):
+                raise
+            error = e
+            continue
+        return provider, slot, stream, time.monotonic() - started
+
+    raise upstream_limit.Overloaded() from error
+
+def new_completion_reply():
+    return {'role' : 'assistant', 'content' : [], 'function_name' : [], 'function_args' : []}
+
+def add_completion_chunk(reply, chunk):
+    """Fold one streamed chunk into reply and return its content delta, if any."""
+    if not chunk['choices']:
+        return None
+    delta = chunk['choices'][0]['delta']
+    reply['role'] = delta.get('role', reply['role'])
+    if delta.get('function_call'):
+        reply['function_name'].append(delta['function_call'].get('name', ''))
+        reply['function_args'].append(delta['function_call'].get('arguments', ''))
+    if delta.get('content'):
+        reply['content'].append(delta['content'])
+        return delta['content']
+    return None
+
+def completion_reply_result(reply, input_tokens, model):
+    content = ''.join(reply['content'])
+    if reply['function_name']:
+        function_call = {'name' : ''.join(reply['function_name']), 'arguments' : ''.join(reply['function_args'])}
+        output_tokens = num_tokens_from_string(function_call['name'], model) + num_tokens_from_string(function_call['arguments'], model)
+    else:
+        function_call = None
+        output_tokens = num_tokens_from_string(content, model)
+
+    return {
+        'role' : reply['role'],
+        'content' : content,
+        'function_call' : function_call,
+        'output_tokens' : output_tokens,
+        'costs' : calculate_cost_from_tokens(input_tokens, output_tokens, model),
+    }
 
 def send_message(session_id, message):
     channel_layer = get_channel_layer()
@@ -107,17 +517,18 @@ def send_message(session_id, message):
 @app.task(soft_time_limit=30, time_limit=35)
 def execute_function(session_id, api_response):
     try:
-        session = ChatSession.objects.get(id=session_id)
+        context = TurnContext.load(session_id)
+        session = context.session
         prefix = "Function: "
         prefix_args = "Arguments: "
         function_name = api_response[api_response.index(prefix) + len(prefix):api_response.index(", Arguments: ")].strip()
         
-        if not can_execute_function(function_name, session):
+        if not can_execute_function(function_name, context):
             raise Exception("Cannot execute function.")
         function_args = api_response[api_response.index(prefix_args) + len(prefix_args):].strip()
         function_args = json.loads(function_args)
 
-        function = session.template.functions.filter(name=function_name).first()
+        function = context.get_function(function_name)
         secrets = function.secrets.all()
         for secret in secrets:
             secret_key = secret.name
@@ -140,10 +551,101 @@ def execute_function(session_id, api_response):
         hostname = session.function_server.hostname.rstrip('/')
         url = "{}/runfunction/{}".format(hostname, session.id)
 
-        response = requests.post(url, headers=headers, data=json.dumps(data))
+        release_db_connections()
+        response = http_client.get_session().post(url, headers=headers, data=json.dumps(data), timeout=http_client.timeout(settings.FUNCTION_REQUEST_TIMEOUT))
 
         #print(f"URL: {url}\nStatus code: {response.status_code}\nJSON content: {response.json()}\nData: {data}")
 
     except Exception as e:
         error_message = {"role": "system", "content": "A function call error occurred."}
-        send_message(session.id, error_message)
\ No newline at end of file
+        send_message(session_id, error_message)
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below so it can stand in for it as context in later turns. "
+    "Keep facts, decisions, names, numbers, open questions and anything the user asked to remember. "
+    "Reply with the summary only."
+)
+
+def summary_unfunded_key(session_id):
+    return f'summary_unfunded:{session_id}'
+
+def get_summary_limits(model):
+    """Return the trigger, recent and input token limits of rolling summaries, scaled to the model's prompt budget."""
+    budget = get_prompt_budget(model)
+    return (
+        int(budget * settings.SUMMARY_TRIGGER_FRACTION),
+        int(budget * settings.SUMMARY_KEEP_RECENT_FRACTION),
+        int(budget * settings.SUMMARY_MAX_INPUT_FRACTION),
+    )
+
+@app.task(soft_time_limit=60, time_limit=65)
+def summarize_session(session_id):
+    """Fold the messages that have aged out of the recent window into the session's rolling summary."""
+    lock_key = f'summarize_session:{session_id}'
+    if not cache.add(lock_key, True, timeout=65):
+        return
+
+    try:
+        session = ChatSession.objects.select_related('user', 'template').get(id=session_id)
+        messages = ChatMessage.objects.filter(session=session).order_by('created_at').only('role', 'content', 'token_count', 'created_at')
+        since = session.summarized_until or messages.first().created_at
+        unsummarized = list(messages.filter(created_at__gt=since))
+        trigger_tokens, keep_recent_tokens, max_input_tokens = get_summary_limits(session.template.model)
+        # The earlier summary is part of the input, too.
+        max_input_tokens -= session.summary_token_count
+
+        recent_tokens = 0
+        split = len(unsummarized)
+        while split > 0 and recent_tokens + unsummarized[split - 1].token_count <= keep_recent_tokens:
+            split -= 1
+            recent_tokens += unsummarized[split].token_count
+
+        aged_out = []
+        aged_out_tokens = 0
+        for message in unsummarized[:split]:
+            if aged_out and aged_out_tokens + message.token_count > max_input_tokens:
+                break
+            aged_out.append(message)
+            aged_out_tokens += message.token_count
+        if not aged_out:
+            return
+
+        transcript = '\n\n'.join(f'{message.role}: {message.content}' for message in aged_out)
+        if session.summary:
+            transcript = f'Summary so far: {session.summary}\n\n{transcript}'
+        messages = [{'role' : 'system', 'content' : SUMMARY_PROMPT}, {'role' : 'user', 'content' : transcript}]
+        input_tokens = sum(num_tokens_from_message(message, session.template.model) for message in messages) + REPLY_PRIMING_TOKENS
+        reservation = ledger.Reservation.reserve(session.user, estimate_cost(input_tokens, model=session.template.model))
+        if reservation is None:
+            # Keep finish_turn from queueing the summary again on every turn until the user can pay for it.
+            cache.set(summary_unfunded_key(session_id), True, timeout=settings.SUMMARY_UNFUNDED_RETRY_DELAY)
+            return
+
+        try:
+            response = get_summary_completion(messages, session.user.username, session.template.model)
+        except Exception:
+            reservation.release()
+            raise
+        reservation.settle(Decimal(str(response['costs']['input_cost'])) + Decimal(str(response['costs']['output_cost'])))
+
+        session.summary = response['chat_completion']['choices'][0]['message']['content']
+        session.summary_token_count = num_tokens_from_message(session.summary_message(), session.template.model)
+        session.summarized_until = aged_out[-1].created_at
+        session.summarized_token_count += aged_out_tokens
+        session.save(update_fields=['summary', 'summary_token_count', 'summarized_until', 'summarized_token_count'])
+        history_cache.invalidate(session)
+    finally:
+        cache.delete(lock_key)
+
+    if len(aged_out) < split:
+        summarize_session.delay(session_id)
+
+@app.task
+def expire_balance_holds():
+    ledger.expire_holds()
+
+@app.task
+def flush_balance_ledger():
+    """Apply unflushed ledger entries to UserBalance until none are left."""
+    while ledger.flush(settings.BALANCE_LEDGER_FLUSH_BATCH_SIZE) == settings.BALANCE_LEDGER_FLUSH_BATCH_SIZE:
+        pass
@@ -0,0 +1,205 @@
+from django.test import TestCase, SimpleTestCase, TransactionTestCase, override_settings
+from django.contrib.auth.models import User
+from django.urls import re_path
+from unittest.mock import patch
+from decimal import Decimal
+import asyncio
+import openai
+import redis
+from asgiref.sync import sync_to_async
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from .models import ChatSession, ChatTemplate, ChatMessage, UserBalance, ContextStrategyChoices
+from .consumers import precheck_turn, admit_turn, get_turn_request, get_chat_session_access, ChatConsumer, AsyncChatConsumer, MAX_FLAGGED_SESSIONS
+from .providers import get_providers, health_key, latencies_key
+from .redis_client import get_redis
+from .tasks import UPSTREAM_BUSY_MESSAGE
+from . import balance_cache, history_cache, ledger, rate_limit, session_lock, upstream_limit
+
+class PrecheckTurnTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        UserBalance.objects.create(user=self.user, balance=Decimal('1.0'))
+        balance_cache.reset(self.user.id)
+        self.template = ChatTemplate.objects.create(
+            name='Test Template',
+            model='gpt-4',
+            temperature=0.7,
+            system_prompt='Start',
+            user=self.user,
+            context_strategy=ContextStrategyChoices.REJECT,
+        )
+        self.session = ChatSession.objects.create(user=self.user, template=self.template, title='Session')
+        self.limits = rate_limit.get_user_tier(self.user)
+
+    def tearDown(self):
+        get_redis().delete(session_lock.lock_key(self.session.id), session_lock.queue_key(self.session.id))
+        balance_cache.reset(self.user.id)
+
+    def load_session(self):
+        return ChatSession.objects.select_related('template').get(pk=self.session.pk)
+
+    def test_turn_within_limits_is_let_through(self):
+        self.assertIsNone(precheck_turn(self.load_session(), self.user.id, {'content': 'Hello'}))
+        self.assertIsNone(precheck_turn(self.load_session(), self.user.id, {'invoke_ai': True}))
+
+    def test_history_over_budget_is_rejected(self):
+        ChatMessage.objects.create(session=self.session, role='user', content='word ' * 7500)
+
+        self.assertEqual(precheck_turn(self.load_session(), self.user.id, {'content': 'Hello'}), 'context')
+
+        ChatTemplate.objects.filter(pk=self.template.pk).update(context_strategy=ContextStrategyChoices.DROP_OLDEST)
+        self.assertIsNone(precheck_turn(self.load_session(), self.user.id, {'content': 'Hello'}))
+        self.assertEqual(precheck_turn(self.load_session(), self.user.id, {'content': 'word ' * 7500}), 'context')
+
+    def test_insufficient_balance_is_rejected(self):
+        UserBalance.objects.filter(user=self.user).update(balance=Decimal('0.0'))
+        balance_cache.reset(self.user.id)
+
+        self.assertEqual(precheck_turn(self.load_session(), self.user.id, {'content': 'Hello'}), 'balance')
+        self.assertIsNone(precheck_turn(self.load_session(), self.user.id, {'invoke_function': True}))
+
+    def test_user_without_balance_is_rejected(self):
+        UserBalance.objects.filter(user=self.user).delete()
+        balance_cache.reset(self.user.id)
+
+        self.assertEqual(precheck_turn(self.load_session(), self.user.id, {'content': 'Hello'}), 'balance')
+        self.assertEqual(UserBalance.objects.get(user=self.user).balance, Decimal('0.0'))
+
+    def test_rejected_turn_takes_nothing(self):
+        UserBalance.objects.filter(user=self.user).update(balance=Decimal('0.0'))
+        balance_cache.reset(self.user.id)
+
+        self.assertEqual(admit_turn(self.load_session(), self.user.id, {'content': 'Hello'}, self.limits), (None, 'balance'))
+        self.assertIsNone(get_redis().get(session_lock.lock_key(self.session.id)))
+
+    @patch('main.ledger.get_available_balance', side_effect=redis.ConnectionError)
+    def test_fails_open(self, mock_balance):
+        self.assertIsNone(precheck_turn(self.load_session(), self.user.id, {'content': 'Hello'}))
+
+class ChatSessionAccessTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.template = ChatTemplate.objects.create(name='Test Template', model='gpt-4', temperature=0.7, system_prompt='Start', user=self.user)
+        self.session = ChatSession.objects.create(user=self.user, template=self.template, title='Session')
+
+    def test_too_many_flagged_sessions(self):
+        self.assertEqual(get_chat_session_access(self.user, self.session.id), (self.session, None))
+
+        for index in range(MAX_FLAGGED_SESSIONS):
+            ChatSession.objects.create(user=self.user, template=self.template, title=f'Flagged {index}', flagged=True)
+        with self.assertNumQueries(2):
+            session, close_code = get_chat_session_access(self.user, self.session.id)
+        self.assertEqual(close_code, 4405)
+
+    def test_flagging_revokes_cached_access(self):
+        consumer = ChatConsumer()
+        consumer.session, consumer.close_code = get_chat_session_access(self.user, self.session.id)
+
+        consumer.session_flagged({'type': 'session_flagged', 'session_id': self.session.id + 1, 'flagged_count': 1})
+        self.assertIsNone(consumer.close_code)
+        consumer.session_flagged({'type': 'session_flagged', 'session_id': self.session.id, 'flagged_count': 1})
+        self.assertEqual(consumer.close_code, 4405)
+
+class TurnRequestTest(SimpleTestCase):
+
+    def test_server_only_keys_are_dropped(self):
+        self.assertEqual(get_turn_request({'content': 'Hello', 'queued': ['a'] * 100}), {'content': 'Hello'})
+        self.assertEqual(get_turn_request({'invoke_ai': True, 'resume': 'Hello'}), {'invoke_ai': True})
+        self.assertIsNone(get_turn_request({'queued': ['a'] * 100}))
+        self.assertIsNone(get_turn_request({'resume': 'Hello'}))
+        self.assertIsNone(get_turn_request({'content': ['not', 'text']}))
+
+class FakeStream:
+    """Async iterator standing in for a streamed completion."""
+
+    def __init__(self, contents):
+        self.contents = contents
+
+    async def __aiter__(self):
+        yield {'choices': [{'delta': {'role': 'assistant'}}]}
+        for content in self.contents:
+            yield {'choices': [{'delta': {'content': content}}]}
+
+    async def aclose(self):
+        pass
+
+@override_settings(UPSTREAM_MAX_RETRIES=0)
+class AsyncChatConsumerTest(TransactionTestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        UserBalance.objects.create(user=self.user, balance=Decimal('1.0'))
+        self.template = ChatTemplate.objects.create(name='Test Template', model='gpt-3.5-turbo', temperature=0.7, system_prompt='Start', user=self.user)
+        self.session = ChatSession.objects.create(user=self.user, template=self.template, title='Session')
+        self.clear_redis()
+        self.addCleanup(self.clear_redis)
+
+    def clear_redis(self):
+        balance_cache.reset(self.user.id)
+        history_cache.invalidate(self.session)
+        model = self.template.model
+        provider = get_providers()['openai']
+        get_redis().delete(
+            session_lock.lock_key(self.session.id), session_lock.queue_key(self.session.id),
+            rate_limit.bucket_key(self.user.id), rate_limit.in_flight_key(self.user.id),
+            health_key(provider, model), latencies_key(provider, model),
+            upstream_limit.limit_key(f'openai:{model}'), upstream_limit.slots_key(f'openai:{model}'),
+        )
+
+    async def run_turn(self, acreate, frame_count):
+        """Send a message through the consumer and return the frames it sends back, once the turn is over."""
+        application = URLRouter([re_path(r'ws/chat/(?P<session_id>\d+)/$', AsyncChatConsumer.as_asgi())])
+        communicator = WebsocketCommunicator(application, f'/ws/chat/{self.session.id}/')
+        communicator.scope['user'] = self.user
+        connected, close_code = await communicator.connect()
+        self.assertTrue(connected)
+
+        with patch('openai.ChatCompletion.acreate', acreate), patch('main.tasks.moderate_texts', side_effect=lambda texts: [False] * len(texts)):
+            await communicator.send_json_to({'content': 'Hello'})
+            frames = [await communicator.receive_json_from(timeout=5) for i in range(frame_count)]
+            # The session lock is given back after the last frame.
+            for i in range(50):
+                if not await sync_to_async(get_redis().exists)(session_lock.lock_key(self.session.id)):
+                    break
+                await asyncio.sleep(0.05)
+        await communicator.disconnect()
+        return frames
+
+    async def test_reply_is_streamed_and_recorded(self):
+        async def acreate(**kwargs):
+            return FakeStream(['Hi', ' there'])
+
+        frames = await self.run_turn(acreate, 4)
+
+        self.assertEqual(frames[0], {'role': 'user', 'content': 'Hello'})
+        self.assertEqual([frame.get('delta') for frame in frames[1:3]], ['Hi', ' there'])
+        self.assertTrue(frames[3]['done'])
+        reply = await sync_to_async(ChatMessage.objects.get)(session=self.session, role='assistant')
+        self.assertEqual(reply.content, 'Hi there')
+        self.assertFalse(get_redis().exists(session_lock.lock_key(self.session.id)))
+        balance = await sync_to_async(ledger.get_available_balance)(self.user.id)
+        self.assertEqual(balance, Decimal('1.0') - reply.input_cost - reply.output_cost)
+
+    async def test_upstream_failure_releases_turn(self):
+        async def acreate(**kwargs):
+            raise openai.error.APIConnectionError('connection refused')
+
+        frames = await self.run_turn(acreate, 2)
+
+        self.assertEqual(frames[1], UPSTREAM_BUSY_MESSAGE)
+        self.assertFalse(await sync_to_async(ChatMessage.objects.filter(session=self.session, role='assistant').exists)())
+        self.assertFalse(get_redis().exists(session_lock.lock_key(self.session.id)))
+        self.assertEqual(await sync_to_async(ledger.get_available_balance)(self.user.id), Decimal('1.0'))
+
+    async def test_upstream_error_releases_turn(self):
+        async def acreate(**kwargs):
+            raise openai.error.InvalidRequestError('bad request', None)
+
+        frames = await self.run_turn(acreate, 2)
+
+        self.assertEqual(frames[1], {'role': 'system', 'content': 'A network error occurred.'})
+        self.assertFalse(get_redis().exists(session_lock.lock_key(self.session.id)))
+        self.assertEqual(await sync_to_async(ledger.get_available_balance)(self.user.id), Decimal('1.0'))
@@ -0,0 +1,70 @@
+from django.test import SimpleTestCase
+from unittest.mock import patch
+from .context import drop_oldest, truncate_oldest, reject, select_context_messages, get_context_window
+from .models import ChatTemplate, ContextStrategyChoices
+from .tokens import get_encoding
+
+def message(role, content, token_count):
+    return ({'role': role, 'content': content}, token_count)
+
+class ContextStrategyTest(SimpleTestCase):
+
+    def setUp(self):
+        self.system = [message('system', 'system prompt', 10)]
+        self.history = [
+            message('user', 'first', 40),
+            message('assistant', 'second', 40),
+            message('user', 'third', 40),
+        ]
+
+    def test_everything_fits(self):
+        self.assertEqual(drop_oldest(self.system, self.history, 200), self.system + self.history)
+
+    def test_drop_oldest_keeps_system_prompt_and_latest_turns(self):
+        selected = drop_oldest(self.system, self.history, 100)
+        self.assertEqual(selected, self.system + self.history[1:])
+
+    def test_drop_oldest_fails_when_latest_message_does_not_fit(self):
+        self.assertIsNone(drop_oldest(self.system, self.history, 30))
+
+    def test_truncate_oldest_cuts_the_boundary_message(self):
+        history = [message('user', 'one two three four five six seven eight nine ten', 13)] + self.history[1:]
+        selected = truncate_oldest(self.system, history, 100)
+
+        self.assertEqual(len(selected), 4)
+        truncated, token_count = selected[1]
+        self.assertEqual(token_count, 10)
+        self.assertTrue(history[0][0]['content'].endswith(truncated['content']))
+        self.assertLessEqual(sum(count for m, count in selected), 100)
+
+    def test_reject(self):
+        self.assertIsNone(reject(self.system, self.history, 100))
+        self.assertEqual(reject(self.system, self.history, 130), self.system + self.history)
+
+    def test_select_uses_template_strategy_and_model(self):
+        template = ChatTemplate(model='gpt-4', context_strategy=ContextStrategyChoices.REJECT)
+        history = self.system + [message('user', 'long', 9000)]
+        self.assertIsNone(select_context_messages(template, history))
+
+        template.model = 'gpt-4-32k'
+        self.assertEqual(select_context_messages(template, history), history)
+
+    def test_select_leaves_room_for_functions(self):
+        template = ChatTemplate(model='gpt-4', context_strategy=ContextStrategyChoices.REJECT)
+        history = self.system + [message('user', 'long', 7000)]
+        self.assertEqual(select_context_messages(template, history), history)
+
+        template.function_token_count = 1000
+        self.assertIsNone(select_context_messages(template, history))
+
+    def test_truncation_uses_template_model_tokenizer(self):
+        template = ChatTemplate(model='gpt-4', context_strategy=ContextStrategyChoices.TRUNCATE_OLDEST)
+        history = self.system + [message('user', 'one two three ' * 3000, 9000)]
+        with patch('main.context.get_encoding', wraps=get_encoding) as mock_encoding:
+            selected = select_context_messages(template, history)
+        mock_encoding.assert_called_once_with('gpt-4')
+        self.assertEqual(len(selected), 2)
+
+    def test_context_window_prefix_match(self):
+        self.assertEqual(get_context_window('gpt-3.5-turbo-16k-0613'), 16385)
+        self.assertEqual(get_context_window('gpt-3.5-turbo-0613'), 4097)
@@ -0,0 +1,71 @@
+from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.contrib.auth.models import User
+from unittest.mock import patch
+from .models import ChatSession, ChatTemplate, ChatMessage
+from .helpers import moderate_texts, moderation_endpoint, get_chat_history
+
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ModerateTextsTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    @patch('main.helpers.openai.Moderation.create')
+    def test_texts_are_batched_in_one_request(self, mock_create):
+        mock_create.return_value = {'results': [{'flagged': False}, {'flagged': True}]}
+
+        verdicts = moderate_texts(['hello', 'bad words'])
+
+        self.assertEqual(verdicts, [False, True])
+        mock_create.assert_called_once()
+        self.assertEqual(mock_create.call_args.kwargs['input'], ['hello', 'bad words'])
+
+    @patch('main.helpers.openai.Moderation.create')
+    def test_cached_verdicts_are_not_remoderated(self, mock_create):
+        mock_create.return_value = {'results': [{'flagged': True}]}
+        moderate_texts(['bad words'])
+
+        mock_create.return_value = {'results': [{'flagged': False}]}
+        verdicts = moderate_texts(['bad words', 'hello'])
+
+        self.assertEqual(verdicts, [True, False])
+        self.assertEqual(mock_create.call_count, 2)
+        self.assertEqual(mock_create.call_args.kwargs['input'], ['hello'])
+
+    @patch('main.helpers.openai.Moderation.create')
+    def test_empty_text_is_not_sent(self, mock_create):
+        self.assertFalse(moderation_endpoint(''))
+        mock_create.assert_not_called()
+
+    @override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.redis.RedisCache', 'LOCATION': 'redis://127.0.0.1:1/0'}})
+    @patch('main.helpers.openai.Moderation.create')
+    def test_unavailable_cache_is_a_miss(self, mock_create):
+        mock_create.return_value = {'results': [{'flagged': True}]}
+        self.assertEqual(moderate_texts(['bad words']), [True])
+        mock_create.assert_called_once()
+
+@override_settings(CACHE_REDIS_URL='redis://127.0.0.1:1/0')
+class GetChatHistoryTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.template = ChatTemplate.objects.create(
+            name='Test Template',
+            model='gpt-3.5-turbo',
+            temperature=0.7,
+            system_prompt='Start',
+            user=self.user
+        )
+        self.session = ChatSession.objects.create(user=self.user, template=self.template, title='Session')
+        ChatMessage.objects.create(session=self.session, role='user', content='Hello')
+
+    def test_history_is_read_from_database_when_cache_is_unavailable(self):
+        history = get_chat_history(self.session)
+        self.assertEqual([message for message, token_count in history], [
+            {'role': 'system', 'content': 'Start'},
+            {'role': 'user', 'content': 'Hello'},
+        ])
+        self.assertTrue(all(token_count > 0 for message, token_count in history))
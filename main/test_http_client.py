@@ -0,0 +1,66 @@
+from django.test import TestCase
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
+import threading
+import requests
+from .redis_client import get_cache_redis
+from . import http_client
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.server.connections.add(self.client_address)
+        status = 503 if self.path == '/unavailable' else 200
+        self.send_response(status)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args):
+        pass
+
+class PooledSessionTest(TestCase):
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.connections = set()
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.host = f'127.0.0.1:{self.server.server_address[1]}'
+        self.addCleanup(get_cache_redis().delete, http_client.metrics_key(self.host))
+
+    def test_connections_are_kept_alive(self):
+        session = http_client.get_session()
+        for i in range(3):
+            session.post(f'http://{self.host}/', data='{}', timeout=http_client.timeout(5))
+        # openai closes its per-thread session from time to time.
+        session.close()
+        session.post(f'http://{self.host}/', data='{}', timeout=http_client.timeout(5))
+
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_one_session_per_process(self):
+        session = http_client.get_session()
+        self.assertIs(http_client.get_session(), session)
+        with patch('main.http_client.os.getpid', return_value=-1):
+            self.assertIsNot(http_client.get_session(), session)
+
+    def test_metrics_are_recorded_per_host(self):
+        session = http_client.get_session()
+        session.post(f'http://{self.host}/', timeout=http_client.timeout(5))
+        session.post(f'http://{self.host}/unavailable', timeout=http_client.timeout(5))
+
+        metrics = http_client.get_metrics()[self.host]
+        self.assertEqual((metrics['requests'], metrics['errors']), (2, 1))
+        self.assertGreater(metrics['seconds'], 0)
+
+    def test_connection_failures_are_recorded(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self.assertRaises(requests.ConnectionError):
+            http_client.get_session().post(f'http://{self.host}/', timeout=http_client.timeout(5))
+
+        self.assertEqual(http_client.get_metrics()[self.host]['errors'], 1)
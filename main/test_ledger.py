@@ -0,0 +1,66 @@
+from django.test import TestCase
+from django.contrib.auth.models import User
+from decimal import Decimal
+from unittest.mock import patch
+from .models import UserBalance, BalanceLedgerEntry, LedgerEntryKind
+from . import balance_cache, ledger
+
+class LedgerTestCase(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.user_balance = UserBalance.objects.create(user=self.user, balance=Decimal('1.0'))
+        balance_cache.reset(self.user.id)
+
+    def test_reserve_holds_amount(self):
+        reservation = ledger.Reservation.reserve(self.user, Decimal('0.4'))
+        self.assertEqual(reservation.amount, Decimal('0.4'))
+        self.assertEqual(ledger.get_available_balance(self.user.id), Decimal('0.6'))
+        self.user_balance.refresh_from_db()
+        self.assertEqual(self.user_balance.balance, Decimal('1.0'))
+
+    def test_reserve_insufficient_balance(self):
+        self.assertIsNone(ledger.Reservation.reserve(self.user, Decimal('1.5')))
+        self.assertEqual(ledger.get_available_balance(self.user.id), Decimal('1.0'))
+
+    def test_settle_records_charge(self):
+        reservation = ledger.Reservation.reserve(self.user, Decimal('0.4'))
+        reservation.settle(Decimal('0.1'))
+        self.assertEqual(ledger.get_available_balance(self.user.id), Decimal('0.9'))
+
+        entry = BalanceLedgerEntry.objects.get(kind=LedgerEntryKind.CHARGE)
+        self.assertEqual(entry.amount, Decimal('-0.1'))
+        self.assertFalse(entry.flushed)
+
+    def test_settle_after_release_charges_actual_cost(self):
+        reservation = ledger.Reservation.reserve(self.user, Decimal('0.4'))
+        reservation.release()
+        reservation.settle(Decimal('0.1'))
+        self.assertEqual(ledger.get_available_balance(self.user.id), Decimal('0.9'))
+
+    def test_expired_holds_are_released(self):
+        ledger.Reservation.reserve(self.user, Decimal('0.4'))
+        with patch('main.ledger.time.time', return_value=10 ** 10):
+            ledger.expire_holds()
+        self.assertEqual(ledger.get_available_balance(self.user.id), Decimal('1.0'))
+
+    def test_charge(self):
+        self.assertTrue(ledger.charge(self.user, Decimal('0.3')))
+        self.assertFalse(ledger.charge(self.user, Decimal('0.8')))
+        self.assertEqual(ledger.get_available_balance(self.user.id), Decimal('0.7'))
+
+    def test_cached_balance_counts_unflushed_entries(self):
+        ledger.charge(self.user, Decimal('0.3'))
+        balance_cache.reset(self.user.id)
+        self.assertEqual(ledger.get_available_balance(self.user.id), Decimal('0.7'))
+
+    def test_flush_applies_entries(self):
+        ledger.charge(self.user, Decimal('0.3'))
+        ledger.charge(self.user, Decimal('0.2'))
+
+        self.assertEqual(ledger.flush(), 2)
+        self.user_balance.refresh_from_db()
+        self.assertEqual(self.user_balance.balance, Decimal('0.5'))
+        self.assertFalse(BalanceLedgerEntry.objects.filter(flushed=False).exists())
+        self.assertEqual(ledger.flush(), 0)
+        self.assertEqual(ledger.get_available_balance(self.user.id), Decimal('0.5'))
@@ -0,0 +1,43 @@
+from django.test import TestCase, override_settings
+from unittest.mock import patch
+from .model_registry import get_registry, get_model_spec, DEFAULT_MODEL_SPEC
+from .helpers import calculate_cost, calculate_cost_from_tokens, get_completion_kwargs
+from .models import ChatSession, ChatTemplate
+
+class ModelRegistryTest(TestCase):
+
+    def setUp(self):
+        get_registry.cache_clear()
+        get_model_spec.cache_clear()
+
+    def tearDown(self):
+        get_registry.cache_clear()
+        get_model_spec.cache_clear()
+
+    def test_prefix_match(self):
+        self.assertEqual(get_model_spec('gpt-4-0613').context_window, 8192)
+        self.assertEqual(get_model_spec('gpt-4-32k-0613').context_window, 32768)
+        self.assertEqual(get_model_spec('unknown-model'), DEFAULT_MODEL_SPEC)
+
+    @override_settings(MODEL_SPECS={'gpt-4': {'input_cost': 0.01}, 'custom-model': {'context_window': 128000}})
+    def test_settings_override(self):
+        self.assertEqual(get_model_spec('gpt-4').input_cost, 0.01)
+        self.assertEqual(get_model_spec('gpt-4').output_cost, 0.06)
+        self.assertEqual(get_model_spec('custom-model-1').context_window, 128000)
+
+    def test_cost_depends_on_model(self):
+        self.assertAlmostEqual(calculate_cost_from_tokens(1000, 1000, 'gpt-3.5-turbo-0613')['input_cost'], 0.0015)
+        self.assertAlmostEqual(calculate_cost_from_tokens(1000, 1000, 'gpt-4-0613')['output_cost'], 0.06)
+
+        chat_completion = {'model': 'gpt-4-0613', 'usage': {'prompt_tokens': 1000, 'completion_tokens': 500}}
+        costs = calculate_cost(chat_completion)
+        self.assertAlmostEqual(costs['input_cost'], 0.03)
+        self.assertAlmostEqual(costs['output_cost'], 0.03)
+
+    @override_settings(MODEL_SPECS={'gpt-4': {'max_output_tokens': 4000}})
+    def test_reply_cap_follows_model(self):
+        session = ChatSession(template=ChatTemplate(model='gpt-4-0613', temperature=0.7))
+        with patch('main.helpers.get_functions_as_json', return_value=[]):
+            self.assertEqual(get_completion_kwargs([], 'testuser', session)['max_tokens'], 4000)
+            session.template.model = 'gpt-3.5-turbo'
+            self.assertEqual(get_completion_kwargs([], 'testuser', session)['max_tokens'], 1000)
@@ -4,7 +4,9 @@ from decimal import Decimal
 from django.conf import settings
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from .models import UserBalance, SecretKey, FunctionServer, FunctionSchema, ChatTemplate, ChatSession, ChatMessage, RoleChoices
+from unittest.mock import patch
+from .tokens import num_tokens_from_functions
+from .models import UserBalance, SecretKey, FunctionServer, FunctionSchema, ChatTemplate, ChatSession, ChatMessage, RoleChoices, BalanceLedgerEntry, LedgerEntryKind, FlaggedSessionCount
 
 class UserBalanceTestCase(TestCase):
     
@@ -28,6 +30,20 @@ class UserBalanceTestCase(TestCase):
         with self.assertRaises(ValueError):
             self.user_balance.debit(Decimal('150.0'))
 
+    def test_changes_are_recorded_in_ledger(self):
+        self.user_balance.credit(Decimal('50.0'))
+        self.user_balance.debit(Decimal('20.0'))
+        self.user_balance.reset_balance(Decimal('10.0'))
+
+        entries = BalanceLedgerEntry.objects.filter(user=self.user).order_by('id')
+        self.assertEqual([(entry.kind, entry.amount) for entry in entries], [
+            (LedgerEntryKind.OPENING, Decimal('100.0')),
+            (LedgerEntryKind.CREDIT, Decimal('50.0')),
+            (LedgerEntryKind.CHARGE, Decimal('-20.0')),
+            (LedgerEntryKind.ADJUSTMENT, Decimal('-120.0')),
+        ])
+        self.assertTrue(all(entry.flushed for entry in entries))
+
 class FunctionServerTestCase(TestCase):
     
     def setUp(self):
@@ -161,6 +177,34 @@ class ChatTemplateTestCase(TestCase):
     def test_functions(self):
         self.assertEqual(list(self.chat_template.functions.all()), [self.function_schema])
 
+    def function_token_count(self):
+        return ChatTemplate.objects.get(pk=self.chat_template.pk).function_token_count
+
+    def test_function_token_count_follows_functions(self):
+        self.assertEqual(self.function_token_count(), num_tokens_from_functions([self.function_schema.schema]))
+
+        other = FunctionSchema.objects.create(name='Other Function', user=self.user, schema={"name": "other", "parameters": {}})
+        self.chat_template.functions.add(other)
+        self.assertEqual(self.function_token_count(), num_tokens_from_functions([self.function_schema.schema, other.schema]))
+
+        self.chat_template.functions.remove(self.function_schema)
+        self.assertEqual(self.function_token_count(), num_tokens_from_functions([other.schema]))
+
+        self.chat_template.functions.clear()
+        self.assertEqual(self.function_token_count(), 0)
+
+    def test_function_token_count_follows_schemas(self):
+        self.function_schema.schema = {"name": "test", "description": "A much longer description than before."}
+        self.function_schema.save()
+        self.assertEqual(self.function_token_count(), num_tokens_from_functions([self.function_schema.schema]))
+
+        self.function_schema.chattemplate_set.clear()
+        self.assertEqual(self.function_token_count(), 0)
+
+        self.chat_template.functions.add(self.function_schema)
+        self.function_schema.delete()
+        self.assertEqual(self.function_token_count(), 0)
+
 class ChatSessionTestCase(TestCase):
 
     def setUp(self):
@@ -207,6 +251,40 @@ class ChatSessionTestCase(TestCase):
     def test_function_server(self):
         self.assertEqual(self.chat_session.function_server, self.function_server)
 
+    @patch('main.session_events.send_flagged')
+    def test_flagged_sessions_are_counted(self, mock_send):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chat_session.flagged = True
+            self.chat_session.save(update_fields=['flagged', 'updated_at'])
+        self.assertEqual(FlaggedSessionCount.get(self.user.id), 1)
+        mock_send.assert_called_once_with(self.user.id, self.chat_session.id, 1)
+
+        # Saving again without a change of flag does not count twice.
+        self.chat_session.save()
+        ChatSession.objects.create(user=self.user, template=self.chat_template, title='Other', flagged=True)
+        self.assertEqual(FlaggedSessionCount.get(self.user.id), 2)
+
+        self.chat_session.flagged = False
+        self.chat_session.save()
+        self.assertEqual(FlaggedSessionCount.get(self.user.id), 1)
+
+        ChatSession.objects.filter(title='Other').delete()
+        self.assertEqual(FlaggedSessionCount.get(self.user.id), 0)
+
+    @patch('main.session_events.send_flagged')
+    def test_partial_save_keeps_flag(self, mock_send):
+        stale = ChatSession.objects.get(pk=self.chat_session.pk)
+        self.chat_session.flagged = True
+        self.chat_session.save(update_fields=['flagged', 'updated_at'])
+
+        # A stale copy saving other fields must not clear the flag or the count.
+        stale.summary = 'Summary'
+        stale.save(update_fields=['summary'])
+        self.chat_session.refresh_from_db()
+        self.assertTrue(self.chat_session.flagged)
+        self.assertEqual(self.chat_session.summary, 'Summary')
+        self.assertEqual(FlaggedSessionCount.get(self.user.id), 1)
+
 
 class ChatMessageTestCase(TestCase):
 
@@ -271,4 +349,35 @@ class ChatMessageTestCase(TestCase):
         self.assertEqual(initial_message.role, RoleChoices.SYSTEM)
         self.assertEqual(initial_message.content, new_chat_session.template.system_prompt)
         self.assertEqual(initial_message.input_cost, Decimal('0.0'))
-        self.assertEqual(initial_message.output_cost, Decimal('0.0'))
\ No newline at end of file
+        self.assertEqual(initial_message.output_cost, Decimal('0.0'))
+
+    def test_token_count(self):
+        self.assertGreater(self.chat_message.token_count, 0)
+
+    def test_session_token_count(self):
+        self.chat_session.refresh_from_db()
+        total = sum(message.token_count for message in ChatMessage.objects.filter(session=self.chat_session))
+        self.assertEqual(self.chat_session.token_count, total)
+
+    def test_session_token_count_after_edit_and_delete(self):
+        self.chat_message.content = 'This is a much longer test message than the one before'
+        self.chat_message.save()
+        self.chat_session.refresh_from_db()
+        total = sum(message.token_count for message in ChatMessage.objects.filter(session=self.chat_session))
+        self.assertEqual(self.chat_session.token_count, total)
+
+        self.chat_message.delete()
+        self.chat_session.refresh_from_db()
+        initial_message = ChatMessage.objects.get(session=self.chat_session)
+        self.assertEqual(self.chat_session.token_count, initial_message.token_count)
+
+    def test_cascade_deletes(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.chat_template.delete()
+        self.assertFalse(ChatMessage.objects.filter(pk=self.chat_message.pk).exists())
+
+        ChatSession.objects.create(user=self.user, template=ChatTemplate.objects.create(
+            name='Other', model='GPT-3', temperature=0.7, system_prompt='Hello', user=self.user))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.delete()
+        self.assertFalse(ChatMessage.objects.exists())
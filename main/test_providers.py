@@ -0,0 +1,124 @@
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from unittest.mock import patch, MagicMock
+import openai
+import threading
+import time
+from .models import ChatSession, ChatTemplate
+from .redis_client import get_redis
+from .providers import get_providers, get_request_kwargs, get_latency_percentile, route, record, health_key, latencies_key
+from .tasks import open_chat_completion_stream
+from . import upstream_limit
+
+LLM_PROVIDERS = [
+    {'name': 'local', 'api_base': 'http://vllm:8000/v1', 'models': ['llama']},
+    {'name': 'azure', 'api_type': 'azure', 'api_base': 'https://example.openai.azure.com', 'api_version': '2023-07-01-preview', 'deployments': {'gpt-4': 'gpt4'}},
+]
+
+@override_settings(LLM_PROVIDERS=LLM_PROVIDERS, PROVIDER_FAILURE_THRESHOLD=2)
+class ProvidersTest(TestCase):
+
+    def setUp(self):
+        get_providers.cache_clear()
+        self.addCleanup(get_providers.cache_clear)
+        self.providers = get_providers()
+        for provider in self.providers.values():
+            for model in ['gpt-4', 'llama-2']:
+                get_redis().delete(health_key(provider, model), latencies_key(provider, model), upstream_limit.limit_key(f'{provider.name}:{model}'), upstream_limit.slots_key(f'{provider.name}:{model}'))
+
+    def test_candidates_serve_the_model(self):
+        self.assertEqual({provider.name for provider in route('gpt-4')}, {'openai', 'azure'})
+        self.assertEqual({provider.name for provider in route('llama-2')}, {'openai', 'local', 'azure'})
+
+    def test_request_kwargs(self):
+        self.assertEqual(get_request_kwargs(self.providers['local'], 'llama-2'), {'api_key': 'none', 'api_type': 'open_ai', 'api_base': 'http://vllm:8000/v1'})
+        self.assertEqual(get_request_kwargs(self.providers['azure'], 'gpt-4')['deployment_id'], 'gpt4')
+
+    def test_failing_provider_goes_last(self):
+        record(self.providers['openai'], 'gpt-4')
+        record(self.providers['openai'], 'gpt-4')
+        for i in range(10):
+            self.assertEqual([provider.name for provider in route('gpt-4')], ['azure', 'openai'])
+
+    def test_providers_are_weighted_by_inverse_latency(self):
+        record(self.providers['openai'], 'gpt-4', 0.1)
+        record(self.providers['azure'], 'gpt-4', 10.0)
+        with patch('main.providers.random.choices', side_effect=[[1], [0]]) as mock_choices:
+            self.assertEqual([provider.name for provider in route('gpt-4')], ['azure', 'openai'])
+
+        # openai and azure, in candidate order, then openai alone once azure was drawn.
+        self.assertEqual(mock_choices.call_count, 2)
+        self.assertEqual(mock_choices.call_args_list[0].args[0], range(2))
+        openai_weight, azure_weight = mock_choices.call_args_list[0].kwargs['weights']
+        self.assertAlmostEqual(openai_weight, 10.0)
+        self.assertAlmostEqual(azure_weight, 0.1)
+
+    @patch('main.tasks.get_chat_completion_stream')
+    def test_failed_call_fails_over_to_the_next_provider(self, mock_stream):
+        user = User.objects.create_user(username='testuser', password='testpass')
+        template = ChatTemplate.objects.create(name='Test Template', model='gpt-4', temperature=0.7, system_prompt='Start', user=user)
+        session = ChatSession.objects.create(user=user, template=template, title='Session')
+        mock_stream.side_effect = [openai.error.APIConnectionError('connection refused'), iter([])]
+
+        with patch('main.tasks.providers.route', return_value=[self.providers['openai'], self.providers['azure']]):
+            provider, slot, stream, latency = open_chat_completion_stream([], 'testuser', session)
+
+        self.assertEqual(provider.name, 'azure')
+        self.assertEqual(get_redis().hget(health_key(self.providers['openai'], 'gpt-4'), 'failures'), b'1')
+
+    @patch('main.tasks.get_chat_completion_stream', side_effect=openai.error.InvalidRequestError('bad request', 'messages'))
+    def test_request_errors_do_not_fail_over(self, mock_stream):
+        user = User.objects.create_user(username='testuser', password='testpass')
+        template = ChatTemplate.objects.create(name='Test Template', model='gpt-4', temperature=0.7, system_prompt='Start', user=user)
+        session = ChatSession.objects.create(user=user, template=template, title='Session')
+
+        with self.assertRaises(openai.error.InvalidRequestError):
+            open_chat_completion_stream([], 'testuser', session)
+        self.assertEqual(mock_stream.call_count, 1)
+
+    def test_latency_percentile(self):
+        for latency in range(1, 11):
+            record(self.providers['openai'], 'gpt-4', latency / 10)
+        self.assertIsNone(get_latency_percentile(self.providers['openai'], 'gpt-4', 90, 20))
+        self.assertEqual(get_latency_percentile(self.providers['openai'], 'gpt-4', 90, 10), 1.0)
+
+    @override_settings(HEDGE_MIN_DELAY=0.05, HEDGE_MIN_SAMPLES=5)
+    @patch('main.tasks.get_chat_completion_stream')
+    def test_slow_call_is_hedged(self, mock_stream):
+        user = User.objects.create_user(username='testuser', password='testpass')
+        template = ChatTemplate.objects.create(name='Test Template', model='gpt-4', temperature=0.7, system_prompt='Start', user=user)
+        session = ChatSession.objects.create(user=user, template=template, title='Session')
+        for i in range(5):
+            record(self.providers['openai'], 'gpt-4', 0.05)
+
+        stalled = threading.Event()
+        slow_stream = MagicMock()
+        def start(messages, username, session, provider):
+            if provider.name == 'openai':
+                stalled.wait(5)
+                return slow_stream
+            return iter([])
+        mock_stream.side_effect = start
+
+        with patch('main.tasks.providers.route', return_value=[self.providers['openai'], self.providers['azure']]):
+            provider, slot, stream, latency = open_chat_completion_stream([], 'testuser', session, hedge=True)
+        self.assertEqual(provider.name, 'azure')
+
+        stalled.set()
+        for i in range(50):
+            if slow_stream.close.called:
+                break
+            time.sleep(0.1)
+        slow_stream.close.assert_called_once()
+
+    @override_settings(HEDGE_MIN_SAMPLES=5)
+    @patch('main.tasks.get_chat_completion_stream', return_value=iter([]))
+    def test_no_hedging_without_latency_history(self, mock_stream):
+        user = User.objects.create_user(username='testuser', password='testpass')
+        template = ChatTemplate.objects.create(name='Test Template', model='gpt-4', temperature=0.7, system_prompt='Start', user=user)
+        session = ChatSession.objects.create(user=user, template=template, title='Session')
+
+        with patch('main.tasks.providers.route', return_value=[self.providers['openai'], self.providers['azure']]):
+            provider, slot, stream, latency = open_chat_completion_stream([], 'testuser', session, hedge=True)
+        self.assertEqual(provider.name, 'openai')
+        self.assertEqual(mock_stream.call_count, 1)
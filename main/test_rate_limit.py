@@ -0,0 +1,53 @@
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User, Group
+from unittest.mock import patch
+import redis
+from .redis_client import get_redis
+from . import rate_limit
+
+LIMITS = {'requests_per_minute': 2, 'tokens_per_minute': 100, 'max_in_flight': 1, 'priority': 6}
+
+class RateLimitTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        get_redis().delete(rate_limit.bucket_key(self.user.id), rate_limit.in_flight_key(self.user.id))
+
+    def test_in_flight_cap(self):
+        self.assertIsNone(rate_limit.admit(self.user.id, 'turn1', LIMITS))
+        self.assertEqual(rate_limit.admit(self.user.id, 'turn2', LIMITS), 'in_flight')
+
+        rate_limit.release(self.user.id, 'turn1', 10)
+        self.assertIsNone(rate_limit.admit(self.user.id, 'turn2', LIMITS))
+
+    def test_request_bucket(self):
+        limits = {**LIMITS, 'max_in_flight': 10}
+        self.assertIsNone(rate_limit.admit(self.user.id, 'turn1', limits))
+        self.assertIsNone(rate_limit.admit(self.user.id, 'turn2', limits))
+        self.assertEqual(rate_limit.admit(self.user.id, 'turn3', limits), 'requests')
+
+        with patch('main.rate_limit.time.time', return_value=rate_limit.time.time() + 30):
+            self.assertIsNone(rate_limit.admit(self.user.id, 'turn4', limits))
+
+    def test_token_bucket(self):
+        rate_limit.admit(self.user.id, 'turn1', LIMITS)
+        rate_limit.release(self.user.id, 'turn1', 150)
+        self.assertEqual(rate_limit.admit(self.user.id, 'turn2', LIMITS), 'tokens')
+
+        with patch('main.rate_limit.time.time', return_value=rate_limit.time.time() + 60):
+            self.assertIsNone(rate_limit.admit(self.user.id, 'turn2', LIMITS))
+
+    def test_expired_turns_free_their_slot(self):
+        rate_limit.admit(self.user.id, 'turn1', LIMITS)
+        with patch('main.rate_limit.time.time', return_value=rate_limit.time.time() + 61):
+            self.assertIsNone(rate_limit.admit(self.user.id, 'turn2', LIMITS))
+
+    @patch('main.rate_limit.get_script', side_effect=redis.ConnectionError)
+    def test_fails_open(self, mock_get_script):
+        self.assertIsNone(rate_limit.admit(self.user.id, 'turn1', LIMITS))
+
+    @override_settings(USER_TIERS={'pro': {**LIMITS, 'max_in_flight': 5}, 'default': LIMITS})
+    def test_user_tier(self):
+        self.assertEqual(rate_limit.get_user_tier(self.user), LIMITS)
+        self.user.groups.add(Group.objects.create(name='pro'))
+        self.assertEqual(rate_limit.get_user_tier(self.user)['max_in_flight'], 5)
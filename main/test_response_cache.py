@@ -0,0 +1,63 @@
+from django.test import TestCase
+from django.contrib.auth.models import User
+from unittest.mock import patch
+from decimal import Decimal
+from .models import ChatSession, ChatTemplate, UserBalance
+from .redis_client import get_cache_redis
+from .tasks import openai_api_call
+from . import balance_cache, response_cache
+
+def make_chunk(delta):
+    return {'choices': [{'delta': delta}]}
+
+class ResponseCacheTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        UserBalance.objects.create(user=self.user, balance=Decimal('1.0'))
+        balance_cache.reset(self.user.id)
+        self.template = ChatTemplate.objects.create(
+            name='Test Template',
+            model='gpt-3.5-turbo',
+            temperature=0,
+            system_prompt='Start',
+            user=self.user,
+            cache_responses=True,
+        )
+        messages = [{'role': 'system', 'content': 'Start'}, {'role': 'user', 'content': 'Hello'}]
+        get_cache_redis().delete(response_cache.get_key(self.template, messages, []), response_cache.METRICS_KEY)
+
+    def test_key_is_canonical(self):
+        messages = [{'role': 'user', 'content': 'Hello'}]
+        self.assertEqual(
+            response_cache.get_key(self.template, messages, []),
+            response_cache.get_key(self.template, [{'content': 'Hello', 'role': 'user'}], []),
+        )
+        self.assertNotEqual(
+            response_cache.get_key(self.template, messages, []),
+            response_cache.get_key(self.template, messages, [{'name': 'get_weather'}]),
+        )
+
+    def test_only_deterministic_templates_are_cached(self):
+        self.assertTrue(response_cache.is_cacheable(self.template))
+        self.template.temperature = 0.7
+        self.assertFalse(response_cache.is_cacheable(self.template))
+
+    @patch('main.tasks.moderate_texts', return_value=[False])
+    @patch('main.tasks.send_message')
+    @patch('main.tasks.get_chat_completion_stream')
+    def test_repeated_question_is_answered_from_cache(self, mock_stream, mock_send, mock_moderate):
+        mock_stream.return_value = iter([make_chunk({'role': 'assistant'}), make_chunk({'content': 'Hi there'})])
+        first = ChatSession.objects.create(user=self.user, template=self.template, title='First')
+        second = ChatSession.objects.create(user=self.user, template=self.template, title='Second')
+
+        openai_api_call(first.id, self.user.id, {'content': 'Hello'})
+        openai_api_call(second.id, self.user.id, {'content': 'Hello'})
+
+        self.assertEqual(mock_stream.call_count, 1)
+        reply = second.messages.get(role='assistant')
+        self.assertEqual(reply.content, 'Hi there')
+        self.assertEqual((reply.input_cost, reply.output_cost), (Decimal('0'), Decimal('0')))
+        self.assertGreater(first.messages.get(role='assistant').output_cost, 0)
+        mock_send.assert_any_call(second.id, {'role': 'assistant', 'delta': 'Hi there'})
+        self.assertEqual(response_cache.get_metrics()[self.template.id], {'hits': 1, 'misses': 1})
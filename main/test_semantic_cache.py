@@ -0,0 +1,57 @@
+from django.test import TestCase, override_settings
+from django.contrib.auth.models import User
+from unittest import skipUnless
+from unittest.mock import patch
+import tempfile
+from .models import ChatTemplate
+from . import semantic_cache
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+WORDS = ['capital', 'weather', 'one', 'two', 'three']
+
+def fake_embed(text):
+    # Prompts starting with the same word mean the same.
+    vector = numpy.zeros(len(WORDS), dtype=numpy.float32)
+    vector[WORDS.index(text.split()[0].lower())] = 1
+    return vector
+
+REPLY = {'role': 'assistant', 'content': 'Paris', 'function_call': None, 'output_tokens': 1}
+
+@skipUnless(numpy is not None, 'numpy is not installed')
+@patch('main.semantic_cache.embed', fake_embed)
+class SemanticCacheTest(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.enterContext(override_settings(SEMANTIC_CACHE_DIR=directory.name, SEMANTIC_CACHE_MAX_ENTRIES=2))
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.template = ChatTemplate.objects.create(name='Test Template', model='gpt-3.5-turbo', temperature=0.7, system_prompt='Start', user=self.user, semantic_cache=True)
+        self.addCleanup(semantic_cache.clear, self.template.id)
+
+    def test_similar_prompt_gets_the_cached_reply(self):
+        reply, vector = semantic_cache.search(self.template, 'Capital of France?')
+        self.assertIsNone(reply)
+        semantic_cache.add(self.template, vector, REPLY)
+
+        self.assertEqual(semantic_cache.search(self.template, 'capital city of France, please')[0], REPLY)
+        self.assertIsNone(semantic_cache.search(self.template, 'Weather in Paris?')[0])
+
+    def test_full_index_takes_no_new_entries(self):
+        for prompt in ['one', 'two', 'three']:
+            reply, vector = semantic_cache.search(self.template, prompt)
+            semantic_cache.add(self.template, vector, {**REPLY, 'content': prompt})
+
+        self.assertEqual(semantic_cache.search(self.template, 'two')[0]['content'], 'two')
+        self.assertIsNone(semantic_cache.search(self.template, 'three')[0])
+
+    def test_clear_starts_a_new_index(self):
+        reply, vector = semantic_cache.search(self.template, 'Capital of France?')
+        semantic_cache.add(self.template, vector, REPLY)
+
+        self.assertEqual(semantic_cache.clear(self.template.id), 1)
+        self.assertIsNone(semantic_cache.search(self.template, 'Capital of France?')[0])
@@ -0,0 +1,47 @@
+from django.test import TestCase, override_settings
+from unittest.mock import patch
+import redis
+from .redis_client import get_redis
+from . import session_lock
+
+class SessionLockTest(TestCase):
+
+    def setUp(self):
+        get_redis().delete(session_lock.lock_key(1), session_lock.queue_key(1))
+
+    def tearDown(self):
+        get_redis().delete(session_lock.lock_key(1), session_lock.queue_key(1))
+
+    def test_single_flight(self):
+        self.assertIsNone(session_lock.acquire(1, 'turn1', {'invoke_ai': True}))
+        self.assertEqual(session_lock.acquire(1, 'turn2', {'invoke_ai': True}), 'duplicate')
+        self.assertEqual(session_lock.acquire(1, 'turn3', {'invoke_function': True}), 'busy')
+
+        self.assertIsNone(session_lock.release(1, 'turn1'))
+        self.assertIsNone(session_lock.acquire(1, 'turn3', {'invoke_function': True}))
+
+    def test_release_by_other_turn_is_ignored(self):
+        session_lock.acquire(1, 'turn1', {'invoke_ai': True})
+        session_lock.release(1, 'turn2')
+        self.assertEqual(session_lock.acquire(1, 'turn3', {'invoke_function': True}), 'busy')
+
+    def test_messages_are_queued_for_a_follow_up_turn(self):
+        session_lock.acquire(1, 'turn1', {'invoke_ai': True})
+        self.assertEqual(session_lock.acquire(1, 'turn2', {'content': 'first'}), 'queued')
+        self.assertEqual(session_lock.acquire(1, 'turn3', {'content': 'second'}), 'queued')
+
+        follow_up_turn_id, queued = session_lock.release(1, 'turn1')
+        self.assertEqual(queued, ['first', 'second'])
+        self.assertEqual(session_lock.acquire(1, 'turn4', {'invoke_ai': True}), 'busy')
+        self.assertIsNone(session_lock.release(1, follow_up_turn_id))
+        self.assertIsNone(session_lock.acquire(1, 'turn4', {'invoke_ai': True}))
+
+    @override_settings(SESSION_QUEUE_MAX_MESSAGES=1)
+    def test_queue_is_bounded(self):
+        session_lock.acquire(1, 'turn1', {'invoke_ai': True})
+        self.assertEqual(session_lock.acquire(1, 'turn2', {'content': 'first'}), 'queued')
+        self.assertEqual(session_lock.acquire(1, 'turn3', {'content': 'second'}), 'busy')
+
+    @patch('main.session_lock.get_script', side_effect=redis.ConnectionError)
+    def test_fails_open(self, mock_get_script):
+        self.assertIsNone(session_lock.acquire(1, 'turn1', {'invoke_ai': True}))
@@ -0,0 +1,267 @@
+from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.db import connection
+from celery.signals import task_postrun
+from celery.exceptions import Retry
+import openai
+import threading
+from concurrent.futures import Future
+from django.contrib.auth.models import User
+from unittest.mock import patch
+from decimal import Decimal
+from .models import ChatSession, ChatTemplate, ChatMessage, UserBalance, FunctionSchema
+from .helpers import get_chat_history, estimate_cost
+from . import balance_cache, ledger
+from .tasks import stream_chat_completion, summarize_session, summary_unfunded_key, prepare_turn, openai_api_call, release_db_connections
+
+def make_chunk(delta):
+    return {'choices': [{'delta': delta}]}
+
+class StreamChatCompletionTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.template = ChatTemplate.objects.create(
+            name='Test Template',
+            model='gpt-3.5-turbo',
+            temperature=0.7,
+            system_prompt='Start',
+            user=self.user
+        )
+        self.session = ChatSession.objects.create(user=self.user, template=self.template, title='Session')
+
+    @patch('main.tasks.send_message')
+    @patch('main.tasks.get_chat_completion_stream')
+    def test_content_deltas_are_forwarded(self, mock_stream, mock_send):
+        mock_stream.return_value = iter([
+            make_chunk({'role': 'assistant'}),
+            make_chunk({'content': 'Hello'}),
+            make_chunk({'content': ' world'}),
+            make_chunk({}),
+        ])
+
+        response = stream_chat_completion(self.session.id, [], 'testuser', self.session, 10)
+
+        self.assertEqual(response['role'], 'assistant')
+        self.assertEqual(response['content'], 'Hello world')
+        self.assertIsNone(response['function_call'])
+        self.assertEqual(mock_send.call_count, 2)
+        mock_send.assert_any_call(self.session.id, {'role': 'assistant', 'delta': 'Hello'})
+        self.assertGreater(response['costs']['output_cost'], 0)
+
+    @patch('main.tasks.send_message')
+    @patch('main.tasks.get_chat_completion_stream')
+    def test_function_call_is_assembled(self, mock_stream, mock_send):
+        mock_stream.return_value = iter([
+            make_chunk({'role': 'assistant', 'content': None, 'function_call': {'name': 'get_weather', 'arguments': ''}}),
+            make_chunk({'function_call': {'arguments': '{"city": '}}),
+            make_chunk({'function_call': {'arguments': '"Paris"}'}}),
+        ])
+
+        response = stream_chat_completion(self.session.id, [], 'testuser', self.session, 10)
+
+        self.assertEqual(response['function_call'], {'name': 'get_weather', 'arguments': '{"city": "Paris"}'})
+        mock_send.assert_not_called()
+
+    @patch('main.tasks.send_message')
+    @patch('main.tasks.get_chat_completion_stream')
+    def test_nothing_is_shown_for_flagged_input(self, mock_stream, mock_send):
+        def chunks():
+            yield make_chunk({'role': 'assistant'})
+            yield make_chunk({'content': 'Hello'})
+            yield make_chunk({'content': ' world'})
+        moderation = Future()
+        moderation.set_result([True])
+        mock_stream.return_value = chunks()
+
+        response = stream_chat_completion(self.session.id, [], 'testuser', self.session, 10, moderation)
+
+        mock_send.assert_not_called()
+        self.assertEqual(response['content'], 'Hello')
+
+        moderation = Future()
+        moderation.set_result([False])
+        mock_stream.return_value = chunks()
+        stream_chat_completion(self.session.id, [], 'testuser', self.session, 10, moderation)
+        self.assertEqual(mock_send.call_count, 2)
+
+@override_settings(
+    CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}},
+    SUMMARY_KEEP_RECENT_FRACTION=0.13,
+    SUMMARY_MAX_INPUT_FRACTION=1.0,
+)
+@patch('main.tasks.get_prompt_budget', return_value=100)
+class SummarizeSessionTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        UserBalance.objects.create(user=self.user, balance=Decimal('1.0'))
+        balance_cache.reset(self.user.id)
+        self.template = ChatTemplate.objects.create(
+            name='Test Template',
+            model='gpt-3.5-turbo',
+            temperature=0.7,
+            system_prompt='Start',
+            user=self.user
+        )
+        self.session = ChatSession.objects.create(user=self.user, template=self.template, title='Session')
+        for content in ['first question', 'first answer', 'second question', 'second answer']:
+            ChatMessage.objects.create(session=self.session, role='user', content=content)
+
+    @patch('main.tasks.get_summary_completion')
+    def test_aged_out_messages_are_replaced_by_summary(self, mock_summary, mock_budget):
+        mock_summary.return_value = {
+            'chat_completion': {'choices': [{'message': {'role': 'assistant', 'content': 'The user asked things.'}}]},
+            'costs': {'input_cost': 0.0001, 'output_cost': 0.0001},
+        }
+
+        summarize_session(self.session.id)
+
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.summary, 'The user asked things.')
+        transcript = mock_summary.call_args.args[0][1]['content']
+        self.assertIn('first question', transcript)
+        self.assertNotIn('second answer', transcript)
+
+        history = [message for message, token_count in get_chat_history(self.session)]
+        self.assertEqual(history[0]['content'], 'Start')
+        self.assertEqual(history[1], self.session.summary_message())
+        self.assertEqual([message['content'] for message in history[2:]], ['second question', 'second answer'])
+
+    @patch('main.tasks.get_summary_completion')
+    def test_summary_is_skipped_when_user_cannot_pay(self, mock_summary, mock_budget):
+        UserBalance.objects.filter(user=self.user).update(balance=Decimal('0.0'))
+        balance_cache.reset(self.user.id)
+        self.addCleanup(cache.delete, summary_unfunded_key(self.session.id))
+
+        summarize_session(self.session.id)
+
+        mock_summary.assert_not_called()
+        self.session.refresh_from_db()
+        self.assertEqual(self.session.summary, '')
+        self.assertTrue(cache.get(summary_unfunded_key(self.session.id)))
+
+@override_settings(CACHE_REDIS_URL='redis://127.0.0.1:1/0')
+class PrepareTurnTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        UserBalance.objects.create(user=self.user, balance=Decimal('1.0'))
+        balance_cache.reset(self.user.id)
+        self.template = ChatTemplate.objects.create(
+            name='Test Template',
+            model='gpt-3.5-turbo',
+            temperature=0.7,
+            system_prompt='Start',
+            user=self.user
+        )
+        self.session = ChatSession.objects.create(user=self.user, template=self.template, title='Session')
+
+    @patch('main.tasks.moderate_texts', return_value=[False])
+    @patch('main.tasks.send_message')
+    def test_user_message_is_recorded(self, mock_send, mock_moderate):
+        turn = prepare_turn(self.session.id, self.user.id, {'content': 'Hello'})
+
+        self.assertEqual(turn['messages'], [{'role': 'system', 'content': 'Start'}, {'role': 'user', 'content': 'Hello'}])
+        self.assertEqual(turn['input_tokens'], sum(message.token_count for message in self.session.messages.all()) + 3)
+        self.assertTrue(self.session.messages.filter(role='user', content='Hello').exists())
+        mock_send.assert_called_once_with(self.session.id, {'role': 'user', 'content': 'Hello'})
+        self.assertEqual(turn['user_moderation'].result(), [False])
+        self.assertEqual(turn['reservation'].amount, estimate_cost(turn['input_tokens'], 1000, model='gpt-3.5-turbo'))
+
+    @patch('main.tasks.moderate_texts', return_value=[False])
+    @patch('main.tasks.send_message')
+    def test_queued_messages_are_answered_together(self, mock_send, mock_moderate):
+        turn = prepare_turn(self.session.id, self.user.id, {'queued': ['first', 'second']})
+
+        self.assertEqual(turn['messages'][1:], [{'role': 'user', 'content': 'first'}, {'role': 'user', 'content': 'second'}])
+        self.assertEqual(list(self.session.messages.filter(role='user').values_list('content', flat=True)), ['first', 'second'])
+        self.assertEqual(turn['user_message']['content'], 'first\n\nsecond')
+
+    @patch('main.tasks.moderate_texts', return_value=[False])
+    @patch('main.tasks.send_message')
+    def test_function_schemas_are_counted(self, mock_send, mock_moderate):
+        function = FunctionSchema.objects.create(name='lookup', user=self.user, schema={'name': 'lookup', 'parameters': {'type': 'object', 'properties': {}}})
+        self.template.functions.add(function)
+        function_token_count = ChatTemplate.objects.get(pk=self.template.pk).function_token_count
+        self.assertGreater(function_token_count, 0)
+
+        turn = prepare_turn(self.session.id, self.user.id, {'content': 'Hello'})
+
+        self.assertEqual(turn['input_tokens'], sum(message.token_count for message in self.session.messages.all()) + function_token_count + 3)
+
+    @patch('main.tasks.moderate_texts', return_value=[False])
+    @patch('main.tasks.send_message')
+    def test_parallel_turns_cannot_overdraw(self, mock_send, mock_moderate):
+        # Enough for one turn with a full-length reply, but not for two.
+        UserBalance.objects.filter(user=self.user).update(balance=estimate_cost(100, model='gpt-3.5-turbo') * Decimal('1.5'))
+        balance_cache.reset(self.user.id)
+        other_session = ChatSession.objects.create(user=self.user, template=self.template, title='Other')
+
+        self.assertIsNotNone(prepare_turn(self.session.id, self.user.id, {'content': 'Hello'}))
+        self.assertIsNone(prepare_turn(other_session.id, self.user.id, {'content': 'Hello'}))
+        self.assertIn('Insufficient balance', mock_send.call_args.args[1]['content'])
+
+    @patch('main.tasks.send_message')
+    def test_insufficient_balance(self, mock_send):
+        UserBalance.objects.filter(user=self.user).update(balance=Decimal('0.0'))
+
+        self.assertIsNone(prepare_turn(self.session.id, self.user.id, {'invoke_ai': True}))
+        self.assertIn('Insufficient balance', mock_send.call_args.args[1]['content'])
+
+class UpstreamOverloadTest(TestCase):
+
+    def setUp(self):
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        UserBalance.objects.create(user=self.user, balance=Decimal('1.0'))
+        balance_cache.reset(self.user.id)
+        self.template = ChatTemplate.objects.create(
+            name='Test Template',
+            model='gpt-3.5-turbo',
+            temperature=0.7,
+            system_prompt='Start',
+            user=self.user
+        )
+        self.session = ChatSession.objects.create(user=self.user, template=self.template, title='Session')
+
+    @patch('main.tasks.release_turn')
+    @patch('main.tasks.openai_api_call.retry', side_effect=Retry)
+    @patch('main.tasks.get_chat_completion_stream', side_effect=openai.error.RateLimitError('slow down'))
+    @patch('main.tasks.moderate_texts', return_value=[False])
+    @patch('main.tasks.send_message')
+    def test_rate_limited_turn_is_retried_without_recording_input_again(self, mock_send, mock_moderate, mock_stream, mock_retry, mock_release_turn):
+        with self.assertRaises(Retry), self.captureOnCommitCallbacks(execute=True):
+            openai_api_call(self.session.id, self.user.id, {'content': 'Hello'}, 'turn1')
+
+        mock_release_turn.assert_not_called()
+        self.assertEqual(mock_retry.call_args.kwargs['args'], (self.session.id, self.user.id, {'resume': 'Hello'}, 'turn1'))
+        self.assertEqual(ledger.get_available_balance(self.user.id), Decimal('1.0'))
+
+        turn = prepare_turn(self.session.id, self.user.id, {'resume': 'Hello'})
+        self.assertEqual(turn['messages'], [{'role': 'system', 'content': 'Start'}, {'role': 'user', 'content': 'Hello'}])
+
+class DatabaseConnectionLifecycleTest(TestCase):
+
+    def run_in_thread(self, target):
+        result = {}
+        thread = threading.Thread(target=lambda: result.update(target()))
+        thread.start()
+        thread.join()
+        return result
+
+    def test_release_closes_only_the_calling_threads_connection(self):
+        def target():
+            User.objects.exists()
+            with patch.object(connection, 'close', wraps=connection.close) as mock_close:
+                release_db_connections()
+            return {'closed': mock_close.called}
+
+        User.objects.exists()
+        with patch.object(connection, 'close') as mock_main_close:
+            self.assertEqual(self.run_in_thread(target), {'closed': True})
+        mock_main_close.assert_not_called()
+
+    @patch('main.tasks.close_old_connections')
+    def test_connections_are_closed_after_each_task(self, mock_close):
+        task_postrun.send(sender=openai_api_call, task_id='1', task=openai_api_call, args=(), kwargs={}, retval=None, state='SUCCESS')
+        mock_close.assert_called_once_with()
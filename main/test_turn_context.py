@@ -0,0 +1,50 @@
+from django.test import TestCase
+from django.contrib.auth.models import User
+from .models import ChatSession, ChatTemplate, FunctionSchema, FunctionServer
+from .turn_context import TurnContext, template_functions_cache
+
+class TurnContextTest(TestCase):
+
+    def setUp(self):
+        template_functions_cache.clear()
+        self.user = User.objects.create_user(username='testuser', password='testpass')
+        self.function = FunctionSchema.objects.create(name='get_weather', user=self.user, schema={'name': 'get_weather'})
+        self.template = ChatTemplate.objects.create(
+            name='Test Template',
+            model='gpt-3.5-turbo',
+            temperature=0.7,
+            system_prompt='Start',
+            user=self.user
+        )
+        self.template.functions.add(self.function)
+        self.function_server = FunctionServer.objects.create(name='Server', hostname='http://server', is_public=True)
+        self.session = ChatSession.objects.create(user=self.user, template=self.template, title='Session', function_server=self.function_server)
+
+    def test_load(self):
+        context = TurnContext.load(self.session.id)
+
+        self.assertEqual(context.session, self.session)
+        self.assertEqual(context.user, self.user)
+        self.assertEqual(context.function_server, self.function_server)
+        self.assertEqual(context.get_function('get_weather'), self.function)
+        self.assertIsNone(context.get_function('missing'))
+
+    def test_load_uses_one_query_once_functions_are_cached(self):
+        TurnContext.load(self.session.id)
+        with self.assertNumQueries(1):
+            context = TurnContext.load(self.session.id)
+            context.get_function('get_weather').secrets.all()[:]
+
+    def test_function_changes_invalidate_the_cache(self):
+        TurnContext.load(self.session.id)
+
+        other_function = FunctionSchema.objects.create(name='get_time', user=self.user, schema={'name': 'get_time'})
+        self.template.functions.add(other_function)
+        self.assertEqual(TurnContext.load(self.session.id).get_function('get_time'), other_function)
+
+        other_function.schema = {'name': 'get_time', 'description': 'Current time'}
+        other_function.save()
+        self.assertEqual(TurnContext.load(self.session.id).get_function('get_time').schema['description'], 'Current time')
+
+        other_function.chattemplate_set.clear()
+        self.assertIsNone(TurnContext.load(self.session.id).get_function('get_time'))
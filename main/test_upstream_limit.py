@@ -0,0 +1,68 @@
+from django.test import TestCase, override_settings
+from unittest.mock import patch
+import openai
+import redis
+from .redis_client import get_redis
+from . import upstream_limit
+
+CONCURRENCY = {'initial': 2, 'min': 1, 'max': 4, 'decrease_factor': 0.5, 'latency_tolerance': 2.0, 'decrease_cooldown': 5}
+MODEL = 'test-model'
+
+def current_limit():
+    return float(get_redis().hget(upstream_limit.limit_key(MODEL), 'limit'))
+
+@override_settings(UPSTREAM_CONCURRENCY=CONCURRENCY)
+class UpstreamLimitTest(TestCase):
+
+    def setUp(self):
+        get_redis().delete(upstream_limit.limit_key(MODEL), upstream_limit.slots_key(MODEL))
+
+    def test_calls_beyond_the_limit_are_refused(self):
+        first = upstream_limit.acquire(MODEL)
+        self.assertIsNotNone(upstream_limit.acquire(MODEL))
+        self.assertIsNone(upstream_limit.acquire(MODEL))
+
+        upstream_limit.release(first)
+        self.assertIsNotNone(upstream_limit.acquire(MODEL))
+
+    def test_successes_raise_the_limit(self):
+        for i in range(2):
+            upstream_limit.release(upstream_limit.acquire(MODEL), 'success', 1.0)
+        self.assertAlmostEqual(current_limit(), 2.9)
+
+        for i in range(20):
+            upstream_limit.release(upstream_limit.acquire(MODEL), 'success', 1.0)
+        self.assertEqual(current_limit(), 4)
+
+    def test_overloads_cut_the_limit_once_per_cooldown(self):
+        upstream_limit.release(upstream_limit.acquire(MODEL), 'overload')
+        upstream_limit.release(upstream_limit.acquire(MODEL), 'overload')
+        self.assertEqual(current_limit(), 1)
+        self.assertIsNotNone(upstream_limit.acquire(MODEL))
+        self.assertIsNone(upstream_limit.acquire(MODEL))
+
+    def test_rising_latency_counts_as_an_overload(self):
+        upstream_limit.release(upstream_limit.acquire(MODEL), 'success', 1.0)
+        upstream_limit.release(upstream_limit.acquire(MODEL), 'success', 3.0)
+        self.assertEqual(current_limit(), 1.25)
+
+    def test_expired_slots_are_reclaimed(self):
+        upstream_limit.acquire(MODEL)
+        upstream_limit.acquire(MODEL)
+        with patch('main.upstream_limit.time.time', return_value=upstream_limit.time.time() + 61):
+            self.assertIsNotNone(upstream_limit.acquire(MODEL))
+
+    @patch('main.upstream_limit.get_script', side_effect=redis.ConnectionError)
+    def test_fails_open(self, mock_get_script):
+        self.assertIsNotNone(upstream_limit.acquire(MODEL))
+
+    def test_is_overload(self):
+        self.assertTrue(upstream_limit.is_overload(openai.error.RateLimitError('slow down')))
+        self.assertTrue(upstream_limit.is_overload(openai.error.APIError('bad gateway', http_status=502)))
+        self.assertFalse(upstream_limit.is_overload(openai.error.InvalidRequestError('bad request', 'messages')))
+
+    @override_settings(UPSTREAM_RETRY_BASE_DELAY=1, UPSTREAM_RETRY_MAX_DELAY=8)
+    def test_retry_delay_is_jittered_and_capped(self):
+        delays = [upstream_limit.retry_delay(10) for i in range(100)]
+        self.assertTrue(all(0 <= delay <= 8 for delay in delays))
+        self.assertGreater(len(set(delays)), 1)
@@ -0,0 +1,39 @@
+import json
+import tiktoken
+from functools import lru_cache
+from .model_registry import get_model_spec
+
+DEFAULT_MODEL = "gpt-3.5-turbo-16k-0613"
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+REPLY_PRIMING_TOKENS = 3  # every reply is primed with <|start|>assistant<|message|>
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """Return the tiktoken encoding for model, resolved once per process."""
+    return tiktoken.get_encoding(get_model_spec(model).tokenizer)
+
+def num_tokens_from_string(string, model=DEFAULT_MODEL):
+    """Return the number of tokens in a text string."""
+    return len(get_encoding(model).encode(string))
+
+def num_tokens_from_message(message, model=DEFAULT_MODEL):
+    """Return the number of tokens a single message adds to a prompt."""
+    encoding = get_encoding(model)
+
+    num_tokens = TOKENS_PER_MESSAGE
+    for key, value in message.items():
+        num_tokens += len(encoding.encode(value))
+        if key == "name":
+            num_tokens += TOKENS_PER_NAME
+    return num_tokens
+
+def num_tokens_from_functions(functions, model=DEFAULT_MODEL):
+    """Return the number of tokens a list of function schemas adds to a prompt.
+
+    The API rewrites the schemas into a terser form than JSON, so counting their JSON
+    errs on the high side.
+    """
+    if not functions:
+        return 0
+    return num_tokens_from_string(json.dumps(functions), model)
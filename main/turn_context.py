@@ -0,0 +1,37 @@
+from .models import ChatSession
+
+# template id -> (template.updated_at, [FunctionSchema]). Entries are replaced
+# whenever the template's updated_at moves, which the model signals bump on any
+# change to the template's functions or their secrets.
+template_functions_cache = {}
+
+def get_template_functions(template):
+    """Return the template's function schemas (with their secrets), cached in-process."""
+    cached = template_functions_cache.get(template.id)
+    if cached is not None and cached[0] == template.updated_at:
+        return cached[1]
+
+    functions = list(template.functions.prefetch_related('secrets').order_by('id'))
+    template_functions_cache[template.id] = (template.updated_at, functions)
+    return functions
+
+class TurnContext:
+    """The session, user, template, functions and function server a turn works with, loaded together."""
+
+    def __init__(self, session):
+        self.session = session
+        self.user = session.user
+        self.template = session.template
+        self.function_server = session.function_server
+        self.functions = get_template_functions(session.template)
+
+    @classmethod
+    def load(cls, session_id):
+        # The balance is not loaded here: turns reserve their cost through the ledger.
+        return cls(ChatSession.objects.select_related('user', 'template', 'function_server').get(id=session_id))
+
+    def get_function(self, name):
+        for function in self.functions:
+            if function.name == name:
+                return function
+        return None
@@ -0,0 +1,115 @@
+import random
+import time
+import uuid
+from collections import namedtuple
+from functools import lru_cache
+import openai
+import redis
+from django.conf import settings
+from .redis_client import get_redis
+
+# Slots not given back by their deadline (a worker died mid-call) are reclaimed.
+ACQUIRE = """
+redis.call('ZREMRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+local limit = tonumber(redis.call('HGET', KEYS[1], 'limit') or ARGV[4])
+if redis.call('ZCARD', KEYS[2]) >= math.floor(limit) then return 0 end
+redis.call('ZADD', KEYS[2], ARGV[3], ARGV[2])
+return 1
+"""
+
+# Additive increase, multiplicative decrease: every success adds 1/limit, so the limit
+# grows by one per round of successful calls, and an overload multiplies it by
+# ARGV[8]. A call whose time to first response is more than ARGV[9] times the moving
+# average counts as an overload. Decreases are at most one per ARGV[10] seconds, so a
+# burst of failures from the same overload only cuts the limit once.
+RELEASE = """
+redis.call('ZREM', KEYS[2], ARGV[2])
+if ARGV[3] == '' then return 0 end
+
+local now = tonumber(ARGV[1])
+local state = redis.call('HMGET', KEYS[1], 'limit', 'latency', 'decreased_at')
+local limit = tonumber(state[1] or ARGV[7])
+local average = tonumber(state[2])
+local overloaded = ARGV[3] == 'overload'
+local latency = tonumber(ARGV[4])
+
+if latency then
+    if average and latency > average * tonumber(ARGV[9]) then overloaded = true end
+    average = average and average + 0.1 * (latency - average) or latency
+    redis.call('HSET', KEYS[1], 'latency', average)
+end
+
+if overloaded then
+    if not state[3] or now - tonumber(state[3]) >= tonumber(ARGV[10]) then
+        limit = math.max(tonumber(ARGV[5]), limit * tonumber(ARGV[8]))
+        redis.call('HSET', KEYS[1], 'decreased_at', now)
+    end
+else
+    limit = math.min(tonumber(ARGV[6]), limit + 1 / limit)
+end
+redis.call('HSET', KEYS[1], 'limit', limit)
+return 1
+"""
+
+Slot = namedtuple('Slot', ['name', 'slot_id', 'limits'])
+
+class Overloaded(Exception):
+    """No upstream slot was free, or the provider pushed back before anything was streamed."""
+
+def limit_key(name):
+    return f'upstream_limit:{name}'
+
+def slots_key(name):
+    return f'upstream_slots:{name}'
+
+@lru_cache(maxsize=None)
+def get_script(source):
+    return get_redis().register_script(source)
+
+def acquire(name, limits=None):
+    """Take one of the slots for concurrent completions limited under name, e.g. a provider and model.
+
+    limits defaults to settings.UPSTREAM_CONCURRENCY. Returns a Slot to be given back
+    with release(), or None when name is at its current limit. If Redis is unavailable
+    the call is let through.
+    """
+    slot = Slot(name, uuid.uuid4().hex, limits or settings.UPSTREAM_CONCURRENCY)
+    now = time.time()
+    try:
+        acquired = get_script(ACQUIRE)(
+            keys=[limit_key(name), slots_key(name)],
+            args=[now, slot.slot_id, now + settings.UPSTREAM_SLOT_TIMEOUT, slot.limits['initial']],
+        )
+    except redis.RedisError:
+        return slot
+    return slot if acquired else None
+
+def release(slot, outcome=None, latency=None):
+    """Give back slot and adapt its limit to how the call went.
+
+    outcome is 'success' or 'overload'; None frees the slot without adapting the limit,
+    for failures that say nothing about the provider's load. latency is the time to the
+    first response in seconds.
+    """
+    limits = slot.limits
+    try:
+        get_script(RELEASE)(
+            keys=[limit_key(slot.name), slots_key(slot.name)],
+            args=[
+                time.time(), slot.slot_id, outcome or '', '' if latency is None else latency,
+                limits['min'], limits['max'], limits['initial'], limits['decrease_factor'],
+                limits['latency_tolerance'], limits['decrease_cooldown'],
+            ],
+        )
+    except redis.RedisError:
+        pass
+
+def is_overload(error):
+    """Whether error is the provider rate limiting us or failing under load."""
+    if isinstance(error, (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.Timeout)):
+        return True
+    return isinstance(error, openai.error.APIError) and (error.http_status or 0) >= 500
+
+def retry_delay(retries):
+    """Seconds to wait before retry number retries + 1: exponential backoff with full jitter."""
+    return random.uniform(0, min(settings.UPSTREAM_RETRY_MAX_DELAY, settings.UPSTREAM_RETRY_BASE_DELAY * 2 ** retries))